@@ -0,0 +1,76 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import inspect, text, update
+from app import app, db, Cliente, normalizar_identificacion
+
+# Filas por lote al actualizar
+LOTE = 1000
+
+# Columna original -> columna con el valor normalizado
+COLUMNAS = (('cedula', 'cedula_normalizada'), ('rif', 'rif_normalizado'))
+
+def agregar_columna_identificacion():
+    """
+    Agrega las columnas cedula_normalizada y rif_normalizado a la tabla cliente,
+    las llena con la cédula y el RIF normalizados de cada cliente y crea sus
+    índices únicos.
+    Si varios clientes comparten un valor, solo el de menor id lo recibe;
+    los demás se listan para fusionarlos con la herramienta de duplicados.
+    """
+    with app.app_context():
+        try:
+            existentes = [c['name'] for c in inspect(db.engine).get_columns('cliente')]
+            for _, columna in COLUMNAS:
+                if columna not in existentes:
+                    with db.engine.begin() as conexion:
+                        conexion.execute(text(f'ALTER TABLE cliente ADD COLUMN {columna} VARCHAR(20)'))
+                    print(f"Columna {columna} agregada exitosamente")
+                else:
+                    print(f"Columna {columna} ya existe")
+        except Exception as e:
+            print(f"Error al agregar columnas: {e}")
+            return
+
+        try:
+            filas = db.session.query(Cliente.id, Cliente.cedula, Cliente.rif).order_by(Cliente.id).all()
+            asignadas = {columna: {} for _, columna in COLUMNAS}
+            duplicados = []
+            cambios = []
+            for cliente_id, cedula, rif in filas:
+                cambio = {'id': cliente_id}
+                for (original, columna), valor in zip(COLUMNAS, (cedula, rif)):
+                    normalizado = normalizar_identificacion(valor)
+                    if normalizado in asignadas[columna]:
+                        duplicados.append((cliente_id, original, normalizado, asignadas[columna][normalizado]))
+                        normalizado = None
+                    elif normalizado:
+                        asignadas[columna][normalizado] = cliente_id
+                    cambio[columna] = normalizado
+                cambios.append(cambio)
+
+            # Actualización masiva por clave primaria, por lotes
+            for inicio in range(0, len(cambios), LOTE):
+                db.session.execute(update(Cliente), cambios[inicio:inicio + LOTE])
+                db.session.commit()
+            for original, columna in COLUMNAS:
+                print(f"Valores en {columna}: {len(asignadas[columna])} de {len(filas)} clientes")
+
+            for cliente_id, original, valor, original_id in duplicados:
+                print(f"Cliente {cliente_id} duplica {original} {valor} del cliente {original_id}")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error al normalizar identificaciones: {e}")
+            return
+
+        for indice in Cliente.__table__.indexes:
+            if any(columna in indice.columns for _, columna in COLUMNAS):
+                try:
+                    indice.create(db.engine, checkfirst=True)
+                    print(f"Índice {indice.name} verificado/creado")
+                except Exception as e:
+                    print(f"Error al crear índice {indice.name}: {e}")
+
+if __name__ == '__main__':
+    agregar_columna_identificacion()
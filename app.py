@@ -17,28 +17,66 @@ Fecha: 2025-08-27
 # IMPORTACIONES Y CONFIGURACIÓN INICIAL
 # ============================================================================
 
-from flask import Flask, send_file, render_template, redirect, url_for, flash, request, session, abort, jsonify
+from flask import Flask, send_file, render_template, redirect, url_for, flash, request, session, abort, jsonify, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user, AnonymousUserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.exceptions import HTTPException
 import os
-from datetime import datetime, timedelta, time
+from datetime import datetime, timedelta, time, date, timezone
+from zoneinfo import ZoneInfo
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
-from reportlab.platypus import Table, TableStyle
-from io import BytesIO
+from reportlab.platypus import Table, TableStyle, SimpleDocTemplate, Paragraph, Spacer
+from reportlab.lib.styles import getSampleStyleSheet
+from io import BytesIO, StringIO, TextIOWrapper
+from xml.sax.saxutils import escape
+import csv
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
 import requests
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
-from sqlalchemy import func, extract, and_, case, text
+from sqlalchemy import func, extract, and_, or_, case, text, select, update, union_all, literal, event
+from sqlalchemy.exc import IntegrityError
 import hashlib
+import re
+import unicodedata
+from difflib import SequenceMatcher
+import bisect
+import math
+import random
+import tempfile
+import numpy as np
+
+# Exportación columnar (Parquet) opcional: sin pyarrow se exporta en CSV
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Importación de clientes desde Excel opcional: sin openpyxl solo se acepta CSV
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
 
 
 # Configuración de la aplicación Flask
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'una_clave_secreta_muy_segura')
 
+# Railway antepone un proxy que agrega X-Forwarded-For; solo se confía en
+# las últimas PROXIES_CONFIABLES entradas, las que escribieron nuestros proxies
+PROXIES_CONFIABLES = int(os.environ.get('PROXIES_CONFIABLES', 1))
+if PROXIES_CONFIABLES > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXIES_CONFIABLES)
+
 # Configuración de la base de datos usando variables de Railway
 # Usar MYSQL_PUBLIC_URL en lugar de MYSQL_URL para la conexión externa
 db_url = os.environ.get('MYSQL_PUBLIC_URL')
@@ -58,13 +96,19 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_recycle': 300,
     'pool_size': 5,
     'max_overflow': 10,
-    'pool_timeout': 30,
-    'connect_args': {
+    'pool_timeout': 30
+}
+# connect_timeout es propio de PyMySQL; otros motores (p. ej. SQLite) no lo aceptan
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('mysql+pymysql://'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {
         'connect_timeout': 30
     }
-}
 
 db = SQLAlchemy(app)
+
+# Zona horaria del negocio: las fechas se guardan en UTC y los reportes
+# agrupan por día local
+ZONA_HORARIA_NEGOCIO = ZoneInfo(os.environ.get('ZONA_HORARIA', 'America/Caracas'))
 # ============================================================================
 # FORMULARIOS WTF
 # ============================================================================
@@ -174,11 +218,14 @@ class Usuario(db.Model, UserMixin):
 class Cliente(db.Model):
     """Modelo para clientes del sistema"""
     id = db.Column(db.Integer, primary_key=True)
-    nombre = db.Column(db.String(100), nullable=False)
-    cedula = db.Column(db.String(20))
-    rif = db.Column(db.String(20))
+    nombre = db.Column(db.String(100), nullable=False, index=True)
+    cedula = db.Column(db.String(20), index=True)
+    rif = db.Column(db.String(20), index=True)
+    # Cédula y RIF normalizados (ver normalizar_identificacion); se mantienen al guardar
+    cedula_normalizada = db.Column(db.String(20), unique=True, index=True)
+    rif_normalizado = db.Column(db.String(20), unique=True, index=True)
     direccion = db.Column(db.String(200))
-    telefono = db.Column(db.String(20))
+    telefono = db.Column(db.String(20), index=True)
     email = db.Column(db.String(100))
     deudas = db.relationship('Deuda', backref='cliente', lazy=True)
 
@@ -203,9 +250,14 @@ class Categoria(db.Model):
 
 class Deuda(db.Model):
     """Modelo para deudas de clientes"""
+    __table_args__ = (
+        # Orden del listado de deudas (fecha desc, id desc) y paginación por cursor
+        db.Index('ix_deuda_fecha_id', 'fecha', 'id'),
+        db.Index('ix_deuda_estado_fecha_id', 'estado', 'fecha', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False)
-    cliente_cedula = db.Column(db.String(20))
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False, index=True)
+    cliente_cedula = db.Column(db.String(20), index=True)
     fecha = db.Column(db.DateTime, default=datetime.utcnow)
     estado = db.Column(db.String(20), default='pendiente')  # 'pendiente' o 'pagada'
     productos = db.relationship('ProductoDeuda', backref='deuda', lazy=True)
@@ -214,7 +266,7 @@ class Deuda(db.Model):
 class ProductoDeuda(db.Model):
     """Modelo para productos asociados a una deuda"""
     id = db.Column(db.Integer, primary_key=True)
-    deuda_id = db.Column(db.Integer, db.ForeignKey('deuda.id'), nullable=False)
+    deuda_id = db.Column(db.Integer, db.ForeignKey('deuda.id'), nullable=False, index=True)
     producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), nullable=False)
     cantidad = db.Column(db.Integer, nullable=False)
     precio = db.Column(db.Float, nullable=False, default=0.0)
@@ -224,7 +276,7 @@ class ProductoDeuda(db.Model):
 class PagoParcial(db.Model):
     """Modelo para pagos parciales de deudas"""
     id = db.Column(db.Integer, primary_key=True)
-    deuda_id = db.Column(db.Integer, db.ForeignKey('deuda.id'), nullable=False)
+    deuda_id = db.Column(db.Integer, db.ForeignKey('deuda.id'), nullable=False, index=True)
     monto_usd = db.Column(db.Float, nullable=False)
     descripcion = db.Column(db.String(200))
     fecha = db.Column(db.DateTime, default=datetime.utcnow)
@@ -243,6 +295,9 @@ class Empresa(db.Model):
 
 class Pedido(db.Model):
     """Modelo para pedidos online"""
+    __table_args__ = (
+        db.Index('ix_pedido_estado_fecha', 'estado', 'fecha'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     cliente_nombre = db.Column(db.String(100))
     cliente_cedula = db.Column(db.String(20))
@@ -284,14 +339,813 @@ class TasaCambio(db.Model):
     """Modelo para tasas de cambio de moneda"""
     id = db.Column(db.Integer, primary_key=True)
     tasa = db.Column(db.Float, nullable=False)
-    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     fuente = db.Column(db.String(50), default='manual')
     descripcion = db.Column(db.String(200))
 
+class VentaDiaria(db.Model):
+    """Modelo para el acumulado diario de ventas por canal ('pedido' o 'deuda')"""
+    __tablename__ = 'ventas_diarias'
+    fecha = db.Column(db.Date, primary_key=True)
+    canal = db.Column(db.String(20), primary_key=True)
+    monto = db.Column(db.Float, nullable=False, default=0.0)
+    transacciones = db.Column(db.Integer, nullable=False, default=0)
+    unidades = db.Column(db.Integer, nullable=False, default=0)
+
+class VentaProductoDiaria(db.Model):
+    """Modelo para el acumulado diario de unidades e ingresos por producto y canal"""
+    __tablename__ = 'ventas_producto_diarias'
+    fecha = db.Column(db.Date, primary_key=True)
+    producto_id = db.Column(db.Integer, primary_key=True, index=True)
+    canal = db.Column(db.String(20), primary_key=True)
+    unidades = db.Column(db.Integer, nullable=False, default=0)
+    monto = db.Column(db.Float, nullable=False, default=0.0)
+
+class DiscrepanciaSaldo(db.Model):
+    """Modelo para deudas cuyo estado no coincide con su saldo (conciliación nocturna)"""
+    __tablename__ = 'discrepancia_saldo'
+    id = db.Column(db.Integer, primary_key=True)
+    ejecucion = db.Column(db.DateTime, nullable=False, index=True)
+    deuda_id = db.Column(db.Integer, nullable=False, index=True)
+    cliente_id = db.Column(db.Integer)
+    estado = db.Column(db.String(20))
+    total_cargos = db.Column(db.Float)
+    total_precio_actual = db.Column(db.Float)
+    total_pagado = db.Column(db.Float)
+    saldo = db.Column(db.Float)
+    tipo = db.Column(db.String(30))  # 'sobrepago', 'pagada_con_saldo', 'pendiente_saldada', 'lineas_sin_precio'
+
+class SugerenciaReposicion(db.Model):
+    """Modelo para la sugerencia de reposición calculada por producto (se reemplaza en cada ejecución)"""
+    __tablename__ = 'sugerencia_reposicion'
+    producto_id = db.Column(db.Integer, primary_key=True)
+    calculado = db.Column(db.DateTime, nullable=False)
+    stock = db.Column(db.Integer, nullable=False, default=0)
+    promedio_7 = db.Column(db.Float, nullable=False, default=0.0)
+    promedio_30 = db.Column(db.Float, nullable=False, default=0.0)
+    promedio_90 = db.Column(db.Float, nullable=False, default=0.0)
+    dias_cobertura = db.Column(db.Float)  # None si el producto no tiene ventas
+    punto_reorden = db.Column(db.Float, nullable=False, default=0.0)
+    cantidad_sugerida = db.Column(db.Integer, nullable=False, default=0)
+    estado = db.Column(db.String(20), nullable=False, index=True)  # 'agotado', 'reordenar', 'ok', 'sin_movimiento'
+
+class VersionDatos(db.Model):
+    """Contador de versión por clave para sincronizar cachés entre workers"""
+    __tablename__ = 'version_datos'
+    clave = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class LoteEstadosCuenta(db.Model):
+    """Modelo para los lotes de estados de cuenta generados en segundo plano (visibles desde cualquier worker)"""
+    __tablename__ = 'lote_estados_cuenta'
+    id = db.Column(db.Integer, primary_key=True)
+    estado = db.Column(db.String(20), nullable=False, default='procesando')  # 'procesando', 'completado', 'error'
+    fecha_inicio = db.Column(db.Date, nullable=False)
+    fecha_fin = db.Column(db.Date, nullable=False)
+    procesados = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    fallidos = db.Column(db.Integer, nullable=False, default=0)
+    errores = db.Column(db.Text)  # Primeros errores por cliente, uno por línea
+    archivo = db.Column(db.String(200))  # Nombre del ZIP dentro de DIRECTORIO_ESTADOS_CUENTA
+    error = db.Column(db.String(500))
+    creado = db.Column(db.DateTime, default=datetime.utcnow)
+    actualizado = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# ============================================================================
+# CACHÉ EN MEMORIA
+# ============================================================================
+
+class CacheTTL:
+    """
+    Caché en memoria del proceso con expiración por tiempo (TTL)
+    Cada worker mantiene su propia copia de los valores
+    """
+    def __init__(self, ttl_segundos, max_entradas=256):
+        self.ttl = ttl_segundos
+        self.max_entradas = max_entradas
+        self._datos = {}
+        self._lock = threading.Lock()
+    
+    def leer(self, clave, defecto=None):
+        """Devuelve el valor vigente para la clave o `defecto` si no existe o expiró"""
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada and entrada[0] > monotonic():
+                return entrada[1]
+        return defecto
+    
+    def guardar(self, clave, valor):
+        """Guarda un valor con el TTL de la caché"""
+        ahora = monotonic()
+        with self._lock:
+            self._datos.pop(clave, None)
+            if len(self._datos) >= self.max_entradas:
+                # Descartar entradas vencidas y, si no alcanza, la más antigua
+                for k in [k for k, (expira, _) in self._datos.items() if expira <= ahora]:
+                    del self._datos[k]
+                if len(self._datos) >= self.max_entradas:
+                    del self._datos[next(iter(self._datos))]
+            self._datos[clave] = (ahora + self.ttl, valor)
+    
+    def obtener(self, clave, calcular):
+        """
+        Devuelve el valor guardado para la clave o lo calcula si expiró
+        
+        Args:
+            clave: Clave del valor en caché
+            calcular (callable): Función sin argumentos que produce el valor
+        """
+        faltante = object()
+        valor = self.leer(clave, faltante)
+        if valor is not faltante:
+            return valor
+        
+        # Calcular fuera del lock para no bloquear otras claves
+        valor = calcular()
+        self.guardar(clave, valor)
+        return valor
+    
+    def invalidar(self, clave=None):
+        """Elimina una clave o, si no se indica, todo el contenido"""
+        with self._lock:
+            if clave is None:
+                self._datos.clear()
+            else:
+                self._datos.pop(clave, None)
+
+class AlmacenLocal:
+    """
+    Almacén clave-valor con expiración en memoria del proceso
+    
+    Es el sustituto local de un almacén compartido entre workers (Redis,
+    memcached, etc.). Una implementación compartida debe ofrecer la misma
+    interfaz: `ahora()` con un reloj común y `actualizar()` atómico.
+    """
+    def __init__(self, max_claves=10000):
+        self.max_claves = max_claves
+        self._datos = {}
+        self._lock = threading.Lock()
+    
+    def ahora(self):
+        """Reloj del almacén en segundos"""
+        return monotonic()
+    
+    def actualizar(self, clave, funcion, ttl):
+        """
+        Lee, transforma y guarda el valor de una clave de forma atómica
+        
+        Args:
+            clave: Clave del valor
+            funcion (callable): Recibe el valor actual (o None) y devuelve
+                                (nuevo_valor, resultado)
+            ttl (float): Segundos tras los que la clave puede descartarse
+        
+        Returns:
+            El `resultado` devuelto por la función
+        """
+        ahora = self.ahora()
+        with self._lock:
+            entrada = self._datos.get(clave)
+            valor = entrada[1] if entrada and entrada[0] > ahora else None
+            nuevo_valor, resultado = funcion(valor)
+            
+            if clave not in self._datos and len(self._datos) >= self.max_claves:
+                self._purgar(ahora)
+            self._datos[clave] = (ahora + ttl, nuevo_valor)
+        return resultado
+    
+    def _purgar(self, ahora):
+        """Elimina claves vencidas y, si no alcanza, la más antigua"""
+        for k in [k for k, (expira, _) in self._datos.items() if expira <= ahora]:
+            del self._datos[k]
+        if len(self._datos) >= self.max_claves:
+            del self._datos[next(iter(self._datos))]
+
+class LimitadorTokens:
+    """
+    Limitador de tasa por token bucket
+    Cada clave dispone de `capacidad` tokens que se recargan a `tasa` por segundo.
+    Las cubetas viven en `almacen` (por defecto, en memoria del proceso).
+    """
+    def __init__(self, capacidad, tasa, max_claves=10000, almacen=None, prefijo=''):
+        self.capacidad = capacidad
+        self.tasa = tasa
+        self.prefijo = prefijo
+        self.almacen = almacen or AlmacenLocal(max_claves=max_claves)
+    
+    def permitir(self, clave, costo=1):
+        """
+        Consume `costo` tokens de la cubeta de la clave
+        
+        Returns:
+            bool: True si había tokens suficientes
+        """
+        ahora = self.almacen.ahora()
+        
+        def consumir(cubeta):
+            tokens, ultimo = cubeta or (self.capacidad, ahora)
+            tokens = min(self.capacidad, tokens + (ahora - ultimo) * self.tasa)
+            permitido = tokens >= costo
+            if permitido:
+                tokens -= costo
+            return (tokens, ahora), permitido
+        
+        # Una cubeta que no se toca en este tiempo ya está llena y puede descartarse
+        ttl = self.capacidad / self.tasa
+        return self.almacen.actualizar(f"{self.prefijo}{clave}", consumir, ttl)
+    
+    def disponible(self, clave, costo=1):
+        """Indica si la cubeta de la clave tiene `costo` tokens, sin consumirlos"""
+        ahora = self.almacen.ahora()
+        
+        def consultar(cubeta):
+            tokens, ultimo = cubeta or (self.capacidad, ahora)
+            tokens = min(self.capacidad, tokens + (ahora - ultimo) * self.tasa)
+            return (tokens, ahora), tokens >= costo
+        
+        return self.almacen.actualizar(f"{self.prefijo}{clave}", consultar, self.capacidad / self.tasa)
+
+class CacheTasaCambio:
+    """
+    Tasa de cambio vigente en memoria del proceso
+    
+    Quien registra una tasa la guarda aquí al confirmar (write-through). Los
+    demás workers detectan tasas nuevas comparando MAX(id) de tasa_cambio
+    (búsqueda por clave primaria) como máximo una vez cada
+    `intervalo_verificacion` segundos, y solo entonces releen la fila.
+    """
+    def __init__(self, intervalo_verificacion=5):
+        self.intervalo_verificacion = intervalo_verificacion
+        self._tasa = None
+        self._version = None
+        self._verificado = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _copiar(tasa):
+        """Copia plana de una fila TasaCambio, segura para compartir entre hilos"""
+        return {
+            'id': tasa.id,
+            'tasa': tasa.tasa,
+            'fecha_actualizacion': tasa.fecha_actualizacion,
+            'fuente': tasa.fuente,
+            'descripcion': tasa.descripcion
+        }
+    
+    def obtener(self):
+        """
+        Devuelve la tasa vigente como diccionario (o None si no hay tasas)
+        con las claves id, tasa, fecha_actualizacion, fuente y descripcion
+        """
+        ahora = monotonic()
+        with self._lock:
+            if self._verificado is not None and ahora - self._verificado < self.intervalo_verificacion:
+                return self._tasa
+            version_actual = self._version
+        
+        version = db.session.query(func.max(TasaCambio.id)).scalar()
+        if version is None or version != version_actual:
+            fila = TasaCambio.query.order_by(TasaCambio.fecha_actualizacion.desc(), TasaCambio.id.desc()).first()
+            tasa = self._copiar(fila) if fila else None
+            with self._lock:
+                self._tasa = tasa
+                self._version = version
+        
+        with self._lock:
+            self._verificado = ahora
+            return self._tasa
+    
+    def guardar(self, tasa):
+        """
+        Publica una tasa recién confirmada si es más reciente que la vigente
+        
+        Args:
+            tasa (TasaCambio): Fila ya guardada en la base de datos
+        """
+        copia = self._copiar(tasa)
+        with self._lock:
+            actual = self._tasa
+            if actual is None or actual['fecha_actualizacion'] is None or copia['fecha_actualizacion'] >= actual['fecha_actualizacion']:
+                self._tasa = copia
+            self._version = max(self._version or 0, copia['id'])
+            self._verificado = monotonic()
+    
+    def invalidar(self):
+        """Fuerza la verificación en la próxima lectura"""
+        with self._lock:
+            self._verificado = None
+
+class HistorialTasas:
+    """
+    Serie histórica de tasas de cambio en memoria, ordenada por fecha
+    
+    Responde "tasa vigente en el momento T" con búsqueda binaria y convierte
+    lotes de montos con numpy.searchsorted. Se recarga de forma incremental:
+    cada `intervalo_verificacion` segundos lee solo las filas con id mayor
+    al último cargado (rango sobre la clave primaria).
+    
+    Para momentos anteriores a la primera tasa registrada se usa la primera.
+    """
+    def __init__(self, intervalo_verificacion=30):
+        self.intervalo_verificacion = intervalo_verificacion
+        self._fechas = []
+        self._fechas_np = np.empty(0, dtype='datetime64[us]')
+        self._tasas = np.empty(0)
+        self._ultimo_id = 0
+        self._verificado = None
+        self._lock = threading.Lock()
+    
+    @property
+    def version(self):
+        """Id de la última tasa cargada; cambia cuando se incorporan tasas"""
+        return self._ultimo_id
+    
+    def _incorporar(self, filas):
+        """Agrega filas (id, fecha, tasa) manteniendo el orden por fecha; requiere el lock"""
+        filas = [f for f in filas if f[0] > self._ultimo_id and f[1] is not None]
+        if not filas:
+            return
+        filas.sort(key=lambda f: (f[1], f[0]))
+        
+        tasas = self._tasas.tolist()
+        if not self._fechas or filas[0][1] >= self._fechas[-1]:
+            # Caso normal: las tasas nuevas son las más recientes
+            self._fechas.extend(f[1] for f in filas)
+            tasas.extend(f[2] for f in filas)
+        else:
+            combinadas = sorted(list(zip(self._fechas, tasas)) + [(f[1], f[2]) for f in filas],
+                                key=lambda par: par[0])
+            self._fechas = [fecha for fecha, _ in combinadas]
+            tasas = [tasa for _, tasa in combinadas]
+        
+        self._fechas_np = np.array(self._fechas, dtype='datetime64[us]')
+        self._tasas = np.array(tasas, dtype=float)
+        self._ultimo_id = max(self._ultimo_id, max(f[0] for f in filas))
+    
+    def _actualizar(self):
+        """Carga las tasas nuevas si pasó el intervalo de verificación"""
+        ahora = monotonic()
+        with self._lock:
+            if self._verificado is not None and ahora - self._verificado < self.intervalo_verificacion:
+                return
+            ultimo_id = self._ultimo_id
+        
+        nuevas = db.session.query(TasaCambio.id, TasaCambio.fecha_actualizacion, TasaCambio.tasa
+                                  ).filter(TasaCambio.id > ultimo_id).order_by(TasaCambio.id).all()
+        with self._lock:
+            self._incorporar([tuple(f) for f in nuevas])
+            self._verificado = ahora
+    
+    def agregar(self, tasa):
+        """
+        Incorpora una tasa recién confirmada (write-through)
+        
+        Args:
+            tasa (TasaCambio): Fila ya guardada en la base de datos
+        """
+        with self._lock:
+            # Solo se agrega directamente si el historial ya está cargado y no hay
+            # filas intermedias; si no, la próxima lectura carga lo que falte
+            if self._verificado is not None and tasa.id == self._ultimo_id + 1:
+                self._incorporar([(tasa.id, tasa.fecha_actualizacion, tasa.tasa)])
+            else:
+                self._verificado = None
+    
+    def tasa_en(self, momento):
+        """
+        Tasa vigente en un momento (fecha-hora UTC)
+        
+        Returns:
+            float: Bolívares por dólar, o None si no hay tasas registradas
+        """
+        self._actualizar()
+        with self._lock:
+            if not self._fechas:
+                return None
+            indice = bisect.bisect_right(self._fechas, momento or datetime.utcnow()) - 1
+            return float(self._tasas[max(indice, 0)])
+    
+    def convertir(self, montos, momentos):
+        """
+        Convierte montos en USD a bolívares con la tasa vigente en cada momento
+        
+        Args:
+            montos (list): Montos en USD
+            momentos (list): Fechas-hora UTC de cada monto (None = ahora)
+        
+        Returns:
+            tuple: (numpy.ndarray de tasas, numpy.ndarray de montos en Bs);
+                   ceros si no hay tasas registradas
+        """
+        self._actualizar()
+        ahora = datetime.utcnow()
+        momentos_np = np.array([m or ahora for m in momentos], dtype='datetime64[us]')
+        montos_np = np.asarray(montos, dtype=float)
+        with self._lock:
+            if not len(self._tasas):
+                return np.zeros(len(montos_np)), np.zeros(len(montos_np))
+            indices = np.searchsorted(self._fechas_np, momentos_np, side='right') - 1
+            tasas = self._tasas[np.clip(indices, 0, None)]
+        return tasas, montos_np * tasas
+
+class CacheDatosGlobales:
+    """
+    Empresa y Configuracion en memoria del proceso para el context processor
+    
+    Guarda copias planas (diccionarios) de ambas filas. Quien las modifica
+    incrementa la versión 'datos_globales' en version_datos en la misma
+    transacción; los demás workers comparan esa versión (búsqueda por clave
+    primaria) como máximo una vez cada `intervalo_verificacion` segundos.
+    """
+    CLAVE_VERSION = 'datos_globales'
+    
+    def __init__(self, intervalo_verificacion=5):
+        self.intervalo_verificacion = intervalo_verificacion
+        self._datos = None
+        self._version = None
+        self._verificado = None
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _copiar(fila):
+        """Copia plana de una fila, segura para compartir entre hilos"""
+        if fila is None:
+            return None
+        return {columna.name: getattr(fila, columna.name) for columna in fila.__table__.columns}
+    
+    @staticmethod
+    def _configuracion_por_defecto():
+        """Valores por defecto de Configuracion si aún no existe la fila"""
+        return {columna.name: columna.default.arg if columna.default is not None and not callable(columna.default.arg) else None
+                for columna in Configuracion.__table__.columns}
+    
+    def obtener(self):
+        """
+        Devuelve un diccionario con las claves 'empresa' (o None) y
+        'configuracion', ambas como diccionarios de columnas
+        """
+        ahora = monotonic()
+        with self._lock:
+            if self._datos is not None and ahora - self._verificado < self.intervalo_verificacion:
+                return self._datos
+            version_actual = self._version
+        
+        version = db.session.query(VersionDatos.version).filter(VersionDatos.clave == self.CLAVE_VERSION).scalar()
+        with self._lock:
+            datos = self._datos
+        if datos is None or version is None or version != version_actual:
+            datos = {
+                'empresa': self._copiar(Empresa.query.first()),
+                'configuracion': self._copiar(Configuracion.query.first()) or self._configuracion_por_defecto()
+            }
+        
+        with self._lock:
+            self._datos = datos
+            self._version = version
+            self._verificado = ahora
+            return datos
+    
+    def invalidar(self):
+        """Descarta las copias locales; se releen en la próxima lectura"""
+        with self._lock:
+            self._datos = None
+
+class VersionCompartida:
+    """
+    Contador de version_datos que todos los workers consultan
+    
+    Cada worker lo relee (búsqueda por clave primaria) como máximo una vez
+    cada `intervalo_verificacion` segundos; quien hace un cambio lo incrementa
+    en la misma transacción.
+    """
+    def __init__(self, clave, intervalo_verificacion=5):
+        self.clave = clave
+        self.intervalo_verificacion = intervalo_verificacion
+        self._version = None
+        self._verificado = None
+        self._lock = threading.Lock()
+    
+    def obtener(self):
+        """Versión vigente (con a lo sumo `intervalo_verificacion` segundos de retraso)"""
+        ahora = monotonic()
+        with self._lock:
+            if self._verificado is not None and ahora - self._verificado < self.intervalo_verificacion:
+                return self._version
+        
+        version = db.session.query(VersionDatos.version).filter(VersionDatos.clave == self.clave).scalar()
+        with self._lock:
+            self._version = version
+            self._verificado = ahora
+        return version
+    
+    def incrementar(self):
+        """Incrementa la versión dentro de la transacción actual (crea la fila si falta)"""
+        insertar_o_actualizar(VersionDatos.__table__, [{'clave': self.clave, 'version': 1}],
+                              claves=('clave',), sumar=('version',))
+    
+    def invalidar(self):
+        """Fuerza a releer la versión en la próxima consulta"""
+        with self._lock:
+            self._verificado = None
+
+def marcar_datos_globales_modificados():
+    """
+    Incrementa la versión de Empresa/Configuracion dentro de la transacción
+    actual y marca la sesión para descartar la caché local al confirmar
+    """
+    db.session.execute(
+        update(VersionDatos)
+        .where(VersionDatos.clave == CacheDatosGlobales.CLAVE_VERSION)
+        .values(version=VersionDatos.version + 1)
+    )
+    db.session.info['datos_globales_modificados'] = True
+
+def inicializar_datos_globales():
+    """
+    Crea al arrancar la fila de configuración y el contador de versión si
+    faltan, para que ninguna ruta que solo renderiza tenga que escribir.
+    También crea las tablas de soporte que no existían en instalaciones previas.
+    """
+    VersionDatos.__table__.create(db.engine, checkfirst=True)
+    LoteEstadosCuenta.__table__.create(db.engine, checkfirst=True)
+    if not db.session.get(VersionDatos, CacheDatosGlobales.CLAVE_VERSION):
+        db.session.add(VersionDatos(clave=CacheDatosGlobales.CLAVE_VERSION, version=0))
+    if not Configuracion.query.first():
+        db.session.add(Configuracion())
+    db.session.commit()
+
+def obtener_ip_cliente():
+    """
+    Obtiene la IP del cliente considerando el proxy de Railway
+    ProxyFix ya tomó de X-Forwarded-For la entrada agregada por el proxy
+    confiable; las entradas anteriores las controla el cliente y se ignoran.
+    """
+    return request.remote_addr or 'desconocida'
+
+# Resultados de reportes pesados (antigüedad de saldos, etc.)
+cache_reportes = CacheTTL(ttl_segundos=60)
+
+# PDF de estados de cuenta, por cliente, rango y versión del libro
+cache_estados_cuenta = CacheTTL(ttl_segundos=3600, max_entradas=64)
+
+# Resumen de ventas por período del dashboard; se invalida al confirmar
+# cambios en ventas_diarias y el TTL acota lo desfasado entre workers
+cache_resumen_ventas = CacheTTL(ttl_segundos=60, max_entradas=4)
+
+# Series de ventas por día/semana/mes: solo se guardan períodos ya cerrados
+cache_buckets_ventas = CacheTTL(ttl_segundos=3600, max_entradas=1024)
+
+# Ranking de productos por ventana de tiempo, por día y canal
+cache_ranking_productos = CacheTTL(ttl_segundos=3600, max_entradas=8)
+
+# Datos del dashboard de administración; se invalida al confirmar cambios
+# en productos, clientes, deudas, pagos o pedidos
+cache_dashboard = CacheTTL(ttl_segundos=60, max_entradas=1)
+
+# Tasa de cambio vigente (write-through y verificación de versión entre workers)
+tasa_cambio_vigente = CacheTasaCambio(intervalo_verificacion=5)
+
+# Historial de tasas para convertir montos a la tasa de su fecha
+historial_tasas = HistorialTasas(intervalo_verificacion=30)
+
+# Usuarios autenticados (desconectados de la sesión), por id, versión de
+# credenciales y versión compartida de usuarios: un cambio de contraseña en
+# cualquier worker cambia esta última y deja obsoletas las copias de todos
+cache_usuarios = CacheTTL(ttl_segundos=300, max_entradas=256)
+version_usuarios = VersionCompartida('usuarios', intervalo_verificacion=5)
+
+# Identificaciones consultadas en el checkout que no pertenecen a ningún cliente
+cache_identificaciones_inexistentes = CacheTTL(ttl_segundos=30, max_entradas=4096)
+
+# Pares de clientes posiblemente duplicados; se invalida al fusionar
+cache_duplicados_clientes = CacheTTL(ttl_segundos=600, max_entradas=1)
+
+# Empresa y configuración que se inyectan en todas las plantillas
+datos_globales = CacheDatosGlobales(intervalo_verificacion=5)
+
+# Consulta pública de deudas: resultados por cliente y límites de tráfico
+cache_consulta_deudas = CacheTTL(ttl_segundos=30, max_entradas=1024)
+limitador_consulta_ip = LimitadorTokens(capacidad=10, tasa=0.2)
+limitador_consulta_global = LimitadorTokens(capacidad=30, tasa=5)
+
+# Inicio de sesión: cubetas por IP y por usuario en un almacén común. La del
+# usuario solo se consume con contraseñas incorrectas, venga de la IP que venga.
+# Las IPs desde las que el usuario ya entró con éxito usan en su lugar una
+# cubeta propia (usuario, IP), así quien agota la cubeta del usuario desde
+# otras direcciones no le impide entrar desde sus equipos habituales
+almacen_limites_login = AlmacenLocal(max_claves=10000)
+limitador_login_ip = LimitadorTokens(capacidad=10, tasa=1 / 6, almacen=almacen_limites_login, prefijo='login_ip:')
+limitador_login_usuario = LimitadorTokens(capacidad=5, tasa=1 / 60, almacen=almacen_limites_login, prefijo='login_usuario:')
+limitador_login_dispositivo = LimitadorTokens(capacidad=5, tasa=1 / 60, almacen=almacen_limites_login, prefijo='login_dispositivo:')
+dispositivos_confiables_login = CacheTTL(ttl_segundos=30 * 24 * 3600, max_entradas=10000)
+
+# ============================================================================
+# TAREAS EN SEGUNDO PLANO
+# ============================================================================
+
+# Trabajos largos (lotes de PDF, etc.) que no deben ocupar los workers web
+ejecutor_fondo = ThreadPoolExecutor(max_workers=2, thread_name_prefix='tareas_fondo')
+
+# Hashing de contraseñas (PBKDF2): hilos y cola acotados por worker
+HASH_HILOS = int(os.environ.get('HASH_HILOS', 2))
+HASH_MAX_PENDIENTES = int(os.environ.get('HASH_MAX_PENDIENTES', 8))
+# Segundos que una petición espera un hash antes de responder "ocupado"
+HASH_ESPERA = float(os.environ.get('HASH_ESPERA', 3))
+HASH_ITERACIONES = int(os.environ.get('HASH_ITERACIONES', 600000))
+METODO_HASH = f'pbkdf2:sha256:{HASH_ITERACIONES}'
+ejecutor_hash = ThreadPoolExecutor(max_workers=HASH_HILOS, thread_name_prefix='hash_contrasenas')
+cupos_hash = threading.BoundedSemaphore(HASH_MAX_PENDIENTES)
+
+def ejecutar_hash(funcion, *args, espera=None):
+    """
+    Ejecuta un cálculo de hash de contraseñas en el ejecutor acotado
+    
+    El cupo se libera cuando el cálculo termina y no cuando la petición deja
+    de esperarlo, así nunca hay más de HASH_MAX_PENDIENTES en curso.
+    
+    Args:
+        funcion (callable): check_password_hash o generate_password_hash
+        espera (float): Segundos máximos de espera (por defecto HASH_ESPERA)
+    
+    Returns:
+        El resultado de la función o None si no hay cupo, se agotó la espera
+        o el cálculo falló
+    """
+    if not cupos_hash.acquire(blocking=False):
+        return None
+    try:
+        futuro = ejecutor_hash.submit(funcion, *args)
+    except Exception as e:
+        cupos_hash.release()
+        print(f"Error al encolar hash de contraseña: {e}")
+        return None
+    futuro.add_done_callback(lambda _: cupos_hash.release())
+    
+    try:
+        return futuro.result(timeout=HASH_ESPERA if espera is None else espera)
+    except Exception as e:
+        print(f"Error al calcular hash de contraseña: {e!r}")
+        return None
+
+def verificar_contrasena(hash_guardado, contrasena, espera=None):
+    """
+    Verifica una contraseña en el ejecutor acotado de hashing
+    
+    Returns:
+        bool: True si coincide, False si no coincide o None si el servidor
+              está ocupado (sin cupo o sin resultado a tiempo)
+    """
+    return ejecutar_hash(check_password_hash, hash_guardado, contrasena, espera=espera)
+
+def generar_hash_contrasena(contrasena, espera=None):
+    """
+    Genera el hash de una contraseña con METODO_HASH en el ejecutor acotado
+    
+    Returns:
+        str: Hash o None si el servidor está ocupado
+    """
+    return ejecutar_hash(generate_password_hash, contrasena, METODO_HASH, espera=espera)
+
+def requiere_rehash(hash_guardado):
+    """Indica si un hash fue generado con un método o costo distinto del configurado"""
+    return hash_guardado.split('$', 1)[0] != METODO_HASH
+
+def ejecutar_en_fondo(funcion, *args, **kwargs):
+    """
+    Ejecuta una función en el ejecutor de fondo dentro del contexto de la app
+    
+    Returns:
+        Future: Resultado futuro del trabajo
+    """
+    def trabajo():
+        with app.app_context():
+            try:
+                return funcion(*args, **kwargs)
+            except Exception as e:
+                print(f"Error en tarea de fondo {funcion.__name__}: {e}")
+                import traceback
+                traceback.print_exc()
+                raise
+    return ejecutor_fondo.submit(trabajo)
+
+class InterruptorCircuito:
+    """
+    Circuit breaker para servicios externos
+    
+    Tras `umbral_fallos` fallos seguidos se abre y rechaza llamadas durante
+    `espera` segundos; luego deja pasar un intento de prueba (semiabierto)
+    que lo cierra si tiene éxito o lo vuelve a abrir si falla.
+    """
+    def __init__(self, umbral_fallos=3, espera=300):
+        self.umbral_fallos = umbral_fallos
+        self.espera = espera
+        self._fallos = 0
+        self._abierto_hasta = None
+        self._lock = threading.Lock()
+    
+    def permitir(self):
+        """Indica si se puede llamar al servicio"""
+        with self._lock:
+            return self._abierto_hasta is None or monotonic() >= self._abierto_hasta
+    
+    def registrar_exito(self):
+        """Cierra el circuito"""
+        with self._lock:
+            self._fallos = 0
+            self._abierto_hasta = None
+    
+    def registrar_fallo(self):
+        """Cuenta un fallo y abre el circuito al llegar al umbral"""
+        with self._lock:
+            self._fallos += 1
+            if self._fallos >= self.umbral_fallos:
+                self._abierto_hasta = monotonic() + self.espera
+    
+    @property
+    def estado(self):
+        """'cerrado', 'abierto' o 'semiabierto'"""
+        with self._lock:
+            if self._abierto_hasta is None:
+                return 'cerrado'
+            return 'abierto' if monotonic() < self._abierto_hasta else 'semiabierto'
+
+class FuenteTasaJSON:
+    """
+    Fuente de tasa de cambio que lee un número de una respuesta JSON por HTTP
+    
+    Cada fuente tiene su propio circuit breaker y reintenta con espera
+    exponencial con jitter. Solo debe llamarse desde tareas de fondo.
+    """
+    def __init__(self, nombre, url, campo='tasa', timeout=(3, 5), intentos=3, espera_base=1.0):
+        self.nombre = nombre
+        self.url = url
+        self.campo = campo
+        self.timeout = timeout
+        self.intentos = intentos
+        self.espera_base = espera_base
+        self.interruptor = InterruptorCircuito()
+    
+    def _leer_campo(self, datos):
+        """Extrae el valor de una ruta con puntos (ej. 'monitors.usd.price')"""
+        for parte in self.campo.split('.'):
+            datos = datos[int(parte)] if isinstance(datos, list) else datos[parte]
+        return float(str(datos).replace(',', '.'))
+    
+    def obtener(self):
+        """
+        Consulta la tasa
+        
+        Returns:
+            float: Bolívares por dólar
+        
+        Raises:
+            RuntimeError: Si el circuito está abierto o fallaron todos los intentos
+        """
+        if not self.interruptor.permitir():
+            raise RuntimeError(f'circuito abierto para la fuente {self.nombre}')
+        
+        ultimo_error = None
+        for intento in range(self.intentos):
+            if intento:
+                # Espera exponencial con jitter completo
+                sleep(random.uniform(0, self.espera_base * 2 ** intento))
+            try:
+                respuesta = requests.get(self.url, timeout=self.timeout)
+                respuesta.raise_for_status()
+                tasa = self._leer_campo(respuesta.json())
+                if tasa <= 0:
+                    raise ValueError(f'tasa no válida: {tasa}')
+                self.interruptor.registrar_exito()
+                return tasa
+            except Exception as e:
+                ultimo_error = e
+        
+        self.interruptor.registrar_fallo()
+        raise RuntimeError(f'fuente {self.nombre} sin respuesta válida: {ultimo_error}')
+
+def cargar_fuentes_tasa_cambio():
+    """
+    Lee las fuentes automáticas de TASA_CAMBIO_FUENTES, en orden de prioridad
+    
+    Formato: nombre|url|campo separados por coma, por ejemplo
+    "stub|http://127.0.0.1:8765/tasa|tasa" (ver stub_tasa_cambio.py)
+    """
+    fuentes = []
+    for definicion in os.environ.get('TASA_CAMBIO_FUENTES', '').split(','):
+        partes = [p.strip() for p in definicion.split('|')]
+        if len(partes) >= 2 and partes[0] and partes[1]:
+            fuentes.append(FuenteTasaJSON(partes[0], partes[1], partes[2] if len(partes) > 2 and partes[2] else 'tasa'))
+    return fuentes
+
+fuentes_tasa_cambio = cargar_fuentes_tasa_cambio()
+
 # ============================================================================
 # FUNCIONES AUXILIARES
 # ============================================================================
 
+# IVA incluido en los precios de venta
+TASA_IVA = 0.16
+
 def es_categoria_personalizada(categoria_id):
     """Verifica si una categoría es la de productos personalizados"""
     categoria_personalizada = Categoria.query.filter_by(nombre='Personalizado').first()
@@ -306,6 +1160,85 @@ def es_categoria_personalizada(categoria_id):
     except (ValueError, TypeError):
         return False
 
+def registrar_tasa_cambio(tasa, fuente='manual', descripcion=None, fecha=None):
+    """
+    Guarda una nueva tasa de cambio y la publica en la caché de tasa vigente
+    
+    Args:
+        tasa (float): Bolívares por dólar
+        fuente (str): Origen de la tasa ('manual', 'bcv', etc.)
+        descripcion (str): Nota opcional
+        fecha (datetime): Fecha de la tasa en UTC (por defecto ahora)
+    
+    Returns:
+        TasaCambio: Fila creada
+    """
+    tasa_cambio = TasaCambio(
+        tasa=float(tasa),
+        fuente=fuente,
+        descripcion=descripcion,
+        fecha_actualizacion=fecha or datetime.utcnow()
+    )
+    db.session.add(tasa_cambio)
+    db.session.commit()
+    tasa_cambio_vigente.guardar(tasa_cambio)
+    historial_tasas.agregar(tasa_cambio)
+    return tasa_cambio
+
+# Variación máxima aceptada frente a la tasa vigente (protege de respuestas erróneas)
+VARIACION_MAXIMA_TASA = 0.5
+
+def actualizar_tasa_automatica():
+    """
+    Consulta las fuentes automáticas en orden y guarda la primera tasa
+    válida como TasaCambio con su fuente
+    
+    Se ejecuta solo en tareas de fondo (programada o encolada); las rutas
+    nunca esperan la llamada externa. No guarda nada si la tasa no cambió.
+    
+    Returns:
+        float: Tasa guardada o vigente, o None si ninguna fuente respondió
+    """
+    vigente = tasa_cambio_vigente.obtener()
+    for fuente in fuentes_tasa_cambio:
+        try:
+            tasa = fuente.obtener()
+        except Exception as e:
+            print(f"Error al obtener tasa de cambio ({fuente.nombre}): {e}")
+            continue
+        
+        if vigente and vigente['tasa'] > 0 and abs(tasa - vigente['tasa']) / vigente['tasa'] > VARIACION_MAXIMA_TASA:
+            print(f"Tasa descartada de {fuente.nombre}: {tasa} difiere demasiado de {vigente['tasa']}")
+            fuente.interruptor.registrar_fallo()
+            continue
+        
+        if vigente and vigente['fuente'] == fuente.nombre and abs(tasa - vigente['tasa']) < 0.0001:
+            return vigente['tasa']
+        
+        registrar_tasa_cambio(tasa, fuente=fuente.nombre,
+                              descripcion='Tasa obtenida automáticamente')
+        print(f"Tasa de cambio actualizada desde {fuente.nombre}: {tasa}")
+        return tasa
+    return None
+
+def hoy_negocio():
+    """Fecha de hoy en la zona horaria del negocio"""
+    return datetime.now(ZONA_HORARIA_NEGOCIO).date()
+
+def fecha_negocio(momento):
+    """
+    Convierte una fecha-hora guardada en UTC (sin zona) al día local del negocio
+    
+    Args:
+        momento (datetime): Fecha-hora UTC; None se toma como ahora
+    
+    Returns:
+        date: Día en la zona horaria del negocio
+    """
+    if momento is None:
+        momento = datetime.utcnow()
+    return momento.replace(tzinfo=timezone.utc).astimezone(ZONA_HORARIA_NEGOCIO).date()
+
 def get_date_range(period):
     """
     Obtiene el rango de fechas para un período específico
@@ -317,7 +1250,7 @@ def get_date_range(period):
         tuple: (fecha_inicio, fecha_fin)
     """
     try:
-        hoy = datetime.now().date()
+        hoy = hoy_negocio()
         
         if period == 'today':
             return hoy, hoy
@@ -350,13 +1283,16 @@ def get_date_range(period):
             return hoy, hoy
     except Exception as e:
         print(f"Error en get_date_range: {e}")
-        hoy = datetime.now().date()
+        hoy = hoy_negocio()
         return hoy, hoy
 
 def calcular_ventas_periodo(fecha_inicio, fecha_fin):
     """
     Calcula las ventas totales para un período específico
     
+    Lee el acumulado diario (ventas_diarias), que suma pedidos completados y
+    deudas pagadas; una fila por día y canal en lugar de recorrer el historial.
+    
     Args:
         fecha_inicio (date): Fecha de inicio del período
         fecha_fin (date): Fecha de fin del período
@@ -365,40 +1301,17 @@ def calcular_ventas_periodo(fecha_inicio, fecha_fin):
         dict: {'monto': float, 'pedidos': int}
     """
     try:
-        # Convertir a datetime para incluir toda la fecha
-        inicio_dt = datetime.combine(fecha_inicio, time.min)
-        fin_dt = datetime.combine(fecha_fin, time.max)
-        
-        # Ventas de pedidos completados
-        ventas_pedidos = db.session.query(
-            func.sum(Pedido.total).label('total_ventas'),
-            func.count(Pedido.id).label('total_transacciones')
+        total = db.session.query(
+            func.coalesce(func.sum(VentaDiaria.monto), 0).label('monto'),
+            func.coalesce(func.sum(VentaDiaria.transacciones), 0).label('transacciones')
         ).filter(
-            Pedido.estado == 'completado',
-            Pedido.fecha >= inicio_dt,
-            Pedido.fecha <= fin_dt
-        ).first()
-        
-        # Ventas de deudas pagadas
-        deudas_pagadas = Deuda.query.filter(
-            Deuda.estado == 'pagada',
-            Deuda.fecha >= inicio_dt,
-            Deuda.fecha <= fin_dt
-        ).all()
-        
-        total_ventas_deudas = 0
-        for deuda in deudas_pagadas:
-            for producto_deuda in deuda.productos:
-                producto = Producto.query.get(producto_deuda.producto_id)
-                if producto:
-                    total_ventas_deudas += producto.precio * producto_deuda.cantidad
-        
-        total_ventas = (ventas_pedidos.total_ventas or 0) + total_ventas_deudas
-        total_transacciones = (ventas_pedidos.total_transacciones or 0) + len(deudas_pagadas)
+            VentaDiaria.fecha >= fecha_inicio,
+            VentaDiaria.fecha <= fecha_fin
+        ).one()
         
         return {
-            'monto': float(total_ventas),
-            'pedidos': total_transacciones
+            'monto': float(total.monto or 0),
+            'pedidos': int(total.transacciones or 0)
         }
     except Exception as e:
         print(f"Error en calcular_ventas_periodo: {e}")
@@ -406,6 +1319,258 @@ def calcular_ventas_periodo(fecha_inicio, fecha_fin):
         traceback.print_exc()
         return {'monto': 0, 'pedidos': 0}
 
+def rango_periodo_anterior(periodo, inicio, fin):
+    """
+    Obtiene el rango con el que se compara un período del dashboard
+    
+    Args:
+        periodo (str): Período ('today', 'yesterday', 'week', etc.)
+        inicio (date): Inicio del período
+        fin (date): Fin del período
+    
+    Returns:
+        tuple: (fecha_inicio, fecha_fin) o None si el período no tiene comparación
+    """
+    if periodo in ('today', 'week', 'month'):
+        anterior = {'today': 'yesterday', 'week': 'last_week', 'month': 'last_month'}[periodo]
+        return get_date_range(anterior)
+    elif periodo == 'yesterday':
+        antier = inicio - timedelta(days=1)
+        return antier, antier
+    elif periodo == 'last_week':
+        return inicio - timedelta(weeks=1), fin - timedelta(weeks=1)
+    elif periodo == 'last_month':
+        fin_anterior = inicio - timedelta(days=1)
+        return fin_anterior.replace(day=1), fin_anterior
+    return None
+
+PERIODOS_DASHBOARD = ('today', 'yesterday', 'week', 'last_week', 'month', 'last_month')
+
+def calcular_resumen_ventas():
+    """
+    Calcula las ventas de todos los períodos del dashboard y su comparación
+    con el período anterior
+    
+    Hace una sola consulta agrupada por día sobre ventas_diarias que cubre
+    desde el inicio del período más antiguo hasta hoy, y suma cada rango en
+    memoria (a lo sumo unas 90 filas por canal).
+    
+    Returns:
+        dict: período -> {'monto', 'pedidos', 'cambio', 'inicio', 'fin'}
+    """
+    rangos = {}
+    for periodo in PERIODOS_DASHBOARD:
+        inicio, fin = get_date_range(periodo)
+        rangos[periodo] = ((inicio, fin), rango_periodo_anterior(periodo, inicio, fin))
+    
+    fechas = [f for actual, anterior in rangos.values() for f in actual + anterior]
+    dias = db.session.query(
+        VentaDiaria.fecha,
+        func.sum(VentaDiaria.monto).label('monto'),
+        func.sum(VentaDiaria.transacciones).label('transacciones')
+    ).filter(
+        VentaDiaria.fecha >= min(fechas),
+        VentaDiaria.fecha <= max(fechas)
+    ).group_by(VentaDiaria.fecha).all()
+    
+    def sumar(inicio, fin):
+        filas = [d for d in dias if inicio <= d.fecha <= fin]
+        return {
+            'monto': round(sum(float(d.monto or 0) for d in filas), 2),
+            'pedidos': sum(int(d.transacciones or 0) for d in filas)
+        }
+    
+    resumen = {}
+    for periodo, ((inicio, fin), anterior) in rangos.items():
+        ventas = sumar(inicio, fin)
+        ventas['cambio'] = calcular_comparacion(ventas, sumar(*anterior))
+        ventas['inicio'] = inicio.isoformat()
+        ventas['fin'] = fin.isoformat()
+        resumen[periodo] = ventas
+    return resumen
+
+def obtener_resumen_ventas():
+    """Resumen de ventas del dashboard en caché hasta el próximo cambio (o cambio de día)"""
+    hoy = hoy_negocio()
+    return cache_resumen_ventas.obtener(hoy, calcular_resumen_ventas)
+
+def inicio_periodo_serie(fecha, granularidad):
+    """Primer día del período ('dia', 'semana' de lunes a domingo o 'mes') que contiene la fecha"""
+    if granularidad == 'semana':
+        return fecha - timedelta(days=fecha.weekday())
+    if granularidad == 'mes':
+        return fecha.replace(day=1)
+    return fecha
+
+def siguiente_periodo_serie(inicio, granularidad):
+    """Primer día del período siguiente"""
+    if granularidad == 'semana':
+        return inicio + timedelta(weeks=1)
+    if granularidad == 'mes':
+        return (inicio.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return inicio + timedelta(days=1)
+
+def anterior_periodo_serie(inicio, granularidad):
+    """Primer día del período anterior"""
+    if granularidad == 'semana':
+        return inicio - timedelta(weeks=1)
+    if granularidad == 'mes':
+        return (inicio - timedelta(days=1)).replace(day=1)
+    return inicio - timedelta(days=1)
+
+def serie_ventas(granularidad, cantidad, canal=None):
+    """
+    Serie de ventas de los últimos períodos, terminando en el período actual
+    
+    Lee ventas_diarias (días locales del negocio) y agrupa en Python, por lo
+    que funciona igual en MySQL y SQLite. Los períodos sin ventas se
+    devuelven en cero. Los períodos ya cerrados se guardan en caché y solo
+    se consultan los que faltan más el período en curso.
+    
+    Args:
+        granularidad (str): 'dia', 'semana' o 'mes'
+        cantidad (int): Cantidad de períodos
+        canal (str): 'pedido', 'deuda' o None para ambos
+    
+    Returns:
+        list: Diccionarios {'inicio', 'fin', 'total', 'cantidad', 'unidades'}
+    """
+    hoy = hoy_negocio()
+    inicios = [inicio_periodo_serie(hoy, granularidad)]
+    while len(inicios) < cantidad:
+        inicios.insert(0, anterior_periodo_serie(inicios[0], granularidad))
+    
+    valores = {}
+    faltantes = []
+    for inicio in inicios:
+        cerrado = siguiente_periodo_serie(inicio, granularidad) <= hoy
+        guardado = cache_buckets_ventas.leer((granularidad, canal, inicio)) if cerrado else None
+        if guardado is not None:
+            valores[inicio] = guardado
+        else:
+            faltantes.append(inicio)
+    
+    if faltantes:
+        acumulado = {inicio: {'total': 0.0, 'cantidad': 0, 'unidades': 0} for inicio in faltantes}
+        consulta = db.session.query(
+            VentaDiaria.fecha,
+            func.sum(VentaDiaria.monto).label('monto'),
+            func.sum(VentaDiaria.transacciones).label('transacciones'),
+            func.sum(VentaDiaria.unidades).label('unidades')
+        ).filter(
+            VentaDiaria.fecha >= faltantes[0],
+            VentaDiaria.fecha < siguiente_periodo_serie(faltantes[-1], granularidad)
+        )
+        if canal:
+            consulta = consulta.filter(VentaDiaria.canal == canal)
+        
+        for fila in consulta.group_by(VentaDiaria.fecha):
+            periodo = acumulado.get(inicio_periodo_serie(fila.fecha, granularidad))
+            if periodo is not None:
+                periodo['total'] += float(fila.monto or 0)
+                periodo['cantidad'] += int(fila.transacciones or 0)
+                periodo['unidades'] += int(fila.unidades or 0)
+        
+        for inicio, periodo in acumulado.items():
+            periodo['total'] = round(periodo['total'], 2)
+            valores[inicio] = periodo
+            if siguiente_periodo_serie(inicio, granularidad) <= hoy:
+                cache_buckets_ventas.guardar((granularidad, canal, inicio), periodo)
+    
+    return [dict(valores[inicio], inicio=inicio,
+                 fin=siguiente_periodo_serie(inicio, granularidad) - timedelta(days=1))
+            for inicio in inicios]
+
+# Ventanas del ranking de productos en días (None = histórico completo)
+VENTANAS_RANKING = {'7': 7, '30': 30, '90': 90, 'total': None}
+
+def calcular_estadisticas_productos(canal=None):
+    """
+    Suma unidades e ingresos por producto para todas las ventanas del
+    ranking en una sola consulta sobre ventas_producto_diarias
+    
+    Incluye productos sin categoría (outer join) y productos eliminados
+    (sin nombre en el catálogo).
+    
+    Args:
+        canal (str): 'pedido', 'deuda' o None para ambos
+    
+    Returns:
+        list: Diccionarios con producto, categoría y {ventana: {'unidades', 'monto'}}
+    """
+    hoy = hoy_negocio()
+    columnas = []
+    for clave, dias in VENTANAS_RANKING.items():
+        if dias is None:
+            unidades, monto = VentaProductoDiaria.unidades, VentaProductoDiaria.monto
+        else:
+            en_ventana = VentaProductoDiaria.fecha > hoy - timedelta(days=dias)
+            unidades = case((en_ventana, VentaProductoDiaria.unidades), else_=0)
+            monto = case((en_ventana, VentaProductoDiaria.monto), else_=0)
+        columnas += [func.sum(unidades).label(f'unidades_{clave}'), func.sum(monto).label(f'monto_{clave}')]
+    
+    ventas = db.session.query(VentaProductoDiaria.producto_id.label('producto_id'), *columnas)
+    if canal:
+        ventas = ventas.filter(VentaProductoDiaria.canal == canal)
+    ventas = ventas.group_by(VentaProductoDiaria.producto_id).subquery()
+    
+    filas = db.session.query(
+        ventas, Producto.nombre, Producto.categoria_id, Categoria.nombre.label('categoria_nombre')
+    ).outerjoin(Producto, Producto.id == ventas.c.producto_id
+    ).outerjoin(Categoria, Categoria.id == Producto.categoria_id).all()
+    
+    return [{
+        'producto_id': f.producto_id,
+        'nombre': f.nombre or f'Producto #{f.producto_id}',
+        'categoria_id': f.categoria_id,
+        'categoria_nombre': f.categoria_nombre,
+        'ventanas': {clave: {'unidades': int(getattr(f, f'unidades_{clave}') or 0),
+                             'monto': round(float(getattr(f, f'monto_{clave}') or 0), 2)}
+                     for clave in VENTANAS_RANKING}
+    } for f in filas]
+
+def ranking_productos(ventana='30', categoria=None, canal=None, orden='unidades', limite=10):
+    """
+    Productos más vendidos en una ventana de tiempo
+    
+    Las estadísticas de todas las ventanas se guardan en caché por día y
+    canal hasta la próxima venta registrada; filtrar y ordenar se hace en
+    memoria.
+    
+    Args:
+        ventana (str): '7', '30', '90' o 'total'
+        categoria: ID de categoría, 'sin_categoria' o None para todas
+        canal (str): 'pedido', 'deuda' o None para ambos
+        orden (str): 'unidades' o 'monto'
+        limite (int): Cantidad máxima de productos
+    
+    Returns:
+        list: Diccionarios {'producto_id', 'nombre', 'categoria_id', 'categoria_nombre', 'unidades', 'monto'}
+    """
+    estadisticas = cache_ranking_productos.obtener(
+        (hoy_negocio(), canal), lambda: calcular_estadisticas_productos(canal))
+    
+    ranking = []
+    for producto in estadisticas:
+        if categoria == 'sin_categoria' and producto['categoria_id'] is not None:
+            continue
+        if categoria not in (None, 'sin_categoria') and producto['categoria_id'] != categoria:
+            continue
+        valores = producto['ventanas'][ventana]
+        if valores['unidades'] <= 0 and valores['monto'] <= 0:
+            continue
+        ranking.append({
+            'producto_id': producto['producto_id'],
+            'nombre': producto['nombre'],
+            'categoria_id': producto['categoria_id'],
+            'categoria_nombre': producto['categoria_nombre'],
+            'unidades': valores['unidades'],
+            'monto': valores['monto']
+        })
+    
+    ranking.sort(key=lambda p: (p[orden], p['unidades'] if orden == 'monto' else p['monto']), reverse=True)
+    return ranking[:limite]
+
 def calcular_comparacion(periodo_actual, periodo_anterior):
     """
     Calcula el cambio porcentual entre dos períodos
@@ -449,62 +1614,1880 @@ def obtener_saldo_pendiente(deuda_id):
     
     return round(total_productos - total_pagos, 2)
 
-def insert_sample_data():
-    """Inserta datos de ejemplo en la base de datos"""
-    if Cliente.query.first() or Producto.query.first():
-        print("Datos de ejemplo ya existen, omitiendo inserción")
-        return
+def subconsultas_saldo_deuda():
+    """
+    Construye las subconsultas agregadas de cargos y pagos por deuda
     
-    # Verificar si las categorías por defecto existen
-    if not Categoria.query.first():
-        categorias_default = [
-            Categoria(nombre='General', descripcion='Productos generales'),
-            Categoria(nombre='Alimentos', descripcion='Productos alimenticios'),
-            Categoria(nombre='Bebidas', descripcion='Bebidas y refrescos'),
-            Categoria(nombre='Limpieza', descripcion='Productos de limpieza'),
-            Categoria(nombre='Cuidado Personal', descripcion='Productos de higiene personal')
-        ]
-        for categoria in categorias_default:
-            db.session.add(categoria)
-        db.session.commit()
-        print("Categorías por defecto creadas")
+    Los cargos salen de los precios guardados en ProductoDeuda. Para usarlas
+    se hace outerjoin de ambas subconsultas por deuda_id contra Deuda.
     
-    # Insertar algunos clientes
-    cliente1 = Cliente(nombre='Juan Pérez', cedula='V12345678', direccion='Calle Principal', telefono='04141234567', email='juan@example.com')
-    cliente2 = Cliente(nombre='María González', cedula='V87654321', direccion='Avenida Central', telefono='04261234567', email='maria@example.com')
-    db.session.add(cliente1)
-    db.session.add(cliente2)
-
-    categoria_alimentos = Categoria.query.filter_by(nombre='Alimentos').first()
-    categoria_bebidas = Categoria.query.filter_by(nombre='Bebidas').first()
-    categoria_limpieza = Categoria.query.filter_by(nombre='Limpieza').first()
+    Returns:
+        tuple: (cargos, pagos, expresión de saldo)
+    """
+    cargos = db.session.query(
+        ProductoDeuda.deuda_id.label('deuda_id'),
+        func.sum(ProductoDeuda.precio * ProductoDeuda.cantidad).label('total')
+    ).group_by(ProductoDeuda.deuda_id).subquery()
     
-    # Insertar algunos productos con categorías válidas
-    producto1 = Producto(nombre='Arroz', cantidad=100, precio=2.5, categoria_id=categoria_alimentos.id if categoria_alimentos else 1)
-    producto2 = Producto(nombre='Leche', cantidad=50, precio=1.8, categoria_id=categoria_bebidas.id if categoria_bebidas else 2)
-    producto3 = Producto(nombre='Jabón', cantidad=200, precio=1.2, categoria_id=categoria_limpieza.id if categoria_limpieza else 4)
-    db.session.add(producto1)
-    db.session.add(producto2)
-    db.session.add(producto3)
-
-    # Insertar un usuario administrador
-    hashed_password = generate_password_hash('admin123', method='pbkdf2:sha256', salt_length=8)
-    usuario = Usuario(username='admin', password=hashed_password, es_admin=True)
-    db.session.add(usuario)
+    pagos = db.session.query(
+        PagoParcial.deuda_id.label('deuda_id'),
+        func.sum(PagoParcial.monto_usd).label('pagado')
+    ).group_by(PagoParcial.deuda_id).subquery()
+    
+    saldo = func.coalesce(cargos.c.total, 0) - func.coalesce(pagos.c.pagado, 0)
+    return cargos, pagos, saldo
 
-    # Insertar información de empresa
-    empresa = Empresa(
-        nombre='Mi Empresa',
-        direccion='Av. Principal #123',
-        telefono='+584121234567',
-        facebook='https://facebook.com/miempresa',
-        instagram='https://instagram.com/miempresa',
+def saldos_deudas_bloqueadas(deuda_ids):
+    """
+    Calcula el saldo de varias deudas con lecturas con bloqueo (FOR UPDATE)
+    
+    En MySQL (REPEATABLE READ) una lectura normal usa la instantánea tomada en
+    la primera consulta de la transacción y no ve los pagos que otra
+    transacción confirmó mientras se esperaba el bloqueo; una lectura con
+    bloqueo siempre lee la última versión confirmada. El llamador debe haber
+    bloqueado antes las filas de Deuda.
+    
+    Args:
+        deuda_ids (list): IDs de las deudas
+    
+    Returns:
+        dict: {deuda_id: saldo}
+    """
+    if not deuda_ids:
+        return {}
+    
+    cargos = db.session.query(
+        ProductoDeuda.deuda_id,
+        func.sum(ProductoDeuda.precio * ProductoDeuda.cantidad)
+    ).filter(ProductoDeuda.deuda_id.in_(deuda_ids)
+    ).group_by(ProductoDeuda.deuda_id).with_for_update().all()
+    
+    pagos = db.session.query(
+        PagoParcial.deuda_id,
+        func.sum(PagoParcial.monto_usd)
+    ).filter(PagoParcial.deuda_id.in_(deuda_ids)
+    ).group_by(PagoParcial.deuda_id).with_for_update().all()
+    
+    saldos = {deuda_id: 0.0 for deuda_id in deuda_ids}
+    for deuda_id, total in cargos:
+        saldos[deuda_id] += float(total or 0)
+    for deuda_id, pagado in pagos:
+        saldos[deuda_id] -= float(pagado or 0)
+    return {deuda_id: round(saldo, 2) for deuda_id, saldo in saldos.items()}
+
+def asignar_pago_cliente(cliente_id, monto, descripcion, deuda_ids=None):
+    """
+    Reparte un pago entre las deudas pendientes de un cliente
+    
+    Por defecto asigna FIFO (de la deuda más antigua a la más reciente); si
+    se indican deuda_ids se respeta ese orden. Todos los PagoParcial se crean
+    con un único INSERT y las deudas saldadas pasan a 'pagada' con un único
+    UPDATE, dentro de la transacción de la sesión (el llamador hace commit).
+    
+    Args:
+        cliente_id (int): ID del cliente
+        monto (float): Monto total recibido en USD
+        descripcion (str): Descripción que se guarda en cada pago
+        deuda_ids (list): IDs de deudas a pagar, en orden (opcional)
+    
+    Returns:
+        dict: {'asignaciones': list, 'sobrante': float}
+    
+    Raises:
+        ValueError: Si el monto no es un número finito mayor a cero
+    """
+    if not math.isfinite(monto) or monto <= 0:
+        raise ValueError(f'Monto de pago no válido: {monto}')
+    
+    # Bloquear las deudas antes de leer saldos; tanto el estado como los
+    # saldos se leen con bloqueo para ver los pagos confirmados por otras
+    # transacciones aunque la sesión ya haya leído algo antes
+    query = Deuda.query.filter(Deuda.cliente_id == cliente_id, Deuda.estado == 'pendiente')
+    if deuda_ids:
+        query = query.filter(Deuda.id.in_(deuda_ids))
+    
+    pendientes = [fila.id for fila in query.with_entities(Deuda.id
+    ).order_by(Deuda.fecha.asc(), Deuda.id.asc()).with_for_update().all()]
+    if deuda_ids:
+        posicion = {deuda_id: i for i, deuda_id in enumerate(deuda_ids)}
+        pendientes.sort(key=posicion.get)
+    saldos = saldos_deudas_bloqueadas(pendientes)
+    
+    restante = round(monto, 2)
+    ahora = datetime.utcnow()
+    nuevos_pagos = []
+    saldadas = []
+    asignaciones = []
+    
+    for deuda_id in pendientes:
+        saldo_deuda = saldos[deuda_id]
+        if restante <= 0.001:
+            break
+        if saldo_deuda <= 0.001:
+            continue
+        
+        aplicado = min(restante, saldo_deuda)
+        restante = round(restante - aplicado, 2)
+        saldo_restante = round(saldo_deuda - aplicado, 2)
+        
+        nuevos_pagos.append({
+            'deuda_id': deuda_id,
+            'monto_usd': aplicado,
+            'descripcion': descripcion,
+            'fecha': ahora
+        })
+        if saldo_restante <= 0.001:
+            saldadas.append(deuda_id)
+        
+        asignaciones.append({
+            'deuda_id': deuda_id,
+            'monto': aplicado,
+            'saldo_restante': max(0, saldo_restante),
+            'saldada': saldo_restante <= 0.001
+        })
+    
+    if nuevos_pagos:
+        db.session.execute(PagoParcial.__table__.insert(), nuevos_pagos)
+        db.session.info['dashboard_modificado'] = True
+    if saldadas:
+        Deuda.query.filter(Deuda.id.in_(saldadas)).update(
+            {Deuda.estado: 'pagada'}, synchronize_session=False)
+        registrar_venta_deudas(saldadas)
+    
+    return {'asignaciones': asignaciones, 'sobrante': max(0, restante)}
+
+def obtener_estado_cuenta(cliente_id, fecha_inicio, fecha_fin):
+    """
+    Construye el libro de movimientos de un cliente para un rango de fechas
+    
+    Cargos (una línea por deuda, con los precios guardados en ProductoDeuda)
+    y pagos salen de una sola consulta UNION ALL ordenada por fecha; los
+    movimientos anteriores al rango forman el saldo inicial.
+    
+    Args:
+        cliente_id (int): ID del cliente
+        fecha_inicio (date): Primer día del estado de cuenta
+        fecha_fin (date): Último día del estado de cuenta
+    
+    Returns:
+        dict: Movimientos con saldo corrido, totales y versión del libro
+    """
+    inicio_dt = datetime.combine(fecha_inicio, time.min)
+    fin_dt = datetime.combine(fecha_fin, time.max)
+    
+    cargos = select(
+        Deuda.fecha.label('fecha'),
+        literal(0).label('orden'),
+        Deuda.id.label('deuda_id'),
+        Deuda.id.label('referencia_id'),
+        func.sum(ProductoDeuda.precio * ProductoDeuda.cantidad).label('monto'),
+        literal('').label('descripcion')
+    ).join(ProductoDeuda, ProductoDeuda.deuda_id == Deuda.id
+    ).where(Deuda.cliente_id == cliente_id, Deuda.fecha <= fin_dt
+    ).group_by(Deuda.id, Deuda.fecha)
+    
+    pagos = select(
+        PagoParcial.fecha.label('fecha'),
+        literal(1).label('orden'),
+        PagoParcial.deuda_id.label('deuda_id'),
+        PagoParcial.id.label('referencia_id'),
+        PagoParcial.monto_usd.label('monto'),
+        PagoParcial.descripcion.label('descripcion')
+    ).join(Deuda, Deuda.id == PagoParcial.deuda_id
+    ).where(Deuda.cliente_id == cliente_id, PagoParcial.fecha <= fin_dt)
+    
+    libro = union_all(cargos, pagos).subquery()
+    filas = db.session.execute(
+        select(libro).order_by(libro.c.fecha, libro.c.orden, libro.c.referencia_id)
+    ).all()
+    
+    saldo_inicial = 0.0
+    total_cargos = 0.0
+    total_abonos = 0.0
+    movimientos = []
+    version = hashlib.sha1()
+    
+    for fila in filas:
+        monto = round(float(fila.monto or 0), 2)
+        es_cargo = fila.orden == 0
+        version.update(f"{fila.orden}|{fila.referencia_id}|{monto}|{fila.fecha}".encode())
+        
+        if fila.fecha and fila.fecha < inicio_dt:
+            saldo_inicial += monto if es_cargo else -monto
+            continue
+        
+        if es_cargo:
+            total_cargos += monto
+        else:
+            total_abonos += monto
+        
+        movimientos.append({
+            'fecha': fila.fecha,
+            'tipo': 'cargo' if es_cargo else 'abono',
+            'deuda_id': fila.deuda_id,
+            'descripcion': f"Factura #{fila.deuda_id}" if es_cargo else (fila.descripcion or f"Pago factura #{fila.deuda_id}"),
+            'cargo': monto if es_cargo else 0.0,
+            'abono': 0.0 if es_cargo else monto
+        })
+    
+    # Saldo corrido a partir del saldo inicial
+    saldo_inicial = round(saldo_inicial, 2)
+    saldo = saldo_inicial
+    for mov in movimientos:
+        saldo += mov['cargo'] - mov['abono']
+        mov['saldo'] = round(saldo, 2)
+    
+    # Monto en bolívares a la tasa de la fecha de cada movimiento
+    tasas, montos_bs = historial_tasas.convertir(
+        [mov['cargo'] or mov['abono'] for mov in movimientos], [mov['fecha'] for mov in movimientos])
+    for mov, tasa, monto_bs in zip(movimientos, tasas, montos_bs):
+        mov['tasa'] = round(float(tasa), 4)
+        mov['monto_bs'] = round(float(monto_bs), 2)
+    version.update(f"tasas|{historial_tasas.version}".encode())
+    
+    return {
+        'fecha_inicio': fecha_inicio,
+        'fecha_fin': fecha_fin,
+        'saldo_inicial': saldo_inicial,
+        'movimientos': movimientos,
+        'total_cargos': round(total_cargos, 2),
+        'total_abonos': round(total_abonos, 2),
+        'saldo_final': round(saldo_inicial + total_cargos - total_abonos, 2),
+        'version': version.hexdigest()
+    }
+
+def generar_pdf_estado_cuenta(cliente, estado, empresa=None):
+    """
+    Genera el PDF de un estado de cuenta con reportlab
+    
+    Args:
+        cliente (Cliente): Cliente del estado de cuenta
+        estado (dict): Resultado de obtener_estado_cuenta
+        empresa (Empresa): Datos de la empresa para el encabezado
+    
+    Returns:
+        bytes: Contenido del PDF
+    """
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter, title=f"Estado de cuenta - {cliente.nombre}",
+                            leftMargin=40, rightMargin=40, topMargin=40, bottomMargin=40)
+    estilos = getSampleStyleSheet()
+    elementos = []
+    
+    # Paragraph interpreta su texto como marcado: los datos escritos por
+    # usuarios se escapan para que '<' o '&' no rompan el PDF
+    if empresa:
+        elementos.append(Paragraph(escape(empresa.nombre or ''), estilos['Title']))
+        elementos.append(Paragraph(
+            f"RIF: {escape(empresa.rif or '')} - {escape(empresa.direccion or '')}", estilos['Normal']))
+        elementos.append(Spacer(1, 12))
+    
+    elementos.append(Paragraph("Estado de cuenta", estilos['Heading2']))
+    elementos.append(Paragraph(
+        f"Cliente: {escape(cliente.nombre or '')} "
+        f"({escape(cliente.cedula or cliente.rif or 'Sin identificación')})", estilos['Normal']))
+    elementos.append(Paragraph(
+        f"Período: {estado['fecha_inicio'].strftime('%d/%m/%Y')} al {estado['fecha_fin'].strftime('%d/%m/%Y')}",
+        estilos['Normal']))
+    elementos.append(Spacer(1, 12))
+    
+    datos = [['Fecha', 'Descripción', 'Cargo', 'Abono', 'Saldo', 'Bs (tasa del día)'],
+             ['', 'Saldo inicial', '', '', f"${estado['saldo_inicial']:.2f}", '']]
+    for mov in estado['movimientos']:
+        datos.append([
+            mov['fecha'].strftime('%d/%m/%Y') if mov['fecha'] else '',
+            Paragraph(escape(mov['descripcion'] or ''), estilos['Normal']),
+            f"${mov['cargo']:.2f}" if mov['cargo'] else '',
+            f"${mov['abono']:.2f}" if mov['abono'] else '',
+            f"${mov['saldo']:.2f}",
+            f"Bs {mov['monto_bs']:.2f}" if mov.get('tasa') else ''
+        ])
+    datos.append(['', 'Totales', f"${estado['total_cargos']:.2f}", f"${estado['total_abonos']:.2f}",
+                  f"${estado['saldo_final']:.2f}", ''])
+    
+    tabla = Table(datos, colWidths=[62, 180, 62, 62, 76, 90], repeatRows=1)
+    tabla.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#343a40')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'),
+        ('ALIGN', (2, 0), (-1, -1), 'RIGHT'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('LINEBELOW', (0, 0), (-1, 0), 1, colors.black),
+        ('LINEABOVE', (0, -1), (-1, -1), 1, colors.black),
+        ('ROWBACKGROUNDS', (0, 1), (-1, -2), [colors.white, colors.HexColor('#f5f5f5')]),
+    ]))
+    elementos.append(tabla)
+    elementos.append(Spacer(1, 12))
+    elementos.append(Paragraph(f"Saldo a la fecha: ${estado['saldo_final']:.2f} USD", estilos['Heading3']))
+    
+    doc.build(elementos)
+    return buffer.getvalue()
+
+def obtener_pdf_estado_cuenta(cliente, fecha_inicio, fecha_fin, empresa=None):
+    """
+    Devuelve el PDF del estado de cuenta, reutilizando el de la caché si
+    el libro de movimientos no cambió desde que se generó
+    
+    Returns:
+        bytes: Contenido del PDF
+    """
+    estado = obtener_estado_cuenta(cliente.id, fecha_inicio, fecha_fin)
+    clave = (cliente.id, fecha_inicio, fecha_fin, estado['version'])
+    return cache_estados_cuenta.obtener(
+        clave, lambda: generar_pdf_estado_cuenta(cliente, estado, empresa))
+
+# Los ZIP de los lotes se guardan aquí, con el id del lote en el nombre. Con
+# varios workers o réplicas debe ser un directorio compartido (volumen)
+DIRECTORIO_ESTADOS_CUENTA = os.environ.get('DIRECTORIO_ESTADOS_CUENTA') or os.path.join(app.instance_path, 'estados_cuenta')
+# Errores por cliente que se guardan en el lote (el ZIP los lista todos)
+MAX_ERRORES_LOTE = 50
+# Un lote 'procesando' sin avances en este tiempo se da por abandonado
+# (p. ej. el worker que lo generaba se reinició)
+MINUTOS_LOTE_ABANDONADO = 15
+
+def generar_lote_estados_cuenta(lote_id):
+    """
+    Genera en un ZIP los estados de cuenta de todos los clientes con saldo
+    pendiente. Se ejecuta en el ejecutor de fondo.
+    
+    El avance se guarda en la fila del lote después de cada bloque, así
+    cualquier worker puede informarlo. Si el PDF de un cliente falla, se anota
+    en errores.txt dentro del ZIP y se continúa con los demás.
+    
+    Args:
+        lote_id (int): ID del LoteEstadosCuenta ya creado en estado 'procesando'
+    """
+    lote = db.session.get(LoteEstadosCuenta, lote_id)
+    fecha_inicio, fecha_fin = lote.fecha_inicio, lote.fecha_fin
+    
+    def actualizar_lote(**valores):
+        db.session.execute(update(LoteEstadosCuenta).where(LoteEstadosCuenta.id == lote_id).values(**valores))
+        db.session.commit()
+    
+    try:
+        cargos, pagos, saldo = subconsultas_saldo_deuda()
+        clientes_ids = [fila.cliente_id for fila in db.session.query(Deuda.cliente_id
+        ).outerjoin(cargos, cargos.c.deuda_id == Deuda.id
+        ).outerjoin(pagos, pagos.c.deuda_id == Deuda.id
+        ).filter(Deuda.estado == 'pendiente'
+        ).group_by(Deuda.cliente_id
+        ).having(func.sum(saldo) > 0.005).all()]
+        
+        actualizar_lote(total=len(clientes_ids))
+        
+        empresa = Empresa.query.first()
+        os.makedirs(DIRECTORIO_ESTADOS_CUENTA, exist_ok=True)
+        nombre = f"estados_cuenta_{lote_id}.zip"
+        ruta = os.path.join(DIRECTORIO_ESTADOS_CUENTA, nombre)
+        
+        procesados = 0
+        errores = []
+        with zipfile.ZipFile(ruta, 'w', zipfile.ZIP_DEFLATED) as archivo_zip:
+            # Procesar por bloques para no cargar todos los clientes a la vez
+            for i in range(0, len(clientes_ids), 100):
+                for cliente in Cliente.query.filter(Cliente.id.in_(clientes_ids[i:i + 100])).all():
+                    try:
+                        pdf = obtener_pdf_estado_cuenta(cliente, fecha_inicio, fecha_fin, empresa)
+                        archivo_zip.writestr(f"estado_cuenta_{cliente.id}.pdf", pdf)
+                    except Exception as e:
+                        print(f"Error al generar estado de cuenta del cliente {cliente.id}: {e}")
+                        errores.append(f"Cliente {cliente.id} ({cliente.nombre}): {e}")
+                    procesados += 1
+                db.session.expunge_all()
+                actualizar_lote(procesados=procesados, fallidos=len(errores),
+                                errores='\n'.join(errores[:MAX_ERRORES_LOTE]) or None)
+            if errores:
+                archivo_zip.writestr('errores.txt', '\n'.join(errores))
+        
+        actualizar_lote(estado='completado', archivo=nombre)
+    except Exception as e:
+        db.session.rollback()
+        actualizar_lote(estado='error', error=str(e)[:500])
+        raise
+
+def conciliar_saldos(dias_historial=30):
+    """
+    Recalcula el saldo de todas las deudas en una sola sentencia
+    INSERT ... SELECT y registra en discrepancia_saldo las que tienen un
+    estado que contradice su saldo o líneas sin precio
+    
+    El saldo usa los precios guardados en ProductoDeuda; también se guarda
+    el total a precios actuales para comparar con los cálculos antiguos.
+    
+    Args:
+        dias_historial (int): Días de ejecuciones anteriores que se conservan
+    
+    Returns:
+        int: Cantidad de discrepancias encontradas
+    """
+    ejecucion = datetime.utcnow()
+    tolerancia = 0.01
+    
+    cargos = db.session.query(
+        ProductoDeuda.deuda_id.label('deuda_id'),
+        func.sum(ProductoDeuda.precio * ProductoDeuda.cantidad).label('total'),
+        func.sum(func.coalesce(Producto.precio, 0) * ProductoDeuda.cantidad).label('total_precio_actual'),
+        func.sum(case((ProductoDeuda.precio <= 0, 1), else_=0)).label('lineas_sin_precio')
+    ).outerjoin(Producto, Producto.id == ProductoDeuda.producto_id
+    ).group_by(ProductoDeuda.deuda_id).subquery()
+    
+    pagos = db.session.query(
+        PagoParcial.deuda_id.label('deuda_id'),
+        func.sum(PagoParcial.monto_usd).label('pagado')
+    ).group_by(PagoParcial.deuda_id).subquery()
+    
+    total_cargos = func.coalesce(cargos.c.total, 0)
+    total_pagado = func.coalesce(pagos.c.pagado, 0)
+    saldo = total_cargos - total_pagado
+    
+    tipo = case(
+        (saldo < -tolerancia, 'sobrepago'),
+        (and_(Deuda.estado == 'pagada', saldo > tolerancia), 'pagada_con_saldo'),
+        (and_(Deuda.estado == 'pendiente', saldo <= tolerancia), 'pendiente_saldada'),
+        (func.coalesce(cargos.c.lineas_sin_precio, 0) > 0, 'lineas_sin_precio'),
+        else_=None
+    )
+    
+    seleccion = select(
+        literal(ejecucion).label('ejecucion'),
+        Deuda.id,
+        Deuda.cliente_id,
+        Deuda.estado,
+        total_cargos,
+        func.coalesce(cargos.c.total_precio_actual, 0),
+        total_pagado,
+        saldo,
+        tipo
+    ).select_from(Deuda
+    ).outerjoin(cargos, cargos.c.deuda_id == Deuda.id
+    ).outerjoin(pagos, pagos.c.deuda_id == Deuda.id
+    ).where(tipo.is_not(None))
+    
+    tabla = DiscrepanciaSaldo.__table__
+    columnas = [tabla.c.ejecucion, tabla.c.deuda_id, tabla.c.cliente_id, tabla.c.estado,
+                tabla.c.total_cargos, tabla.c.total_precio_actual, tabla.c.total_pagado,
+                tabla.c.saldo, tabla.c.tipo]
+    
+    try:
+        resultado = db.session.execute(tabla.insert().from_select(columnas, seleccion))
+        db.session.execute(tabla.delete().where(
+            tabla.c.ejecucion < ejecucion - timedelta(days=dias_historial)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    
+    print(f"Conciliación de saldos: {resultado.rowcount} discrepancias")
+    return resultado.rowcount
+
+# Parámetros del cálculo de reposición
+TIEMPO_ENTREGA_DIAS = int(os.environ.get('TIEMPO_ENTREGA_DIAS', 7))
+DIAS_REVISION_INVENTARIO = int(os.environ.get('DIAS_REVISION_INVENTARIO', 14))
+FACTOR_SEGURIDAD = 1.65  # Nivel de servicio de ~95%
+DIAS_HISTORIAL_VENTAS = 90
+
+def unidades_diarias_por_producto(producto_ids, hoy):
+    """
+    Construye la matriz de unidades vendidas por producto y día local
+    
+    El inventario se descuenta al registrar una deuda o al hacer un pedido,
+    y un pedido completado se convierte en deuda con las mismas líneas. Para
+    no contar dos veces se suman todas las líneas de deudas más las líneas
+    de pedidos que aún no se completan ni se cancelan.
+    
+    Args:
+        producto_ids (list): IDs de producto (orden de las filas)
+        hoy (date): Último día de la matriz
+    
+    Returns:
+        numpy.ndarray: Matriz (productos x DIAS_HISTORIAL_VENTAS)
+    """
+    inicio = hoy - timedelta(days=DIAS_HISTORIAL_VENTAS - 1)
+    desde = inicio_dia_utc(inicio)
+    
+    lineas_deuda = db.session.query(
+        ProductoDeuda.producto_id, Deuda.fecha, ProductoDeuda.cantidad
+    ).join(Deuda, Deuda.id == ProductoDeuda.deuda_id
+    ).filter(Deuda.fecha >= desde)
+    
+    lineas_pedido = db.session.query(
+        ItemPedido.producto_id, Pedido.fecha, ItemPedido.cantidad
+    ).join(Pedido, Pedido.id == ItemPedido.pedido_id
+    ).filter(
+        Pedido.fecha >= desde,
+        Pedido.estado.in_(['pendiente', 'procesando']),
+        or_(ItemPedido.es_personalizado.is_(None), ItemPedido.es_personalizado.is_(False))
+    )
+    
+    indice = {producto_id: i for i, producto_id in enumerate(producto_ids)}
+    filas, dias, cantidades = [], [], []
+    for consulta in (lineas_deuda, lineas_pedido):
+        for producto_id, fecha, cantidad in consulta.yield_per(2000):
+            fila = indice.get(producto_id)
+            if fila is None or not cantidad:
+                continue
+            filas.append(fila)
+            dias.append((fecha_negocio(fecha) - inicio).days)
+            cantidades.append(cantidad)
+    
+    ventas = np.zeros((len(producto_ids), DIAS_HISTORIAL_VENTAS))
+    if filas:
+        dias = np.array(dias)
+        validos = (dias >= 0) & (dias < DIAS_HISTORIAL_VENTAS)
+        np.add.at(ventas, (np.array(filas)[validos], dias[validos]), np.array(cantidades, dtype=float)[validos])
+    return ventas
+
+def calcular_sugerencias_reposicion():
+    """
+    Calcula promedios móviles de venta, días de cobertura y punto de
+    reorden de todos los productos y reemplaza la tabla sugerencia_reposicion
+    
+    - Velocidad: promedio móvil de 30 días (unidades por día)
+    - Stock de seguridad: FACTOR_SEGURIDAD x desviación diaria x raíz del tiempo de entrega
+    - Punto de reorden: velocidad x tiempo de entrega + stock de seguridad
+    - Cantidad sugerida: lo necesario para cubrir entrega + revisión + seguridad
+    
+    Returns:
+        int: Cantidad de productos que conviene reordenar (incluye agotados)
+    """
+    calculado = datetime.utcnow()
+    productos = db.session.query(Producto.id, Producto.cantidad).order_by(Producto.id).all()
+    if not productos:
+        return 0
+    
+    producto_ids = [p.id for p in productos]
+    stock = np.array([p.cantidad or 0 for p in productos], dtype=float)
+    ventas = unidades_diarias_por_producto(producto_ids, hoy_negocio())
+    
+    promedio_7 = ventas[:, -7:].mean(axis=1)
+    promedio_30 = ventas[:, -30:].mean(axis=1)
+    promedio_90 = ventas.mean(axis=1)
+    velocidad = promedio_30
+    desviacion = ventas[:, -30:].std(axis=1)
+    
+    con_ventas = velocidad > 0
+    dias_cobertura = np.divide(stock, velocidad, out=np.full_like(stock, np.nan), where=con_ventas)
+    stock_seguridad = FACTOR_SEGURIDAD * desviacion * np.sqrt(TIEMPO_ENTREGA_DIAS)
+    punto_reorden = velocidad * TIEMPO_ENTREGA_DIAS + stock_seguridad
+    objetivo = velocidad * (TIEMPO_ENTREGA_DIAS + DIAS_REVISION_INVENTARIO) + stock_seguridad
+    reordenar = con_ventas & (stock <= punto_reorden)
+    cantidad_sugerida = np.where(reordenar, np.ceil(np.maximum(objetivo - stock, 0)), 0)
+    
+    estado = np.where(~con_ventas, 'sin_movimiento',
+                      np.where(stock <= 0, 'agotado',
+                               np.where(reordenar, 'reordenar', 'ok')))
+    
+    filas = [{
+        'producto_id': producto_ids[i],
+        'calculado': calculado,
+        'stock': int(stock[i]),
+        'promedio_7': round(float(promedio_7[i]), 3),
+        'promedio_30': round(float(promedio_30[i]), 3),
+        'promedio_90': round(float(promedio_90[i]), 3),
+        'dias_cobertura': None if np.isnan(dias_cobertura[i]) else round(float(dias_cobertura[i]), 1),
+        'punto_reorden': round(float(punto_reorden[i]), 2),
+        'cantidad_sugerida': int(cantidad_sugerida[i]),
+        'estado': str(estado[i])
+    } for i in range(len(producto_ids))]
+    
+    tabla = SugerenciaReposicion.__table__
+    try:
+        db.session.execute(tabla.delete())
+        db.session.execute(tabla.insert(), filas)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    
+    por_reordenar = int(np.count_nonzero(reordenar))
+    print(f"Sugerencias de reposición calculadas: {len(filas)} productos, {por_reordenar} por reordenar")
+    return por_reordenar
+
+def calcular_antiguedad_deudas():
+    """
+    Calcula la antigüedad de saldos por cobrar (corriente, 30, 60 y 90+ días)
+    por cliente, en una sola consulta agregada sobre las deudas pendientes
+    
+    El saldo de cada deuda se obtiene de los precios guardados en
+    ProductoDeuda menos los pagos parciales registrados.
+    
+    Returns:
+        dict: {'clientes': list, 'totales': dict, 'generado': datetime}
+    """
+    ahora = datetime.utcnow()
+    corte_30 = ahora - timedelta(days=30)
+    corte_60 = ahora - timedelta(days=60)
+    corte_90 = ahora - timedelta(days=90)
+    
+    cargos, pagos, saldo = subconsultas_saldo_deuda()
+    
+    def tramo(condicion):
+        return func.sum(case((condicion, saldo), else_=0))
+    
+    filas = db.session.query(
+        Cliente.id,
+        Cliente.nombre,
+        Cliente.cedula,
+        tramo(or_(Deuda.fecha >= corte_30, Deuda.fecha.is_(None))).label('corriente'),
+        tramo(and_(Deuda.fecha < corte_30, Deuda.fecha >= corte_60)).label('dias_30'),
+        tramo(and_(Deuda.fecha < corte_60, Deuda.fecha >= corte_90)).label('dias_60'),
+        tramo(Deuda.fecha < corte_90).label('dias_90'),
+        func.sum(saldo).label('total'),
+        func.count(Deuda.id).label('deudas')
+    ).join(Deuda, Deuda.cliente_id == Cliente.id
+    ).outerjoin(cargos, cargos.c.deuda_id == Deuda.id
+    ).outerjoin(pagos, pagos.c.deuda_id == Deuda.id
+    ).filter(Deuda.estado == 'pendiente', saldo > 0.005
+    ).group_by(Cliente.id, Cliente.nombre, Cliente.cedula
+    ).order_by(func.sum(saldo).desc()).all()
+    
+    tramos = ('corriente', 'dias_30', 'dias_60', 'dias_90', 'total')
+    clientes = []
+    totales = dict.fromkeys(tramos, 0.0)
+    totales['deudas'] = 0
+    
+    for fila in filas:
+        cliente = {
+            'id': fila.id,
+            'nombre': fila.nombre,
+            'cedula': fila.cedula,
+            'deudas': fila.deudas
+        }
+        for tramo_nombre in tramos:
+            cliente[tramo_nombre] = round(float(getattr(fila, tramo_nombre) or 0), 2)
+            totales[tramo_nombre] += cliente[tramo_nombre]
+        totales['deudas'] += fila.deudas
+        clientes.append(cliente)
+    
+    totales = {k: round(v, 2) if isinstance(v, float) else v for k, v in totales.items()}
+    return {'clientes': clientes, 'totales': totales, 'generado': ahora}
+
+def consultar_deudas_cliente_publico(nombre):
+    """
+    Arma el estado de cuenta público de un cliente buscado por nombre
+    
+    Usa el índice de Cliente.nombre y carga líneas, productos y pagos con
+    selectinload; los montos salen de los precios guardados en ProductoDeuda.
+    El resultado solo contiene tipos simples para poder guardarse en caché.
+    
+    Args:
+        nombre (str): Nombre exacto del cliente
+    
+    Returns:
+        dict: cliente, deudas_pendientes, deudas_pagadas y total_pendiente
+    """
+    cliente = Cliente.query.filter(Cliente.nombre == nombre).first()
+    if not cliente:
+        return {'cliente': None}
+    
+    deudas = Deuda.query.filter_by(cliente_id=cliente.id).options(
+        db.selectinload(Deuda.productos).joinedload(ProductoDeuda.producto),
+        db.selectinload(Deuda.pagos)
+    ).order_by(Deuda.fecha.desc(), Deuda.id.desc()).all()
+    
+    deudas_pendientes = []
+    deudas_pagadas = []
+    total_pendiente = 0.0
+    
+    for deuda in deudas:
+        productos_deuda = []
+        total = 0.0
+        for pd in deuda.productos:
+            subtotal = pd.precio * pd.cantidad
+            total += subtotal
+            productos_deuda.append({
+                'producto': {'nombre': pd.nombre or (pd.producto.nombre if pd.producto else 'Producto eliminado')},
+                'cantidad': pd.cantidad,
+                'precio': pd.precio,
+                'subtotal': subtotal
+            })
+        
+        # Calcular saldo pendiente
+        saldo_pendiente = total
+        pagos_parciales = []
+        for pago in deuda.pagos:
+            saldo_pendiente -= pago.monto_usd
+            pagos_parciales.append({
+                'fecha': pago.fecha,
+                'monto_usd': pago.monto_usd,
+                'descripcion': pago.descripcion
+            })
+        
+        deuda_info = {
+            'id': deuda.id,
+            'fecha': deuda.fecha,
+            'estado': deuda.estado,
+            'productos': productos_deuda,
+            'pagos_parciales': pagos_parciales,
+            'total': total,
+            'saldo_pendiente': saldo_pendiente
+        }
+        
+        # Separar deudas en pendientes y pagadas
+        if deuda.estado == 'pendiente':
+            total_pendiente += saldo_pendiente
+            deudas_pendientes.append(deuda_info)
+        elif deuda.estado == 'pagada':
+            deudas_pagadas.append(deuda_info)
+    
+    return {
+        'cliente': {'id': cliente.id, 'nombre': cliente.nombre, 'cedula': cliente.cedula},
+        'deudas_pendientes': deudas_pendientes,
+        'deudas_pagadas': deudas_pagadas,
+        'total_pendiente': total_pendiente
+    }
+
+def desglosar_deuda(deuda):
+    """
+    Calcula en una sola pasada el desglose de IVA y el saldo de una deuda
+    
+    Los precios guardados en ProductoDeuda incluyen IVA; se usan en lugar
+    del precio actual del producto. Requiere que productos y pagos estén
+    cargados (selectinload) para no generar consultas por línea.
+    
+    Args:
+        deuda (Deuda): Deuda con sus productos y pagos
+    
+    Returns:
+        dict: Líneas sin IVA, pagos, subtotal, IVA, total y saldo
+    """
+    productos_deuda = []
+    total_con_iva = 0.0
+    for pd in deuda.productos:
+        precio_sin_iva = pd.precio / (1 + TASA_IVA)
+        total_con_iva += pd.precio * pd.cantidad
+        productos_deuda.append({
+            'producto': pd.producto,
+            'nombre': pd.nombre or (pd.producto.nombre if pd.producto else 'Producto eliminado'),
+            'cantidad': pd.cantidad,
+            'precio_sin_iva': precio_sin_iva,
+            'subtotal_sin_iva': precio_sin_iva * pd.cantidad
+        })
+    
+    subtotal_sin_iva = total_con_iva / (1 + TASA_IVA)
+    
+    total_pagado = 0.0
+    pagos_parciales = []
+    for pago in deuda.pagos:
+        total_pagado += pago.monto_usd
+        pagos_parciales.append({
+            'fecha': pago.fecha,
+            'monto_usd': pago.monto_usd,
+            'descripcion': pago.descripcion
+        })
+    
+    return {
+        'id': deuda.id,
+        'fecha': deuda.fecha,
+        'estado': deuda.estado,
+        'productos': productos_deuda,
+        'pagos_parciales': pagos_parciales,
+        'subtotal_sin_iva': subtotal_sin_iva,
+        'iva': total_con_iva - subtotal_sin_iva,
+        'total_con_iva': total_con_iva,
+        'total_pagado': total_pagado,
+        'saldo_pendiente': total_con_iva - total_pagado
+    }
+
+def insertar_o_actualizar(tabla, filas, claves, sumar=(), reemplazar=()):
+    """
+    Inserta filas o, si la clave ya existe, actualiza la fila existente
+    
+    Usa INSERT ... ON DUPLICATE KEY UPDATE en MySQL y ON CONFLICT en SQLite;
+    en otros motores actualiza y, si no existe, inserta fila por fila.
+    
+    Args:
+        tabla (Table): Tabla destino
+        filas (list): Diccionarios columna -> valor
+        claves (list): Columnas de la clave única
+        sumar (list): Columnas que se suman al valor existente
+        reemplazar (list): Columnas que se sobrescriben con el valor nuevo
+    """
+    if not filas:
+        return
+    
+    dialecto = db.session.get_bind().dialect.name
+    
+    def valores_actualizados(nuevos):
+        valores = {c: tabla.c[c] + nuevos[c] for c in sumar}
+        valores.update({c: nuevos[c] for c in reemplazar})
+        return valores
+    
+    if dialecto == 'mysql':
+        from sqlalchemy.dialects.mysql import insert as insert_mysql
+        sentencia = insert_mysql(tabla)
+        sentencia = sentencia.on_duplicate_key_update(**valores_actualizados(sentencia.inserted))
+        db.session.execute(sentencia, filas)
+    elif dialecto == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+        sentencia = insert_sqlite(tabla)
+        sentencia = sentencia.on_conflict_do_update(
+            index_elements=list(claves), set_=valores_actualizados(sentencia.excluded))
+        db.session.execute(sentencia, filas)
+    else:
+        for fila in filas:
+            condicion = and_(*[tabla.c[c] == fila[c] for c in claves])
+            valores = {c: tabla.c[c] + fila[c] for c in sumar}
+            valores.update({c: fila[c] for c in reemplazar})
+            if db.session.execute(tabla.update().where(condicion).values(**valores)).rowcount == 0:
+                db.session.execute(tabla.insert().values(**fila))
+
+def acumular_ventas_diarias(movimientos):
+    """
+    Suma movimientos de venta al acumulado diario dentro de la transacción
+    actual (el llamador hace commit junto con el cambio que los origina)
+    
+    Las fechas-hora UTC se asignan al día local del negocio.
+    
+    Args:
+        movimientos (iterable): Tuplas (fecha, canal, monto, transacciones, unidades)
+    """
+    acumulado = {}
+    for fecha, canal, monto, transacciones, unidades in movimientos:
+        clave = (fecha if isinstance(fecha, date) and not isinstance(fecha, datetime) else fecha_negocio(fecha), canal)
+        actual = acumulado.get(clave, (0.0, 0, 0))
+        acumulado[clave] = (actual[0] + (monto or 0), actual[1] + transacciones, actual[2] + (unidades or 0))
+    
+    filas = [{'fecha': fecha, 'canal': canal, 'monto': round(monto, 2),
+              'transacciones': transacciones, 'unidades': unidades}
+             for (fecha, canal), (monto, transacciones, unidades) in acumulado.items()]
+    insertar_o_actualizar(VentaDiaria.__table__, filas, claves=('fecha', 'canal'),
+                          sumar=('monto', 'transacciones', 'unidades'))
+    db.session.info['ventas_modificadas'] = True
+
+def acumular_ventas_producto(movimientos):
+    """
+    Suma movimientos de venta por producto al acumulado diario dentro de la
+    transacción actual
+    
+    Args:
+        movimientos (iterable): Tuplas (fecha, producto_id, canal, unidades, monto)
+    """
+    acumulado = {}
+    for fecha, producto_id, canal, unidades, monto in movimientos:
+        if producto_id is None:
+            continue
+        clave = (fecha_negocio(fecha), producto_id, canal)
+        actual = acumulado.get(clave, (0, 0.0))
+        acumulado[clave] = (actual[0] + (unidades or 0), actual[1] + (monto or 0))
+    
+    filas = [{'fecha': fecha, 'producto_id': producto_id, 'canal': canal,
+              'unidades': unidades, 'monto': round(monto, 2)}
+             for (fecha, producto_id, canal), (unidades, monto) in acumulado.items()]
+    insertar_o_actualizar(VentaProductoDiaria.__table__, filas, claves=('fecha', 'producto_id', 'canal'),
+                          sumar=('unidades', 'monto'))
+    db.session.info['ventas_modificadas'] = True
+
+# Marca de sesión -> cachés que se descartan al confirmar la transacción
+CACHES_POR_MARCA = {
+    'ventas_modificadas': (cache_resumen_ventas, cache_buckets_ventas, cache_ranking_productos),
+    'dashboard_modificado': (cache_dashboard,),
+    'datos_globales_modificados': (datos_globales,),
+    'usuarios_modificados': (version_usuarios,),
+}
+
+@event.listens_for(db.session, 'after_flush')
+def marcar_cambios_dashboard(sesion, contexto):
+    """Marca la sesión si se escribieron modelos que muestra el dashboard"""
+    modelos = (Producto, Cliente, Deuda, ProductoDeuda, PagoParcial, Pedido, ItemPedido)
+    for objeto in list(sesion.new) + list(sesion.dirty) + list(sesion.deleted):
+        if isinstance(objeto, modelos):
+            sesion.info['dashboard_modificado'] = True
+            return
+
+@event.listens_for(db.session, 'after_commit')
+def invalidar_caches_confirmadas(sesion):
+    """Descarta las cachés afectadas por la transacción recién confirmada"""
+    for marca, caches in CACHES_POR_MARCA.items():
+        if sesion.info.pop(marca, False):
+            for cache in caches:
+                cache.invalidar()
+
+@event.listens_for(db.session, 'after_rollback')
+def descartar_marcas_cache(sesion):
+    """Olvida las marcas de cambios si la transacción se revierte"""
+    for marca in CACHES_POR_MARCA:
+        sesion.info.pop(marca, None)
+
+def registrar_venta_pedido(pedido, estado_anterior):
+    """
+    Actualiza los acumulados diarios (total y por producto) cuando un pedido
+    entra o sale del estado 'completado'
+    
+    Args:
+        pedido (Pedido): Pedido con su nuevo estado
+        estado_anterior (str): Estado antes del cambio
+    """
+    if (estado_anterior == 'completado') == (pedido.estado == 'completado'):
+        return
+    signo = 1 if pedido.estado == 'completado' else -1
+    lineas = db.session.query(
+        ItemPedido.producto_id,
+        func.coalesce(func.sum(ItemPedido.cantidad), 0).label('unidades'),
+        func.coalesce(func.sum(ItemPedido.precio * ItemPedido.cantidad), 0).label('monto')
+    ).filter(ItemPedido.pedido_id == pedido.id).group_by(ItemPedido.producto_id).all()
+    
+    unidades = sum(int(l.unidades) for l in lineas)
+    acumular_ventas_diarias([(pedido.fecha, 'pedido', signo * (pedido.total or 0), signo, signo * unidades)])
+    acumular_ventas_producto([(pedido.fecha, l.producto_id, 'pedido', signo * int(l.unidades), signo * float(l.monto))
+                              for l in lineas])
+
+def registrar_cambio_lineas_pedido(pedido, total_anterior, producto_id, unidades=0, monto=0.0):
+    """
+    Ajusta los acumulados diarios cuando se editan las líneas de un pedido
+    que ya está completado (el pedido sigue contando como una transacción)
+    
+    Args:
+        pedido (Pedido): Pedido con su total ya recalculado
+        total_anterior (float): Total del pedido antes del cambio
+        producto_id (int): Producto de la línea modificada
+        unidades (int): Diferencia de unidades de la línea
+        monto (float): Diferencia de monto (precio * cantidad) de la línea
+    """
+    if pedido.estado != 'completado':
+        return
+    acumular_ventas_diarias([(pedido.fecha, 'pedido', (pedido.total or 0) - (total_anterior or 0), 0, unidades)])
+    acumular_ventas_producto([(pedido.fecha, producto_id, 'pedido', unidades, monto)])
+
+def registrar_venta_deudas(deuda_ids, signo=1):
+    """
+    Actualiza los acumulados diarios (total y por producto) cuando deudas
+    pasan a 'pagada' (signo 1) o se elimina una deuda pagada (signo -1)
+    
+    Args:
+        deuda_ids (list): IDs de las deudas
+        signo (int): 1 para sumar, -1 para restar
+    """
+    if not deuda_ids:
+        return
+    filas = db.session.query(
+        Deuda.id,
+        Deuda.fecha,
+        ProductoDeuda.producto_id,
+        func.coalesce(func.sum(ProductoDeuda.precio * ProductoDeuda.cantidad), 0).label('monto'),
+        func.coalesce(func.sum(ProductoDeuda.cantidad), 0).label('unidades')
+    ).outerjoin(ProductoDeuda, ProductoDeuda.deuda_id == Deuda.id
+    ).filter(Deuda.id.in_(deuda_ids)
+    ).group_by(Deuda.id, Deuda.fecha, ProductoDeuda.producto_id).all()
+    
+    por_deuda = {}
+    for f in filas:
+        fecha, monto, unidades = por_deuda.get(f.id, (f.fecha, 0.0, 0))
+        por_deuda[f.id] = (fecha, monto + float(f.monto), unidades + int(f.unidades))
+    
+    acumular_ventas_diarias([(fecha, 'deuda', signo * monto, signo, signo * unidades)
+                             for fecha, monto, unidades in por_deuda.values()])
+    acumular_ventas_producto([(f.fecha, f.producto_id, 'deuda', signo * int(f.unidades), signo * float(f.monto))
+                              for f in filas])
+
+def dias_con_ventas():
+    """
+    Días locales con ventas en el historial o con filas en los acumulados
+    
+    Solo se leen las fechas, por lotes; el conjunto resultante tiene una
+    entrada por día.
+    
+    Returns:
+        list: Fechas ordenadas
+    """
+    dias = set()
+    fechas_historial = (
+        db.session.query(Pedido.fecha).filter(Pedido.estado == 'completado', Pedido.fecha.is_not(None)),
+        db.session.query(Deuda.fecha).filter(Deuda.estado == 'pagada', Deuda.fecha.is_not(None))
+    )
+    for consulta in fechas_historial:
+        dias.update(fecha_negocio(fecha) for (fecha,) in consulta.yield_per(1000))
+    dias.update(fecha for (fecha,) in db.session.query(VentaDiaria.fecha).distinct())
+    dias.update(fecha for (fecha,) in db.session.query(VentaProductoDiaria.fecha).distinct())
+    return sorted(dias)
+
+def reconstruir_ventas_dia(dia):
+    """
+    Recalcula los acumulados de un día local en su propia transacción
+    
+    Primero bloquea las filas del día (SELECT ... FOR UPDATE): una venta
+    concurrente que ya las tocó termina antes y queda incluida en el recálculo,
+    y una posterior espera y suma su incremento sobre el valor recalculado.
+    Las filas se reescriben con upsert y solo se borran las claves del día que
+    ya no tienen ventas.
+    
+    Args:
+        dia (date): Día local del negocio
+    
+    Returns:
+        int: Cantidad de filas (día, canal) del día
+    """
+    desde, hasta = inicio_dia_utc(dia), inicio_dia_utc(dia + timedelta(days=1))
+    
+    canales_existentes = {canal for (canal,) in db.session.query(VentaDiaria.canal).filter(
+        VentaDiaria.fecha == dia).with_for_update()}
+    productos_existentes = set(db.session.query(VentaProductoDiaria.producto_id, VentaProductoDiaria.canal).filter(
+        VentaProductoDiaria.fecha == dia).with_for_update())
+    
+    en_dia_pedido = and_(Pedido.estado == 'completado', Pedido.fecha >= desde, Pedido.fecha < hasta)
+    en_dia_deuda = and_(Deuda.estado == 'pagada', Deuda.fecha >= desde, Deuda.fecha < hasta)
+    
+    # Totales por canal; las unidades se suman aparte para no repetir montos en el join
+    pedidos = db.session.query(func.count(Pedido.id), func.coalesce(func.sum(Pedido.total), 0)).filter(en_dia_pedido).one()
+    deudas = db.session.query(func.count(Deuda.id)).filter(en_dia_deuda).scalar()
+    
+    lineas_pedido = db.session.query(
+        ItemPedido.producto_id,
+        func.coalesce(func.sum(ItemPedido.cantidad), 0),
+        func.coalesce(func.sum(ItemPedido.precio * ItemPedido.cantidad), 0)
+    ).join(Pedido, Pedido.id == ItemPedido.pedido_id).filter(en_dia_pedido).group_by(ItemPedido.producto_id)
+    
+    lineas_deuda = db.session.query(
+        ProductoDeuda.producto_id,
+        func.coalesce(func.sum(ProductoDeuda.cantidad), 0),
+        func.coalesce(func.sum(ProductoDeuda.precio * ProductoDeuda.cantidad), 0)
+    ).join(Deuda, Deuda.id == ProductoDeuda.deuda_id).filter(en_dia_deuda).group_by(ProductoDeuda.producto_id)
+    
+    totales = {'pedido': [float(pedidos[1] or 0), int(pedidos[0] or 0), 0],
+               'deuda': [0.0, int(deudas or 0), 0]}
+    filas_producto = []
+    for canal, lineas in (('pedido', lineas_pedido), ('deuda', lineas_deuda)):
+        for producto_id, unidades, monto in lineas.yield_per(1000):
+            totales[canal][2] += int(unidades or 0)
+            if canal == 'deuda':
+                totales[canal][0] += float(monto or 0)
+            if producto_id is not None:
+                filas_producto.append({'fecha': dia, 'producto_id': producto_id, 'canal': canal,
+                                       'unidades': int(unidades or 0), 'monto': round(float(monto or 0), 2)})
+    
+    filas = [{'fecha': dia, 'canal': canal, 'monto': round(monto, 2),
+              'transacciones': transacciones, 'unidades': unidades}
+             for canal, (monto, transacciones, unidades) in totales.items() if transacciones]
+    
+    insertar_o_actualizar(VentaDiaria.__table__, filas, claves=('fecha', 'canal'),
+                          reemplazar=('monto', 'transacciones', 'unidades'))
+    insertar_o_actualizar(VentaProductoDiaria.__table__, filas_producto, claves=('fecha', 'producto_id', 'canal'),
+                          reemplazar=('unidades', 'monto'))
+    
+    for canal in canales_existentes - {f['canal'] for f in filas}:
+        db.session.execute(VentaDiaria.__table__.delete().where(
+            VentaDiaria.fecha == dia, VentaDiaria.canal == canal))
+    sobrantes = productos_existentes - {(f['producto_id'], f['canal']) for f in filas_producto}
+    for canal in {canal for _, canal in sobrantes}:
+        db.session.execute(VentaProductoDiaria.__table__.delete().where(
+            VentaProductoDiaria.fecha == dia, VentaProductoDiaria.canal == canal,
+            VentaProductoDiaria.producto_id.in_([p for p, c in sobrantes if c == canal])))
+    
+    db.session.info['ventas_modificadas'] = True
+    return len(filas)
+
+def reconstruir_ventas_diarias():
+    """
+    Reconstruye ventas_diarias y ventas_producto_diarias desde el historial
+    de pedidos completados y deudas pagadas
+    
+    Cada día se recalcula y confirma por separado (ver reconstruir_ventas_dia),
+    de modo que las ventas registradas mientras corre no se pierden y los
+    bloqueos duran lo que tarda un día.
+    
+    Returns:
+        int: Cantidad de filas (día, canal) generadas en ventas_diarias
+    """
+    total = 0
+    for dia in dias_con_ventas():
+        try:
+            total += reconstruir_ventas_dia(dia)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    
+    print(f"Ventas diarias reconstruidas: {total} filas")
+    return total
+
+def codificar_cursor(fecha, registro_id):
+    """
+    Codifica la posición (fecha, id) del último registro de una página
+    para la paginación por cursor
+    """
+    return f"{fecha.isoformat()}_{registro_id}"
+
+def decodificar_cursor(cursor):
+    """
+    Decodifica un cursor generado por codificar_cursor
+    
+    Args:
+        cursor (str): Cursor recibido en la petición
+    
+    Returns:
+        tuple: (fecha, id) o None si el cursor no es válido
+    """
+    try:
+        fecha_str, id_str = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(fecha_str), int(id_str)
+    except (AttributeError, ValueError):
+        return None
+
+def codificar_cursor_nombre(nombre, registro_id):
+    """
+    Codifica la posición (nombre, id) del último registro de una página
+    para la paginación por cursor en orden alfabético
+    """
+    return f"{nombre}_{registro_id}"
+
+def decodificar_cursor_nombre(cursor):
+    """
+    Decodifica un cursor generado por codificar_cursor_nombre
+    
+    Returns:
+        tuple: (nombre, id) o None si el cursor no es válido
+    """
+    try:
+        nombre, id_str = cursor.rsplit('_', 1)
+        return nombre, int(id_str)
+    except (AttributeError, ValueError):
+        return None
+
+def patron_prefijo(texto):
+    """
+    Patrón LIKE 'texto%' con los comodines del texto escapados (usar con
+    escape='\\'). Un prefijo se resuelve como rango sobre el índice de la
+    columna; un comodín inicial obliga a recorrer la tabla.
+    """
+    return texto.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def buscar_clientes(texto='', cursor=None, limite=25):
+    """
+    Busca clientes por prefijo de nombre, cédula, RIF o teléfono
+    
+    Cada criterio es un rango sobre su índice (LIKE 'texto%'). Los resultados
+    se ordenan por (nombre, id) y se paginan por cursor, sin OFFSET.
+    
+    Args:
+        texto (str): Texto buscado; vacío lista todos los clientes
+        cursor (str): Posición devuelta por la página anterior
+        limite (int): Clientes por página
+    
+    Returns:
+        tuple: (lista de diccionarios de clientes, cursor siguiente o None)
+    """
+    consulta = db.session.query(Cliente.id, Cliente.nombre, Cliente.cedula, Cliente.rif,
+                                Cliente.telefono, Cliente.email, Cliente.direccion)
+    
+    texto = (texto or '').strip()
+    if texto:
+        patron = patron_prefijo(texto)
+        consulta = consulta.filter(or_(
+            Cliente.nombre.like(patron, escape='\\'),
+            Cliente.cedula.like(patron, escape='\\'),
+            Cliente.rif.like(patron, escape='\\'),
+            Cliente.telefono.like(patron, escape='\\')
+        ))
+    
+    posicion = decodificar_cursor_nombre(cursor) if cursor else None
+    if posicion:
+        nombre_cursor, id_cursor = posicion
+        consulta = consulta.filter(or_(
+            Cliente.nombre > nombre_cursor,
+            and_(Cliente.nombre == nombre_cursor, Cliente.id > id_cursor)
+        ))
+    
+    filas = consulta.order_by(Cliente.nombre, Cliente.id).limit(limite + 1).all()
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = codificar_cursor_nombre(filas[-1].nombre, filas[-1].id)
+    
+    return [dict(fila._mapping) for fila in filas], siguiente
+
+PREFIJOS_IDENTIFICACION = ('V', 'E', 'J', 'G', 'P')
+
+def normalizar_identificacion(valor):
+    """
+    Normaliza una cédula o RIF: mayúsculas, sin espacios, puntos ni guiones
+    
+    Args:
+        valor (str): Identificación tal como se escribió (p. ej. 'v-12.345.678')
+    
+    Returns:
+        str: Identificación normalizada (p. ej. 'V12345678') o None si no
+             tiene un prefijo válido (V, E, J, G, P) seguido de dígitos
+    """
+    if not valor:
+        return None
+    valor = re.sub(r'[\s.\-]', '', valor).upper()
+    if len(valor) > 1 and valor[0] in PREFIJOS_IDENTIFICACION and valor[1:].isdigit():
+        return valor
+    return None
+
+def buscar_cliente_por_identificacion(identificacion, usar_cache=True):
+    """
+    Busca un cliente cuya cédula o RIF normalizado coincida (una búsqueda en
+    cada índice único). Los fallos se recuerdan unos segundos para no repetir
+    la consulta ante verificaciones repetidas.
+    
+    La caché de fallos es de cada proceso: otro worker puede haber creado el
+    cliente después. Quien va a crear un cliente debe pasar usar_cache=False.
+    
+    Args:
+        identificacion (str): Cédula o RIF, normalizado o no
+        usar_cache (bool): Consultar la caché de identificaciones inexistentes
+    
+    Returns:
+        Cliente: El cliente o None si no existe
+    """
+    identificacion = normalizar_identificacion(identificacion)
+    if not identificacion or (usar_cache and cache_identificaciones_inexistentes.leer(identificacion)):
+        return None
+    
+    cliente = Cliente.query.filter(or_(
+        Cliente.cedula_normalizada == identificacion,
+        Cliente.rif_normalizado == identificacion
+    )).first()
+    if cliente is None:
+        cache_identificaciones_inexistentes.guardar(identificacion, True)
+    return cliente
+
+@event.listens_for(Cliente, 'before_insert')
+@event.listens_for(Cliente, 'before_update')
+def actualizar_identificacion_cliente(mapper, conexion, cliente):
+    """Mantiene la cédula y el RIF normalizados cuando cambian"""
+    estado = db.inspect(cliente)
+    for columna, normalizada in (('cedula', 'cedula_normalizada'), ('rif', 'rif_normalizado')):
+        if estado.persistent and not estado.attrs[columna].history.has_changes():
+            continue
+        valor = normalizar_identificacion(getattr(cliente, columna))
+        setattr(cliente, normalizada, valor)
+        if valor:
+            cache_identificaciones_inexistentes.invalidar(valor)
+
+def crear_cliente(**datos):
+    """
+    Crea un cliente dentro de un savepoint. Si otro proceso registró la misma
+    cédula o RIF entretanto (índice único), deshace solo el savepoint y
+    devuelve ese cliente.
+    
+    Args:
+        **datos: Columnas del nuevo Cliente
+    
+    Returns:
+        Cliente: Cliente recién creado (ya con id) o el existente
+    """
+    cliente = Cliente(**datos)
+    try:
+        with db.session.begin_nested():
+            db.session.add(cliente)
+    except IntegrityError:
+        identificaciones = [valor for valor in (normalizar_identificacion(datos.get('cedula')),
+                                                normalizar_identificacion(datos.get('rif'))) if valor]
+        # Lectura con bloqueo: en MySQL una lectura normal usaría la instantánea
+        # de la transacción y no vería la fila que otro proceso acaba de confirmar
+        existente = Cliente.query.filter(or_(
+            Cliente.cedula_normalizada.in_(identificaciones),
+            Cliente.rif_normalizado.in_(identificaciones)
+        )).with_for_update(read=True).first() if identificaciones else None
+        if existente is None:
+            raise
+        return existente
+    return cliente
+
+def obtener_o_crear_cliente_pedido(pedido):
+    """
+    Cliente al que se asigna la deuda de un pedido: primero por la cédula/RIF
+    del pedido, luego por nombre exacto; si no existe se crea con los datos
+    del pedido
+    
+    Args:
+        pedido (Pedido): Pedido que se convierte en deuda
+    
+    Returns:
+        Cliente: Cliente existente o recién creado (ya con id)
+    """
+    cliente = (buscar_cliente_por_identificacion(pedido.cliente_cedula, usar_cache=False)
+               or buscar_cliente_por_identificacion(pedido.cliente_rif, usar_cache=False)
+               or Cliente.query.filter_by(nombre=pedido.cliente_nombre).first())
+    if not cliente:
+        cliente = crear_cliente(
+            nombre=pedido.cliente_nombre,
+            cedula=pedido.cliente_cedula or '',
+            rif=pedido.cliente_rif or '',
+            direccion=pedido.cliente_direccion or '',
+            telefono=pedido.cliente_telefono or '',
+            email=pedido.cliente_email or ''
+        )
+    return cliente
+
+# Detección de clientes duplicados: bloques con más clientes que esto
+# (p. ej. un nombre muy común) no generan pares
+MAX_CLIENTES_POR_BLOQUE = 50
+# Puntaje mínimo (0 a 1) para proponer un par como duplicado
+PUNTAJE_MINIMO_DUPLICADO = 0.6
+
+def normalizar_nombre_cliente(nombre):
+    """Nombre en minúsculas, sin acentos ni signos y con las palabras ordenadas"""
+    nombre = unicodedata.normalize('NFKD', nombre or '').encode('ascii', 'ignore').decode('ascii')
+    palabras = re.sub(r'[^a-z0-9 ]', ' ', nombre.lower()).split()
+    return ' '.join(sorted(palabras))
+
+def normalizar_telefono(telefono):
+    """Últimos 10 dígitos del teléfono, o None si tiene menos de 7"""
+    digitos = re.sub(r'\D', '', telefono or '')
+    return digitos[-10:] if len(digitos) >= 7 else None
+
+def digitos_identificacion(cliente):
+    """Dígitos de la cédula o RIF, sin prefijo (así 'V123' y '123' coinciden)"""
+    for valor in (cliente.cedula, cliente.rif):
+        digitos = re.sub(r'\D', '', valor or '')
+        if len(digitos) >= 6:
+            return digitos.lstrip('0')
+    return None
+
+def claves_bloqueo_cliente(cliente):
+    """
+    Claves de bloqueo de un cliente: hash corto del nombre normalizado,
+    del teléfono y de la identificación. Solo se comparan clientes que
+    comparten al menos una clave.
+    """
+    valores = (('n', normalizar_nombre_cliente(cliente.nombre)),
+               ('t', normalizar_telefono(cliente.telefono)),
+               ('i', digitos_identificacion(cliente)))
+    return [hashlib.blake2b(f"{tipo}:{valor}".encode('utf-8'), digest_size=8).digest()
+            for tipo, valor in valores if valor]
+
+def puntuar_par_clientes(a, b):
+    """
+    Puntaje de 0 a 1 de que dos clientes sean la misma persona
+    
+    Identificación igual pesa más; identificaciones distintas descartan el par.
+    Teléfono, correo y parecido del nombre suman.
+    
+    Returns:
+        tuple: (puntaje, lista de motivos)
+    """
+    motivos = []
+    puntaje = 0.0
+    id_a, id_b = digitos_identificacion(a), digitos_identificacion(b)
+    if id_a and id_b:
+        if id_a != id_b:
+            return 0.0, ['Identificaciones distintas']
+        puntaje += 0.6
+        motivos.append('Misma cédula/RIF')
+    
+    telefono_a = normalizar_telefono(a.telefono)
+    if telefono_a and telefono_a == normalizar_telefono(b.telefono):
+        puntaje += 0.3
+        motivos.append('Mismo teléfono')
+    
+    if a.email and b.email and a.email.strip().lower() == b.email.strip().lower():
+        puntaje += 0.2
+        motivos.append('Mismo correo')
+    
+    similitud = SequenceMatcher(None, normalizar_nombre_cliente(a.nombre), normalizar_nombre_cliente(b.nombre)).ratio()
+    puntaje += 0.4 * similitud
+    if similitud >= 0.85:
+        motivos.append('Nombre similar')
+    
+    return min(puntaje, 1.0), motivos
+
+def detectar_clientes_duplicados(puntaje_minimo=PUNTAJE_MINIMO_DUPLICADO):
+    """
+    Busca pares de clientes posiblemente duplicados
+    
+    Recorre los clientes una sola vez por lotes, los agrupa por claves de
+    bloqueo y solo puntúa pares dentro de un mismo bloque, así el costo no
+    crece con el cuadrado de la cantidad de clientes.
+    
+    Returns:
+        list: Diccionarios con 'cliente' y 'duplicado' (datos de cada uno),
+              'puntaje' y 'motivos', ordenados por puntaje descendente
+    """
+    columnas = (Cliente.id, Cliente.nombre, Cliente.cedula, Cliente.rif, Cliente.telefono,
+                Cliente.email, Cliente.direccion)
+    clientes = {}
+    bloques = {}
+    for fila in db.session.query(*columnas).order_by(Cliente.id).yield_per(LOTE_EXPORTACION):
+        clientes[fila.id] = fila
+        for clave in claves_bloqueo_cliente(fila):
+            bloques.setdefault(clave, []).append(fila.id)
+    
+    pares = set()
+    for ids in bloques.values():
+        if 1 < len(ids) <= MAX_CLIENTES_POR_BLOQUE:
+            for i, primero in enumerate(ids):
+                for segundo in ids[i + 1:]:
+                    pares.add((primero, segundo))
+    
+    # Cantidad de deudas por cliente para sugerir cuál conservar
+    deudas_por_cliente = dict(db.session.query(Deuda.cliente_id, func.count(Deuda.id)).filter(
+        Deuda.cliente_id.in_({cliente_id for par in pares for cliente_id in par})
+    ).group_by(Deuda.cliente_id).all()) if pares else {}
+    
+    candidatos = []
+    for primero, segundo in pares:
+        puntaje, motivos = puntuar_par_clientes(clientes[primero], clientes[segundo])
+        if puntaje < puntaje_minimo:
+            continue
+        # Se propone conservar el cliente con más deudas (o el más antiguo)
+        conservar, duplicado = sorted((primero, segundo), key=lambda c: (-deudas_por_cliente.get(c, 0), c))
+        candidatos.append({
+            'cliente': dict(clientes[conservar]._mapping, deudas=deudas_por_cliente.get(conservar, 0)),
+            'duplicado': dict(clientes[duplicado]._mapping, deudas=deudas_por_cliente.get(duplicado, 0)),
+            'puntaje': round(puntaje, 2),
+            'motivos': motivos
+        })
+    
+    candidatos.sort(key=lambda c: (-c['puntaje'], c['cliente']['id'], c['duplicado']['id']))
+    return candidatos
+
+def fusionar_clientes(conservar_id, duplicado_ids):
+    """
+    Fusiona clientes duplicados en uno
+    
+    Las deudas (y discrepancias de saldo) de los duplicados pasan al cliente
+    conservado con una sola actualización masiva por tabla; los datos de
+    contacto que le falten se completan con los de los duplicados y luego
+    los duplicados se eliminan. No hace commit.
+    
+    Args:
+        conservar_id (int): ID del cliente que se conserva
+        duplicado_ids (list): IDs de los clientes que se fusionan en él
+    
+    Returns:
+        int: Cantidad de deudas reasignadas
+    """
+    duplicado_ids = [d for d in set(duplicado_ids) if d != conservar_id]
+    cliente = db.session.get(Cliente, conservar_id)
+    if not cliente or not duplicado_ids:
+        raise ValueError('Clientes inválidos para fusionar')
+    
+    duplicados = Cliente.query.filter(Cliente.id.in_(duplicado_ids)).order_by(Cliente.id).all()
+    if len(duplicados) != len(duplicado_ids):
+        raise ValueError('Alguno de los clientes a fusionar no existe')
+    
+    # Datos de contacto que faltan en el cliente conservado
+    campos = ('cedula', 'rif', 'telefono', 'email', 'direccion')
+    completar = {}
+    for duplicado in duplicados:
+        for campo in campos:
+            if not getattr(cliente, campo) and campo not in completar and getattr(duplicado, campo):
+                completar[campo] = getattr(duplicado, campo)
+    
+    reasignadas = db.session.execute(
+        update(Deuda).where(Deuda.cliente_id.in_(duplicado_ids)).values(cliente_id=conservar_id),
+        execution_options={'synchronize_session': False}
+    ).rowcount
+    db.session.execute(
+        update(DiscrepanciaSaldo).where(DiscrepanciaSaldo.cliente_id.in_(duplicado_ids)).values(cliente_id=conservar_id),
+        execution_options={'synchronize_session': False}
+    )
+    
+    # Eliminar los duplicados antes de copiar su cédula/RIF (índices únicos)
+    for duplicado in duplicados:
+        db.session.expire(duplicado, ['deudas'])
+        db.session.delete(duplicado)
+    db.session.flush()
+    
+    for campo, valor in completar.items():
+        setattr(cliente, campo, valor)
+    db.session.info['dashboard_modificado'] = True
+    return reasignadas
+
+# Importación de clientes: filas por lote de validación y guardado
+LOTE_IMPORTACION = 1000
+# Errores por fila que se conservan para el reporte
+MAX_ERRORES_IMPORTACION = 1000
+
+# Encabezado normalizado (minúsculas, sin acentos ni signos) -> columna de Cliente
+COLUMNAS_IMPORTACION = {
+    'nombre': 'nombre', 'cliente': 'nombre', 'razonsocial': 'nombre',
+    'cedula': 'cedula', 'ci': 'cedula',
+    'rif': 'rif',
+    'telefono': 'telefono', 'celular': 'telefono',
+    'email': 'email', 'correo': 'email', 'correoelectronico': 'email',
+    'direccion': 'direccion',
+}
+
+def leer_filas_importacion(archivo, nombre_archivo):
+    """
+    Lee un archivo CSV o XLSX fila por fila sin cargarlo completo en memoria
+    
+    Args:
+        archivo: Flujo binario del archivo subido
+        nombre_archivo (str): Nombre original (define el formato por su extensión)
+    
+    Yields:
+        tuple: (número de fila en el archivo, diccionario columna -> texto)
+    
+    Raises:
+        ValueError: Si el formato no es soportado o faltan columnas obligatorias
+    """
+    extension = nombre_archivo.rsplit('.', 1)[-1].lower() if '.' in nombre_archivo else ''
+    if extension == 'xlsx':
+        if openpyxl is None:
+            raise ValueError('La importación de Excel no está disponible; use CSV')
+        libro = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+        filas = libro.active.iter_rows(values_only=True)
+    elif extension == 'csv':
+        texto = TextIOWrapper(archivo, encoding='utf-8-sig', newline='')
+        muestra = texto.read(4096)
+        texto.seek(0)
+        try:
+            # Excel en español suele separar con punto y coma
+            dialecto = csv.Sniffer().sniff(muestra, delimiters=',;\t')
+        except csv.Error:
+            dialecto = csv.excel
+        filas = csv.reader(texto, dialecto)
+    else:
+        raise ValueError('Formato no soportado; use un archivo .csv o .xlsx')
+    
+    encabezado = next(filas, None)
+    if not encabezado:
+        raise ValueError('El archivo está vacío')
+    columnas = []
+    for titulo in encabezado:
+        titulo = unicodedata.normalize('NFKD', str(titulo or '')).encode('ascii', 'ignore').decode('ascii')
+        columnas.append(COLUMNAS_IMPORTACION.get(re.sub(r'[^a-z]', '', titulo.lower())))
+    if 'nombre' not in columnas or not {'cedula', 'rif'} & set(columnas):
+        raise ValueError('El archivo debe tener columnas de nombre y de cédula o RIF')
+    
+    for numero, valores in enumerate(filas, start=2):
+        fila = {}
+        for columna, valor in zip(columnas, valores):
+            if columna is None or valor is None:
+                continue
+            # Excel guarda las cédulas como números
+            if isinstance(valor, float) and valor.is_integer():
+                valor = int(valor)
+            valor = str(valor).strip()
+            if valor:
+                fila[columna] = valor
+        if fila:
+            yield numero, fila
+
+def validar_fila_importacion(fila):
+    """
+    Valida y normaliza una fila de la importación de clientes
+    
+    Returns:
+        tuple: (registro listo para guardar, None) o (None, mensaje de error)
+    """
+    nombre = fila.get('nombre')
+    if not nombre:
+        return None, 'Falta el nombre'
+    
+    cedula = normalizar_identificacion(fila.get('cedula'))
+    rif = normalizar_identificacion(fila.get('rif'))
+    if fila.get('cedula') and not cedula:
+        return None, f"Cédula inválida: {fila['cedula']}"
+    if fila.get('rif') and not rif:
+        return None, f"RIF inválido: {fila['rif']}"
+    if not (cedula or rif):
+        return None, 'Falta la cédula o el RIF'
+    
+    email = fila.get('email')
+    if email and not re.match(r'^[^@\s]+@[^@\s]+\.[^@\s]+$', email):
+        return None, f'Email inválido: {email}'
+    
+    registro = {
+        'nombre': nombre,
+        'cedula': cedula,
+        'rif': rif,
+        'cedula_normalizada': cedula,
+        'rif_normalizado': rif,
+        'telefono': fila.get('telefono'),
+        'email': email,
+        'direccion': fila.get('direccion'),
+    }
+    for columna, valor in registro.items():
+        longitud = Cliente.__table__.c[columna].type.length
+        if valor and len(valor) > longitud:
+            return None, f'{columna.capitalize()} supera {longitud} caracteres'
+    return registro, None
+
+def conflicto_importacion(registro, por_cedula, por_rif):
+    """
+    Describe el conflicto entre un registro importado y los clientes existentes
+    
+    Hay conflicto si la cédula y el RIF pertenecen a clientes distintos, o si
+    el cliente encontrado ya tiene otra cédula u otro RIF.
+    
+    Args:
+        registro (dict): Registro validado
+        por_cedula (dict): Cédula normalizada -> cliente existente
+        por_rif (dict): RIF normalizado -> cliente existente
+    
+    Returns:
+        str: Mensaje de error o None si no hay conflicto
+    """
+    cedula, rif = registro['cedula_normalizada'], registro['rif_normalizado']
+    por_su_cedula, por_su_rif = por_cedula.get(cedula), por_rif.get(rif)
+    if por_su_cedula and por_su_rif and por_su_cedula.id != por_su_rif.id:
+        return f'La cédula {cedula} y el RIF {rif} pertenecen a clientes distintos ({por_su_cedula.id} y {por_su_rif.id})'
+    existente = por_su_cedula or por_su_rif
+    if existente and rif and existente.rif_normalizado not in (None, rif):
+        return f'El cliente {existente.id} con cédula {cedula} tiene otro RIF ({existente.rif_normalizado})'
+    if existente and cedula and existente.cedula_normalizada not in (None, cedula):
+        return f'El cliente {existente.id} con RIF {rif} tiene otra cédula ({existente.cedula_normalizada})'
+    return None
+
+def guardar_lote_importacion(lote):
+    """
+    Guarda un lote de clientes con una consulta y dos sentencias masivas
+    
+    Los registros cuya cédula o RIF normalizado ya pertenece a un cliente
+    actualizan ese cliente por id; los demás se insertan. Los que contradicen
+    a un cliente existente (ver conflicto_importacion) no se guardan. El
+    nombre se reemplaza; los demás datos solo si vienen en el archivo (las
+    celdas vacías no borran lo que ya existe).
+    
+    Args:
+        lote (list): Tuplas (número de fila, registro validado)
+    
+    Returns:
+        list: Tuplas (número de fila, mensaje) de los registros en conflicto
+    """
+    cedulas = [r['cedula_normalizada'] for _, r in lote if r['cedula_normalizada']]
+    rifs = [r['rif_normalizado'] for _, r in lote if r['rif_normalizado']]
+    existentes = db.session.query(Cliente.id, Cliente.cedula_normalizada, Cliente.rif_normalizado).filter(or_(
+        Cliente.cedula_normalizada.in_(cedulas), Cliente.rif_normalizado.in_(rifs))).all()
+    por_cedula = {c.cedula_normalizada: c for c in existentes if c.cedula_normalizada}
+    por_rif = {c.rif_normalizado: c for c in existentes if c.rif_normalizado}
+    
+    cambios, nuevos, conflictos = [], [], []
+    for numero, registro in lote:
+        conflicto = conflicto_importacion(registro, por_cedula, por_rif)
+        if conflicto:
+            conflictos.append((numero, conflicto))
+            continue
+        existente = por_cedula.get(registro['cedula_normalizada']) or por_rif.get(registro['rif_normalizado'])
+        if existente:
+            cambios.append({'id': existente.id, **{c: v for c, v in registro.items() if v is not None}})
+        else:
+            nuevos.append(registro)
+    
+    # Sentencias masivas: el listener de normalización no corre, los
+    # registros ya traen la cédula y el RIF normalizados
+    if cambios:
+        db.session.execute(update(Cliente), cambios)
+    if nuevos:
+        db.session.execute(Cliente.__table__.insert(), nuevos)
+    db.session.info['dashboard_modificado'] = True
+    db.session.commit()
+    return conflictos
+
+def importar_clientes(archivo, nombre_archivo):
+    """
+    Importa clientes desde un CSV o XLSX por lotes de LOTE_IMPORTACION filas
+    
+    Cada lote se valida, se guarda con sentencias masivas y se confirma, así
+    la memoria usada no depende del tamaño del archivo. Las filas que
+    contradicen a un cliente existente se informan como errores.
+    
+    Returns:
+        dict: 'procesadas', 'guardadas', 'total_errores' y 'errores'
+              (lista de (fila, mensaje), como máximo MAX_ERRORES_IMPORTACION)
+    
+    Raises:
+        ValueError: Si el archivo no se puede leer
+    """
+    resumen = {'procesadas': 0, 'guardadas': 0, 'total_errores': 0, 'errores': []}
+    
+    def registrar_error(numero, mensaje):
+        resumen['total_errores'] += 1
+        if len(resumen['errores']) < MAX_ERRORES_IMPORTACION:
+            resumen['errores'].append((numero, mensaje))
+    
+    def guardar(lote):
+        try:
+            conflictos = guardar_lote_importacion(lote)
+            resumen['guardadas'] += len(lote) - len(conflictos)
+            for numero, mensaje in conflictos:
+                registrar_error(numero, mensaje)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error al guardar lote de importación: {e}")
+            for numero, _ in lote:
+                registrar_error(numero, 'No se pudo guardar el lote de esta fila')
+    
+    vistas = {}
+    lote = []
+    try:
+        for numero, fila in leer_filas_importacion(archivo, nombre_archivo):
+            resumen['procesadas'] += 1
+            registro, error = validar_fila_importacion(fila)
+            if error:
+                registrar_error(numero, error)
+                continue
+            
+            identificaciones = [v for v in (registro['cedula_normalizada'], registro['rif_normalizado']) if v]
+            repetida = next((v for v in identificaciones if v in vistas), None)
+            if repetida:
+                registrar_error(numero, f'Cédula/RIF {repetida} repetido (fila {vistas[repetida]})')
+                continue
+            for identificacion in identificaciones:
+                vistas[identificacion] = numero
+            
+            lote.append((numero, registro))
+            if len(lote) >= LOTE_IMPORTACION:
+                guardar(lote)
+                lote = []
+        if lote:
+            guardar(lote)
+    finally:
+        # Los clientes nuevos ya no son "inexistentes" y pueden cambiar los duplicados
+        cache_identificaciones_inexistentes.invalidar()
+        cache_duplicados_clientes.invalidar()
+    
+    return resumen
+
+def insert_sample_data():
+    """Inserta datos de ejemplo en la base de datos"""
+    if Cliente.query.first() or Producto.query.first():
+        print("Datos de ejemplo ya existen, omitiendo inserción")
+        return
+    
+    # Verificar si las categorías por defecto existen
+    if not Categoria.query.first():
+        categorias_default = [
+            Categoria(nombre='General', descripcion='Productos generales'),
+            Categoria(nombre='Alimentos', descripcion='Productos alimenticios'),
+            Categoria(nombre='Bebidas', descripcion='Bebidas y refrescos'),
+            Categoria(nombre='Limpieza', descripcion='Productos de limpieza'),
+            Categoria(nombre='Cuidado Personal', descripcion='Productos de higiene personal')
+        ]
+        for categoria in categorias_default:
+            db.session.add(categoria)
+        db.session.commit()
+        print("Categorías por defecto creadas")
+    
+    # Insertar algunos clientes
+    cliente1 = Cliente(nombre='Juan Pérez', cedula='V12345678', direccion='Calle Principal', telefono='04141234567', email='juan@example.com')
+    cliente2 = Cliente(nombre='María González', cedula='V87654321', direccion='Avenida Central', telefono='04261234567', email='maria@example.com')
+    db.session.add(cliente1)
+    db.session.add(cliente2)
+
+    categoria_alimentos = Categoria.query.filter_by(nombre='Alimentos').first()
+    categoria_bebidas = Categoria.query.filter_by(nombre='Bebidas').first()
+    categoria_limpieza = Categoria.query.filter_by(nombre='Limpieza').first()
+    
+    # Insertar algunos productos con categorías válidas
+    producto1 = Producto(nombre='Arroz', cantidad=100, precio=2.5, categoria_id=categoria_alimentos.id if categoria_alimentos else 1)
+    producto2 = Producto(nombre='Leche', cantidad=50, precio=1.8, categoria_id=categoria_bebidas.id if categoria_bebidas else 2)
+    producto3 = Producto(nombre='Jabón', cantidad=200, precio=1.2, categoria_id=categoria_limpieza.id if categoria_limpieza else 4)
+    db.session.add(producto1)
+    db.session.add(producto2)
+    db.session.add(producto3)
+
+    # Insertar un usuario administrador
+    hashed_password = generate_password_hash('admin123', method='pbkdf2:sha256', salt_length=8)
+    usuario = Usuario(username='admin', password=hashed_password, es_admin=True)
+    db.session.add(usuario)
+
+    # Insertar información de empresa
+    empresa = Empresa(
+        nombre='Mi Empresa',
+        direccion='Av. Principal #123',
+        telefono='+584121234567',
+        facebook='https://facebook.com/miempresa',
+        instagram='https://instagram.com/miempresa',
         logo_url='https://ejemplo.com/logo.png'
     )
     db.session.add(empresa)
 
     db.session.commit()
 
+# Tablas exportables: nombre -> (modelo, columna de fecha para filtrar, join con la tabla padre)
+EXPORTACIONES = {
+    'pedidos': (Pedido, Pedido.fecha, None),
+    'items_pedido': (ItemPedido, Pedido.fecha, (Pedido, ItemPedido.pedido_id == Pedido.id)),
+    'deudas': (Deuda, Deuda.fecha, None),
+    'productos_deuda': (ProductoDeuda, Deuda.fecha, (Deuda, ProductoDeuda.deuda_id == Deuda.id)),
+    'pagos': (PagoParcial, PagoParcial.fecha, None),
+}
+
+# Filas por lote al leer con cursor del lado del servidor
+LOTE_EXPORTACION = 2000
+
+def inicio_dia_utc(fecha):
+    """Inicio del día local del negocio expresado en UTC (sin zona), como se guardan las fechas"""
+    return datetime.combine(fecha, time.min, tzinfo=ZONA_HORARIA_NEGOCIO).astimezone(timezone.utc).replace(tzinfo=None)
+
+def consulta_exportacion(entidad, desde=None, hasta=None):
+    """
+    Construye la consulta de exportación de una tabla
+    
+    Las tablas de líneas (items de pedido, productos de deuda) se filtran por
+    la fecha del pedido o la deuda a la que pertenecen. La consulta usa
+    yield_per para leer por lotes con cursor del lado del servidor.
+    
+    Args:
+        entidad (str): Clave de EXPORTACIONES
+        desde (date): Primer día local incluido (opcional)
+        hasta (date): Último día local incluido (opcional)
+    
+    Returns:
+        tuple: (consulta, columnas de la tabla)
+    """
+    modelo, columna_fecha, padre = EXPORTACIONES[entidad]
+    columnas = list(modelo.__table__.columns)
+    
+    consulta = select(*columnas).select_from(modelo)
+    if padre is not None and (desde or hasta):
+        consulta = consulta.join(*padre)
+    if desde:
+        consulta = consulta.where(columna_fecha >= inicio_dia_utc(desde))
+    if hasta:
+        consulta = consulta.where(columna_fecha < inicio_dia_utc(hasta + timedelta(days=1)))
+    
+    consulta = consulta.order_by(modelo.id).execution_options(yield_per=LOTE_EXPORTACION)
+    return consulta, columnas
+
+def generar_csv_exportacion(consulta, columnas):
+    """
+    Genera el CSV de una exportación por partes, un lote de filas a la vez
+    
+    Yields:
+        str: Fragmento del archivo CSV
+    """
+    salida = StringIO()
+    escritor = csv.writer(salida)
+    escritor.writerow([c.name for c in columnas])
+    yield salida.getvalue()
+    
+    for lote in db.session.execute(consulta).partitions():
+        salida.seek(0)
+        salida.truncate(0)
+        escritor.writerows(lote)
+        yield salida.getvalue()
+
+def tipo_arrow(columna):
+    """Tipo de pyarrow equivalente a una columna del modelo"""
+    if isinstance(columna.type, db.Boolean):
+        return pa.bool_()
+    if isinstance(columna.type, db.Integer):
+        return pa.int64()
+    if isinstance(columna.type, db.Float):
+        return pa.float64()
+    if isinstance(columna.type, db.DateTime):
+        return pa.timestamp('us')
+    if isinstance(columna.type, db.Date):
+        return pa.date32()
+    return pa.string()
+
+def escribir_parquet_exportacion(consulta, columnas, archivo):
+    """
+    Escribe una exportación en formato Parquet, un grupo de filas por lote
+    
+    Args:
+        consulta: Consulta de consulta_exportacion
+        columnas (list): Columnas de la tabla
+        archivo: Archivo binario de destino
+    """
+    esquema = pa.schema([(c.name, tipo_arrow(c)) for c in columnas])
+    nombres = [c.name for c in columnas]
+    with pq.ParquetWriter(archivo, esquema) as escritor:
+        for lote in db.session.execute(consulta).partitions():
+            datos = list(zip(*lote))
+            escritor.write_table(pa.Table.from_arrays(
+                [pa.array(valores, type=campo.type) for valores, campo in zip(datos, esquema)],
+                names=nombres))
+
 # ============================================================================
 # CONFIGURACIÓN DE FLASK-LOGIN
 # ============================================================================
@@ -513,13 +3496,49 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+def version_autenticacion(usuario):
+    """Huella corta del hash de contraseña; cambia cuando se cambia la contraseña"""
+    return hashlib.sha256(usuario.password.encode('utf-8')).hexdigest()[:16]
+
+def marcar_usuarios_modificados():
+    """
+    Incrementa la versión compartida de usuarios dentro de la transacción
+    actual; al confirmar, este worker la relee y los demás en pocos segundos
+    """
+    version_usuarios.incrementar()
+    db.session.info['usuarios_modificados'] = True
+
 @login_manager.user_loader
 def load_user(user_id):
-    """Carga un usuario por su ID para Flask-Login"""
+    """
+    Carga un usuario por su ID para Flask-Login
+    
+    Usa una copia desconectada de la sesión guardada en caché por id, versión
+    de credenciales y versión compartida de usuarios. Si la versión guardada
+    en la sesión falta (sesiones anteriores a este control) o ya no coincide
+    con la del usuario (la contraseña cambió), la sesión deja de ser válida.
+    """
     try:
-        return Usuario.query.get(int(user_id))
+        usuario_id = int(user_id)
     except (TypeError, ValueError):
         return None
+    
+    version = session.get('version_auth')
+    if not version:
+        return None
+    clave = (usuario_id, version, version_usuarios.obtener())
+    usuario = cache_usuarios.leer(clave)
+    if usuario is not None:
+        return usuario
+    
+    usuario = db.session.get(Usuario, usuario_id)
+    if usuario is None or version != version_autenticacion(usuario):
+        return None
+    
+    # Desconectar de la sesión para poder compartir la copia entre peticiones
+    db.session.expunge(usuario)
+    cache_usuarios.guardar(clave, usuario)
+    return usuario
 
 class AnonymousUser(AnonymousUserMixin):
     """Clase para usuarios anónimos"""
@@ -621,6 +3640,8 @@ def init_db():
             db.session.add(config)
             
             db.session.commit()
+            inicializar_datos_globales()
+            datos_globales.invalidar()
             
             return "Base de datos inicializada con datos de ejemplo", 200
             
@@ -629,14 +3650,9 @@ def init_db():
 
 @app.context_processor
 def inject_global_data():
-    """Inyecta datos globales en todas las plantillas"""
-    empresa = Empresa.query.first()
-    configuracion = Configuracion.query.first()
-    if not configuracion:
-        configuracion = Configuracion()
-        db.session.add(configuracion)
-        db.session.commit()
-    return dict(empresa=empresa, configuracion=configuracion)
+    """Inyecta datos globales en todas las plantillas (desde la caché del worker)"""
+    datos = datos_globales.obtener()
+    return dict(empresa=datos['empresa'], configuracion=datos['configuracion'])
 
 # ============================================================================
 # RUTAS PRINCIPALES Y PÚBLICAS
@@ -687,73 +3703,35 @@ def consulta_deuda_cliente():
     """
     Permite a los clientes consultar sus deudas pendientes
     Ruta pública accesible sin autenticación
+    
+    Limitada por IP y globalmente (token bucket) para que el tráfico público
+    no agote el pool de conexiones; los resultados se guardan brevemente
+    por cliente.
     """
     form = ConsultaDeudaForm()
     if form.validate_on_submit():
-        nombre = form.nombre.data.strip()
-        
-        # Buscar cliente
-        cliente = Cliente.query.filter(Cliente.nombre == nombre).first()
-        if not cliente:
-            flash('Cliente no encontrado', 'info')
+        if not limitador_consulta_ip.permitir(obtener_ip_cliente()):
+            flash('Demasiadas consultas. Intente de nuevo en unos segundos', 'warning')
             return redirect(url_for('index'))
         
-        # Obtener todas las deudas del cliente
-        deudas = Deuda.query.filter_by(cliente_id=cliente.id).all()
+        nombre = form.nombre.data.strip()
         
-        deudas_info = []
-        total_pendiente = 0.0
+        resultado = cache_consulta_deudas.leer(nombre)
+        if resultado is None:
+            # Solo las consultas que llegan a la base de datos consumen el cupo global
+            if not limitador_consulta_global.permitir('global'):
+                flash('El servicio de consulta está ocupado. Intente de nuevo en unos segundos', 'warning')
+                return redirect(url_for('index'))
+            resultado = consultar_deudas_cliente_publico(nombre)
+            cache_consulta_deudas.guardar(nombre, resultado)
         
-        for deuda in deudas:
-            # Calcular total de la deuda
-            total = 0.0
-            productos_deuda = []
-            for pd in deuda.productos:
-                producto = Producto.query.get(pd.producto_id)
-                if producto:
-                    subtotal = producto.precio * pd.cantidad
-                    total += subtotal
-                    productos_deuda.append({
-                        'producto': producto,
-                        'cantidad': pd.cantidad,
-                        'precio': producto.precio,
-                        'subtotal': subtotal
-                    })
-            
-            # Calcular saldo pendiente
-            saldo_pendiente = total
-            pagos_parciales = []
-            for pago in deuda.pagos:
-                saldo_pendiente -= pago.monto_usd
-                pagos_parciales.append({
-                    'fecha': pago.fecha,
-                    'monto_usd': pago.monto_usd,
-                    'descripcion': pago.descripcion
-                })
-            
-            if deuda.estado == 'pendiente':
-                total_pendiente += saldo_pendiente
-            
-            deudas_info.append({
-                'id': deuda.id,
-                'fecha': deuda.fecha,
-                'estado': deuda.estado,
-                'productos': productos_deuda,
-                'pagos_parciales': pagos_parciales,
-                'total': total,
-                'saldo_pendiente': saldo_pendiente
-            })
-        
-        # Separar deudas en pendientes y pagadas
-        deudas_pendientes = [d for d in deudas_info if d['estado'] == 'pendiente']
-        deudas_pagadas = [d for d in deudas_info if d['estado'] == 'pagada']
+        if not resultado['cliente']:
+            flash('Cliente no encontrado', 'info')
+            return redirect(url_for('index'))
         
         return render_template('consulta_deuda_cliente.html', 
-                            cliente=cliente, 
-                            deudas_pendientes=deudas_pendientes,
-                            deudas_pagadas=deudas_pagadas,
-                            total_pendiente=total_pendiente,
-                            form=EmptyForm())
+                            form=EmptyForm(),
+                            **resultado)
     
     return redirect(url_for('index'))
 
@@ -771,12 +3749,42 @@ def login():
     
     form = LoginForm()
     if form.validate_on_submit():
-        usuario = Usuario.query.filter_by(username=form.username.data).first()
+        username = form.username.data.strip()
         
-        if usuario and check_password_hash(usuario.password, form.password.data):
+        # Las cubetas se revisan antes de tocar la base de datos o calcular hashes
+        ip = obtener_ip_cliente()
+        dispositivo = f"{username.lower()}|{ip}"
+        if dispositivos_confiables_login.leer(dispositivo):
+            limitador_usuario, clave_usuario = limitador_login_dispositivo, dispositivo
+        else:
+            limitador_usuario, clave_usuario = limitador_login_usuario, username.lower()
+        permitido_ip = limitador_login_ip.permitir(ip)
+        if not (permitido_ip and limitador_usuario.disponible(clave_usuario)):
+            flash('Demasiados intentos de inicio de sesión. Intente de nuevo más tarde', 'warning')
+            return render_template('login.html', form=form), 429
+        
+        usuario = Usuario.query.filter_by(username=username).first()
+        valida = verificar_contrasena(usuario.password, form.password.data) if usuario else False
+        if valida is None:
+            flash('El servidor está ocupado. Intente de nuevo en unos segundos', 'warning')
+            return render_template('login.html', form=form), 503
+        
+        if valida:
+            if requiere_rehash(usuario.password):
+                # Actualizar el hash al costo configurado mientras se conoce la
+                # contraseña; si el ejecutor está ocupado se intenta en otro inicio
+                nuevo_hash = generar_hash_contrasena(form.password.data)
+                if nuevo_hash:
+                    usuario.password = nuevo_hash
+                    marcar_usuarios_modificados()
+                    db.session.commit()
+            
             login_user(usuario)
+            session['version_auth'] = version_autenticacion(usuario)
+            dispositivos_confiables_login.guardar(dispositivo, True)
             return redirect(url_for('dashboard'))
         
+        limitador_usuario.permitir(clave_usuario)
         flash('Usuario o contraseña incorrectos', 'danger')
     
     return render_template('login.html', form=form)
@@ -798,10 +3806,18 @@ def change_password():
     form = ChangePasswordForm()
     if form.validate_on_submit():
         try:
-            if check_password_hash(current_user.password, form.old_password.data):
-                hashed_password = generate_password_hash(form.new_password.data)
-                current_user.password = hashed_password
+            valida = verificar_contrasena(current_user.password, form.old_password.data)
+            hashed_password = generar_hash_contrasena(form.new_password.data) if valida else None
+            if valida is None or (valida and hashed_password is None):
+                flash('El servidor está ocupado. Intente de nuevo en unos segundos', 'warning')
+            elif valida:
+                # current_user es una copia en caché desconectada; se actualiza la fila real
+                usuario = db.session.get(Usuario, current_user.id)
+                usuario.password = hashed_password
+                marcar_usuarios_modificados()
                 db.session.commit()
+                
+                session['version_auth'] = version_autenticacion(usuario)
                 flash('Contraseña actualizada exitosamente', 'success')
                 return redirect(url_for('dashboard'))
             else:
@@ -816,6 +3832,73 @@ def change_password():
 # RUTAS DEL PANEL ADMINISTRATIVO
 # ============================================================================
 
+def calcular_datos_dashboard():
+    """
+    Calcula las estadísticas del dashboard con consultas agregadas
+    
+    Devuelve solo datos planos (sin instancias ORM) para poder guardarlos en
+    caché entre peticiones.
+    
+    Returns:
+        dict: Variables de la plantilla dashboard.html
+    """
+    # Totales de inventario
+    inventario = db.session.query(
+        func.coalesce(func.sum(Producto.cantidad), 0).label('stock'),
+        func.coalesce(func.sum(Producto.cantidad * Producto.precio), 0).label('valor')
+    ).one()
+    
+    # Productos con bajo stock (< 5 unidades)
+    productos_bajo_stock = [
+        {'id': p.id, 'nombre': p.nombre, 'cantidad': p.cantidad}
+        for p in db.session.query(Producto.id, Producto.nombre, Producto.cantidad
+                                  ).filter(Producto.cantidad < 5
+                                  ).order_by(Producto.cantidad).all()
+    ]
+    
+    clientes = [
+        {'id': c.id, 'nombre': c.nombre, 'cedula': c.cedula}
+        for c in db.session.query(Cliente.id, Cliente.nombre, Cliente.cedula
+                                  ).order_by(Cliente.id).limit(3).all()
+    ]
+    
+    # Deudas pendientes y saldo por cobrar con los precios guardados
+    cargos, pagos, saldo = subconsultas_saldo_deuda()
+    pendientes = db.session.query(
+        func.count(Deuda.id).label('cantidad'),
+        func.coalesce(func.sum(saldo), 0).label('saldo')
+    ).outerjoin(cargos, cargos.c.deuda_id == Deuda.id
+    ).outerjoin(pagos, pagos.c.deuda_id == Deuda.id
+    ).filter(Deuda.estado == 'pendiente').one()
+    
+    # Últimos pedidos pendientes
+    pedidos_pendientes = [
+        {'id': p.id, 'cliente_nombre': p.cliente_nombre, 'total': p.total or 0, 'fecha': p.fecha}
+        for p in db.session.query(Pedido.id, Pedido.cliente_nombre, Pedido.total, Pedido.fecha
+                                  ).filter(Pedido.estado == 'pendiente'
+                                  ).order_by(Pedido.fecha.desc()).limit(5).all()
+    ]
+    
+    # Top productos más vendidos (pedidos completados y deudas pagadas)
+    top_productos = [
+        {'nombre': p['nombre'], 'categoria_nombre': p['categoria_nombre'] or 'Sin categoría',
+         'total_vendido': p['unidades']}
+        for p in ranking_productos(ventana='total', limite=5)
+    ]
+    
+    return {
+        'productos_bajo_stock': productos_bajo_stock,
+        'clientes': clientes,
+        'total_stock': int(inventario.stock),
+        'total_value': float(inventario.valor),
+        'deudas_pendientes': int(pendientes.cantidad),
+        'total_pendiente': float(pendientes.saldo),
+        'pedidos_pendientes': pedidos_pendientes,
+        'top_productos': top_productos,
+        'total_orders': db.session.query(func.count(Pedido.id)).scalar(),
+        'total_customers': db.session.query(func.count(Cliente.id)).scalar()
+    }
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
@@ -823,56 +3906,8 @@ def dashboard():
     Panel principal de administración
     Muestra estadísticas generales del negocio
     """
-    # Obtener productos
-    productos = Producto.query.all()
-    
-    # Obtener productos con bajo stock (< 5 unidades)
-    productos_bajo_stock = [p for p in productos if p.cantidad < 5]
-    
-    # Obtener clientes
-    clientes = Cliente.query.all()
-    
-    # Calcular estadísticas
-    total_stock = sum(p.cantidad for p in productos)
-    total_value = sum(p.cantidad * p.precio for p in productos)
-    
-    # Obtener deudas pendientes
-    deudas_pendientes = Deuda.query.filter_by(estado='pendiente').all()
-    
-    # Calcular total pendiente por cobrar
-    total_pendiente = 0.0
-    for deuda in deudas_pendientes:
-        total_productos = sum(pd.cantidad * p.precio for pd in deuda.productos for p in [pd.producto])
-        total_pagos = sum(p.monto_usd for p in deuda.pagos)
-        total_pendiente += (total_productos - total_pagos)
-    
-    # Obtener pedidos pendientes
-    pedidos_pendientes = Pedido.query.filter_by(estado='pendiente').order_by(Pedido.fecha.desc()).limit(5).all()
-        
-    # Obtener top productos más vendidos
-    top_productos = db.session.query(
-            Producto.nombre,
-            Categoria.nombre.label('categoria_nombre'),
-            func.sum(ItemPedido.cantidad).label('total_vendido')
-                ).join(ItemPedido, ItemPedido.producto_id == Producto.id
-                ).join(Pedido, Pedido.id == ItemPedido.pedido_id
-                ).join(Categoria, Categoria.id == Producto.categoria_id
-                ).filter(Pedido.estado == 'completado'
-                ).group_by(Producto.id, Producto.nombre, Categoria.nombre
-                ).order_by(func.sum(ItemPedido.cantidad).desc()
-                ).limit(5).all()
-                
-    return render_template('dashboard.html',  
-                            productos_bajo_stock=productos_bajo_stock,
-                            clientes=clientes[:3],
-                            total_stock=total_stock,
-                            total_value=total_value,
-                            deudas_pendientes=len(deudas_pendientes),
-                            total_pendiente=total_pendiente,
-                            pedidos_pendientes=pedidos_pendientes,
-                            top_productos=top_productos,
-                            total_orders=Pedido.query.count(),
-                            total_customers=Cliente.query.count())
+    datos = cache_dashboard.obtener('dashboard', calcular_datos_dashboard)
+    return render_template('dashboard.html', **datos)
 
 # ============================================================================
 # RUTAS DE GESTIÓN DE CLIENTES
@@ -883,6 +3918,9 @@ def dashboard():
 def registrar_cliente():
     form = ClienteForm()
     if form.validate_on_submit():
+        if buscar_cliente_por_identificacion(form.cedula.data, usar_cache=False):
+            flash('Ya existe un cliente con esa cédula o RIF', 'danger')
+            return render_template('registrar_cliente.html', form=form)
         try:
             cliente = Cliente(
                 nombre=form.nombre.data,
@@ -895,7 +3933,12 @@ def registrar_cliente():
             db.session.commit()
             flash('Cliente registrado exitosamente', 'success')
             return redirect(url_for('listar_clientes'))
+        except IntegrityError:
+            # Otro proceso registró la misma cédula entre la verificación y el commit
+            db.session.rollback()
+            flash('Ya existe un cliente con esa cédula o RIF', 'danger')
         except Exception as e:
+            db.session.rollback()
             print(f"Error al registrar cliente: {e}")
             flash('Error al registrar el cliente', 'danger')
     return render_template('registrar_cliente.html', form=form)
@@ -903,9 +3946,32 @@ def registrar_cliente():
 @app.route('/clientes')
 @login_required
 def listar_clientes():
-    """Muestra la lista de todos los clientes"""
-    clientes = Cliente.query.all()
-    return render_template('clientes.html', clientes=clientes, form=EmptyForm())
+    """Muestra el directorio de clientes; las filas se cargan desde /api/clientes"""
+    return render_template('clientes.html', form=EmptyForm())
+
+@app.route('/api/clientes')
+@login_required
+def api_buscar_clientes():
+    """
+    API de búsqueda de clientes paginada por cursor
+    
+    Parámetros:
+        q: Prefijo de nombre, cédula, RIF o teléfono (opcional)
+        cursor: Valor `siguiente` de la página anterior (opcional)
+        limite: Clientes por página (1-100, por defecto 25)
+    Retorna los datos en formato JSON
+    """
+    texto = request.args.get('q', '')
+    cursor = request.args.get('cursor') or None
+    limite = min(max(request.args.get('limite', 25, type=int), 1), 100)
+    
+    try:
+        clientes, siguiente = buscar_clientes(texto, cursor, limite)
+    except Exception as e:
+        print(f"Error en api_buscar_clientes: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({'clientes': clientes, 'siguiente': siguiente})
 
 @app.route('/editar_cliente/<int:id>', methods=['POST'])
 @login_required
@@ -924,7 +3990,12 @@ def editar_cliente(id):
     cliente.telefono = request.form.get('telefono')
     cliente.email = request.form.get('email')
     
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        flash('Ya existe otro cliente con esa cédula o RIF', 'danger')
+        return redirect(url_for('listar_clientes'))
     flash('Cliente actualizado exitosamente', 'success')
     return redirect(url_for('listar_clientes'))
 
@@ -943,6 +4014,63 @@ def eliminar_cliente(id):
     flash('Cliente eliminado correctamente', 'success')
     return redirect(url_for('listar_clientes'))
 
+@app.route('/clientes/importar', methods=['GET', 'POST'])
+@login_required
+def importar_clientes_route():
+    """
+    Importa clientes desde un archivo CSV o XLSX
+    Muestra el resumen y los errores por fila
+    """
+    resumen = None
+    if request.method == 'POST':
+        archivo = request.files.get('archivo')
+        if not archivo or not archivo.filename:
+            flash('Seleccione un archivo CSV o XLSX', 'danger')
+            return redirect(url_for('importar_clientes_route'))
+        try:
+            resumen = importar_clientes(archivo.stream, archivo.filename)
+            flash(f"Importación terminada: {resumen['guardadas']} clientes guardados, "
+                  f"{resumen['total_errores']} filas con errores",
+                  'success' if not resumen['total_errores'] else 'warning')
+        except ValueError as e:
+            flash(str(e), 'danger')
+        except Exception as e:
+            print(f"Error al importar clientes: {e}")
+            flash('Error al leer el archivo', 'danger')
+    
+    return render_template('importar_clientes.html', resumen=resumen,
+                          excel_disponible=openpyxl is not None,
+                          max_errores=MAX_ERRORES_IMPORTACION, form=EmptyForm())
+
+@app.route('/clientes/duplicados')
+@login_required
+def clientes_duplicados():
+    """Lista pares de clientes posiblemente duplicados para fusionarlos"""
+    if request.args.get('recalcular'):
+        cache_duplicados_clientes.invalidar()
+    candidatos = cache_duplicados_clientes.obtener('pares', detectar_clientes_duplicados)
+    return render_template('clientes_duplicados.html', candidatos=candidatos, form=EmptyForm())
+
+@app.route('/clientes/fusionar', methods=['POST'])
+@login_required
+def fusionar_clientes_route():
+    """Fusiona un cliente duplicado en el cliente que se conserva"""
+    conservar_id = request.form.get('conservar_id', type=int)
+    duplicado_id = request.form.get('duplicado_id', type=int)
+    try:
+        reasignadas = fusionar_clientes(conservar_id, [duplicado_id])
+        db.session.commit()
+        cache_duplicados_clientes.invalidar()
+        flash(f'Clientes fusionados: {reasignadas} deudas reasignadas', 'success')
+    except ValueError as e:
+        db.session.rollback()
+        flash(str(e), 'danger')
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al fusionar clientes: {e}")
+        flash('Error al fusionar los clientes', 'danger')
+    return redirect(url_for('clientes_duplicados'))
+
 @app.route('/verificar_cliente', methods=['POST'])
 def verificar_cliente():
     """
@@ -954,12 +4082,10 @@ def verificar_cliente():
         
         if not identificacion:
             return jsonify({'success': False, 'message': 'Por favor ingrese una cédula o RIF'})
+        identificacion = normalizar_identificacion(identificacion) or identificacion
         
-        # Buscar cliente por cédula o RIF
-        cliente = Cliente.query.filter(
-            (Cliente.cedula == identificacion) | 
-            (Cliente.rif == identificacion)
-        ).first()
+        # Buscar cliente por cédula o RIF normalizado (índices únicos)
+        cliente = buscar_cliente_por_identificacion(identificacion)
         
         if cliente:
             return jsonify({
@@ -991,71 +4117,48 @@ def gestion_deudas(cliente_id):
     """
     Muestra todas las deudas de un cliente específico
     
+    Las deudas pendientes se muestran completas; las pagadas se paginan
+    por cursor. Líneas, productos y pagos se cargan con selectinload, así
+    que el costo no crece con la cantidad de deudas del cliente.
+    
     Args:
         cliente_id (int): ID del cliente
     """
     cliente = Cliente.query.get_or_404(cliente_id)
-    
-    # Obtener todas las deudas del cliente
-    deudas = Deuda.query.filter_by(cliente_id=cliente.id).all()
-    
-    deudas_pendientes = []
-    deudas_pagadas = []
-    
-    for deuda in deudas:
-        # Calcular precios sin IVA (ejemplo)
-        total_sin_iva = 0.0
-        productos_deuda = []
-        for pd in deuda.productos:
-            producto = Producto.query.get(pd.producto_id)
-            if producto:
-                precio_sin_iva = producto.precio * 100 / 116  # Suponiendo 16% de IVA
-                subtotal_sin_iva = precio_sin_iva * pd.cantidad
-                total_sin_iva += subtotal_sin_iva
-                
-                productos_deuda.append({
-                    'producto': producto,
-                    'cantidad': pd.cantidad,
-                    'precio_sin_iva': precio_sin_iva,
-                    'subtotal_sin_iva': subtotal_sin_iva
-                })
-        
-        # Calcular IVA y total con IVA
-        iva = total_sin_iva * 0.16
-        total_con_iva = total_sin_iva + iva
-        
-        # Calcular saldo pendiente
-        saldo_pendiente = total_con_iva
-        pagos_parciales = []
-        for pago in deuda.pagos:
-            saldo_pendiente -= pago.monto_usd
-            pagos_parciales.append({
-                'fecha': pago.fecha,
-                'monto_usd': pago.monto_usd,
-                'descripcion': pago.descripcion
-            })
-        
-        deuda_info = {
-            'id': deuda.id,
-            'fecha': deuda.fecha,
-            'estado': deuda.estado,
-            'productos': productos_deuda,
-            'pagos_parciales': pagos_parciales,
-            'subtotal_sin_iva': total_sin_iva,
-            'iva': iva,
-            'total_con_iva': total_con_iva,
-            'saldo_pendiente': saldo_pendiente
-        }
-        
-        if deuda.estado == 'pendiente':
-            deudas_pendientes.append(deuda_info)
-        else:
-            deudas_pagadas.append(deuda_info)
+    cursor_pagadas = request.args.get('cursor_pagadas', '')
+    pagadas_por_pagina = 10
+    
+    def consulta_deudas(estado):
+        return Deuda.query.filter_by(cliente_id=cliente.id, estado=estado).options(
+            db.selectinload(Deuda.productos).joinedload(ProductoDeuda.producto),
+            db.selectinload(Deuda.pagos)
+        ).order_by(Deuda.fecha.desc(), Deuda.id.desc())
+    
+    deudas_pendientes = [desglosar_deuda(d) for d in consulta_deudas('pendiente').all()]
+    
+    query_pagadas = consulta_deudas('pagada')
+    posicion = decodificar_cursor(cursor_pagadas) if cursor_pagadas else None
+    if posicion:
+        fecha_cursor, id_cursor = posicion
+        query_pagadas = query_pagadas.filter(or_(
+            Deuda.fecha < fecha_cursor,
+            and_(Deuda.fecha == fecha_cursor, Deuda.id < id_cursor)
+        ))
+    pagadas = query_pagadas.limit(pagadas_por_pagina + 1).all()
+    
+    siguiente_cursor_pagadas = None
+    if len(pagadas) > pagadas_por_pagina:
+        pagadas = pagadas[:pagadas_por_pagina]
+        siguiente_cursor_pagadas = codificar_cursor(pagadas[-1].fecha, pagadas[-1].id)
+    deudas_pagadas = [desglosar_deuda(d) for d in pagadas]
     
     return render_template('gestion_deudas.html', 
                           cliente=cliente, 
                           deudas_pendientes=deudas_pendientes,
-                          deudas_pagadas=deudas_pagadas)
+                          deudas_pagadas=deudas_pagadas,
+                          total_pendiente=sum(d['saldo_pendiente'] for d in deudas_pendientes),
+                          cursor_pagadas=cursor_pagadas,
+                          siguiente_cursor_pagadas=siguiente_cursor_pagadas)
 
 # ============================================================================
 # RUTAS DE GESTIÓN DE PRODUCTOS
@@ -1464,8 +4567,7 @@ def actualizar_cantidad_temp(index):
 @login_required
 def registrar_deuda():
     """Registra una nueva deuda en el sistema"""
-    # Obtener clientes y productos
-    clientes = Cliente.query.all()
+    # Los clientes se buscan bajo demanda desde /api/clientes
     productos = Producto.query.options(db.joinedload(Producto.categoria)).all()
     
     # Crear formularios
@@ -1477,7 +4579,9 @@ def registrar_deuda():
     categorias = [cat[0] for cat in categorias]
     
     # Poblar opciones del formulario
-    deuda_form.cliente_id.choices = [(c.id, f"{c.nombre} ({c.cedula})") for c in clientes]
+    # Solo hace falta como opción válida el cliente enviado en el formulario
+    cliente_enviado = db.session.get(Cliente, deuda_form.cliente_id.data) if deuda_form.cliente_id.data else None
+    deuda_form.cliente_id.choices = [(cliente_enviado.id, f"{cliente_enviado.nombre} ({cliente_enviado.cedula})")] if cliente_enviado else []
     producto_form.producto_id.choices = [(p.id, p.nombre) for p in productos]
     
     # Inicializar lista de productos en sesión
@@ -1597,7 +4701,6 @@ def registrar_deuda():
                           producto_form=producto_form,
                           productos_deuda=productos_en_deuda,
                           total=total_deuda,
-                          clientes=clientes,  
                           productos=productos,  
                           categorias=categorias,
                           form=EmptyForm())
@@ -1605,67 +4708,90 @@ def registrar_deuda():
 @app.route('/consultar_deudas')
 @login_required
 def consultar_deudas():
-    """Muestra la lista de todas las deudas"""
+    """
+    Muestra la lista de deudas paginada por cursor (fecha desc, id desc)
+    
+    El filtro de búsqueda y el orden se resuelven en SQL; productos y pagos
+    se cargan con selectinload, por lo que cada página cuesta un número
+    fijo de consultas sin importar cuántas deudas existan.
+    """
     try:
         # Obtener parámetros de filtro
         estado_filtro = request.args.get('estado', 'todos')
         busqueda_filtro = request.args.get('busqueda', '').strip().lower()
-        
-        # Construir consulta base
-        query = Deuda.query
+        cursor = request.args.get('cursor', '')
+        por_pagina = min(max(request.args.get('por_pagina', 50, type=int), 1), 200)
+        
+        # Construir consulta base (el cliente se trae en el mismo JOIN)
+        query = Deuda.query.outerjoin(Cliente, Cliente.id == Deuda.cliente_id).options(
+            db.contains_eager(Deuda.cliente),
+            db.selectinload(Deuda.productos),
+            db.selectinload(Deuda.pagos)
+        )
         
         # Aplicar filtro de estado si no es 'todos'
         if estado_filtro != 'todos':
             query = query.filter(Deuda.estado == estado_filtro)
         
-        # Ejecutar consulta
-        deudas = query.all()
+        # Aplicar filtro de búsqueda flexible: cédula, nombre o ID. Solo
+        # prefijos e igualdades sobre columnas de deuda con índice (el cliente
+        # se resuelve en una subconsulta), así cada criterio es un rango del
+        # índice en lugar de recorrer las deudas por fecha
+        if busqueda_filtro:
+            patron = patron_prefijo(busqueda_filtro)
+            criterios_cliente = [Cliente.nombre.like(patron, escape='\\')]
+            identificacion = normalizar_identificacion(busqueda_filtro)
+            if identificacion:
+                criterios_cliente += [Cliente.cedula_normalizada == identificacion,
+                                      Cliente.rif_normalizado == identificacion]
+            criterios = [
+                Deuda.cliente_cedula.like(patron, escape='\\'),
+                Deuda.cliente_id.in_(select(Cliente.id).where(or_(*criterios_cliente)))
+            ]
+            if busqueda_filtro.isdigit():
+                criterios.append(Deuda.id == int(busqueda_filtro))
+            query = query.filter(or_(*criterios))
+        
+        # Continuar después del último registro de la página anterior
+        posicion = decodificar_cursor(cursor) if cursor else None
+        if posicion:
+            fecha_cursor, id_cursor = posicion
+            query = query.filter(or_(
+                Deuda.fecha < fecha_cursor,
+                and_(Deuda.fecha == fecha_cursor, Deuda.id < id_cursor)
+            ))
+        
+        # Se pide un registro extra para saber si hay página siguiente
+        deudas = query.order_by(Deuda.fecha.desc(), Deuda.id.desc()).limit(por_pagina + 1).all()
+        hay_siguiente = len(deudas) > por_pagina
+        deudas = deudas[:por_pagina]
         
         # Procesar deudas para obtener información adicional
         deudas_procesadas = []
         for deuda in deudas:
-            # Calcular total de la deuda - MODIFICADO: usar precio de ProductoDeuda en lugar de Producto
-            total = 0.0
-            for pd in deuda.productos:
-                # Usar el precio almacenado en ProductoDeuda (pd.precio) en lugar del precio actual del producto
-                total += pd.precio * pd.cantidad
-            
-            # Calcular saldo pendiente
-            saldo = total
-            for pago in deuda.pagos:
-                saldo -= pago.monto_usd
+            # Usar el precio almacenado en ProductoDeuda en lugar del precio actual del producto
+            total = sum(pd.precio * pd.cantidad for pd in deuda.productos)
+            saldo = total - sum(pago.monto_usd for pago in deuda.pagos)
             
-            # Obtener nombre del cliente
-            cliente_nombre = deuda.cliente.nombre if deuda.cliente else 'Cliente eliminado'
-            
-            # Aplicar filtro de búsqueda flexible
-            if busqueda_filtro:
-                # Buscar en cédula, nombre o ID
-                busqueda_coincide = (
-                    busqueda_filtro in deuda.cliente_cedula.lower() or
-                    busqueda_filtro in cliente_nombre.lower() or
-                    busqueda_filtro in str(deuda.id)
-                )
-                if not busqueda_coincide:
-                    continue
-                    
             deudas_procesadas.append({
                 'id': deuda.id,
                 'estado': deuda.estado,
                 'fecha': deuda.fecha,
-                'cliente_nombre': cliente_nombre,
+                'cliente_nombre': deuda.cliente.nombre if deuda.cliente else 'Cliente eliminado',
                 'cliente_cedula': deuda.cliente_cedula,
                 'cliente_id': deuda.cliente_id,
                 'total': total,
                 'saldo_pendiente': saldo
             })
         
-        # Ordenar por fecha descendente
-        deudas_procesadas.sort(key=lambda x: x['fecha'], reverse=True)
+        siguiente_cursor = None
+        if hay_siguiente and deudas:
+            siguiente_cursor = codificar_cursor(deudas[-1].fecha, deudas[-1].id)
         
         return render_template('consultar_deudas.html', deudas=deudas_procesadas, 
                                estado_filtro=estado_filtro, busqueda_filtro=busqueda_filtro,
-                               form=EmptyForm())
+                               cursor=cursor, siguiente_cursor=siguiente_cursor,
+                               por_pagina=por_pagina, form=EmptyForm())
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1691,9 +4817,9 @@ def detalle_deuda(deuda_id):
         subtotal_sin_iva = 0.0
 
         # Obtener la tasa de cambio más reciente
-        tasa_cambio_obj = TasaCambio.query.order_by(TasaCambio.fecha_actualizacion.desc()).first()
-        tasa_actual = tasa_cambio_obj.tasa if tasa_cambio_obj else 0
-        tasa_fecha = tasa_cambio_obj.fecha_actualizacion if tasa_cambio_obj else datetime.utcnow()
+        tasa_cambio_obj = tasa_cambio_vigente.obtener()
+        tasa_actual = tasa_cambio_obj['tasa'] if tasa_cambio_obj else 0
+        tasa_fecha = tasa_cambio_obj['fecha_actualizacion'] if tasa_cambio_obj else datetime.utcnow()
         
         for pd in deuda.productos:
             producto = Producto.query.get(pd.producto_id)
@@ -1716,19 +4842,26 @@ def detalle_deuda(deuda_id):
         iva = subtotal_sin_iva * 0.16
         total_con_iva = subtotal_sin_iva + iva
         
-        # Obtener pagos realizados
+        # Obtener pagos realizados, en bolívares a la tasa del día de cada pago
+        pagos = sorted(deuda.pagos, key=lambda p: p.fecha or datetime.min)
+        tasas_pago, montos_bs = historial_tasas.convertir([p.monto_usd for p in pagos], [p.fecha for p in pagos])
         pagos_realizados = []
         total_pagado = 0.0
-        for pago in deuda.pagos:
+        for pago, tasa_pago, monto_bs in zip(pagos, tasas_pago, montos_bs):
             total_pagado += pago.monto_usd
             pagos_realizados.append({
                 'fecha': pago.fecha,
                 'monto': pago.monto_usd,
+                'tasa': float(tasa_pago),
+                'monto_bs': float(monto_bs),
                 'descripcion': pago.descripcion or 'Pago parcial'
             })
         
         saldo_pendiente = total_con_iva - total_pagado
         
+        # Tasa del día en que se emitió la factura
+        tasa_factura = historial_tasas.tasa_en(deuda.fecha)
+        
         productos_por_pagina = 6  # Máximo 6 productos por página
         total_productos = len(productos_deuda)
         
@@ -1746,7 +4879,8 @@ def detalle_deuda(deuda_id):
                                  empresa=empresa,
                                  tasa_cambio=tasa_actual,
                                  tasa_cambio_obj=tasa_cambio_obj,  # Nuevo: objeto completo
-                                 tasa_cambio_fecha=tasa_fecha.strftime('%d/%m/%Y %H:%M'))
+                                 tasa_cambio_fecha=tasa_fecha.strftime('%d/%m/%Y %H:%M'),
+                                 tasa_factura=tasa_factura)
         else:
             # Paginación necesaria
             total_pages = (total_productos + productos_por_pagina - 1) // productos_por_pagina
@@ -1779,7 +4913,8 @@ def detalle_deuda(deuda_id):
                                  saldo_pendiente=saldo_pendiente,
                                  empresa=empresa,
                                  tasa_cambio=tasa_actual,
-                                 tasa_cambio_fecha=tasa_fecha.strftime('%d/%m/%Y %H:%M'))
+                                 tasa_cambio_fecha=tasa_fecha.strftime('%d/%m/%Y %H:%M'),
+                                 tasa_factura=tasa_factura)
                              
     except Exception as e:
         flash(f'Error al cargar el detalle de la deuda: {str(e)}', 'danger')
@@ -1875,7 +5010,9 @@ def marcar_pagada(id):
         id (int): ID de la deuda
     """
     deuda = Deuda.query.get_or_404(id)
-    deuda.estado = 'pagada'
+    if deuda.estado != 'pagada':
+        deuda.estado = 'pagada'
+        registrar_venta_deudas([deuda.id])
     db.session.commit()
     flash('Deuda marcada como pagada', 'success')
     return redirect(url_for('consultar_deudas'))
@@ -1891,6 +5028,10 @@ def eliminar_deuda(id):
     """
     deuda = Deuda.query.get_or_404(id)
     
+    # Descontar del acumulado diario si ya contaba como venta
+    if deuda.estado == 'pagada':
+        registrar_venta_deudas([deuda.id], signo=-1)
+    
     # Eliminar productos asociados y pagos
     ProductoDeuda.query.filter_by(deuda_id=id).delete()
     PagoParcial.query.filter_by(deuda_id=id).delete()
@@ -1912,27 +5053,24 @@ def registrar_pago_parcial(deuda_id):
         deuda_id (int): ID de la deuda
     """
     try:
-        deuda = Deuda.query.get_or_404(deuda_id)
+        # Bloquear la deuda antes de leer su saldo, igual que asignar_pago_cliente
+        deuda = Deuda.query.filter_by(id=deuda_id).populate_existing().with_for_update().first_or_404()
         
         # Obtener datos del formulario
         monto = float(request.form.get('monto'))
         descripcion = request.form.get('descripcion', 'Pago parcial')
         metodo_pago = request.form.get('metodo_pago', 'efectivo')
         
-        # Calcular saldo pendiente
-        total_productos = 0
-        for pd in deuda.productos:
-            producto = Producto.query.get(pd.producto_id)
-            if producto:
-                total_productos += producto.precio * pd.cantidad
-        
-        total_pagos = sum(p.monto_usd for p in deuda.pagos)
-        saldo_pendiente = total_productos - total_pagos
-        
         # Validaciones
-        if monto <= 0:
+        if not math.isfinite(monto) or monto <= 0:
             return jsonify({'success': False, 'message': 'El monto debe ser mayor a cero'})
         
+        # Saldo pendiente con los precios guardados en la deuda
+        saldo_pendiente = saldos_deudas_bloqueadas([deuda.id])[deuda.id]
+        if deuda.estado != 'pendiente' or saldo_pendiente <= 0.001:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'La deuda no tiene saldo pendiente'})
+        
         # Ajustar automáticamente al saldo pendiente si el monto es mayor
         monto_efectivo = min(monto, saldo_pendiente)
         
@@ -1955,6 +5093,7 @@ def registrar_pago_parcial(deuda_id):
         nuevo_saldo = saldo_pendiente - monto_efectivo
         if abs(nuevo_saldo) <= 0.001:  # Tolerancia mínima
             deuda.estado = 'pagada'
+            registrar_venta_deudas([deuda.id])
         
         db.session.commit()
         
@@ -1968,11 +5107,72 @@ def registrar_pago_parcial(deuda_id):
             'nuevo_saldo': max(0, nuevo_saldo)
         })
         
+    except HTTPException:
+        # get_or_404: la deuda no existe
+        raise
     except Exception as e:
         print(f"Error al registrar pago parcial: {e}")
         db.session.rollback()
         return jsonify({'success': False, 'message': 'Error interno al registrar el pago'})
 
+@app.route('/registrar_pago_cliente/<int:cliente_id>', methods=['POST'])
+@login_required
+def registrar_pago_cliente(cliente_id):
+    """
+    Registra un pago global de un cliente repartiéndolo entre sus deudas
+    pendientes, de la más antigua a la más reciente o en el orden de los
+    IDs recibidos en 'deuda_ids'
+    
+    Args:
+        cliente_id (int): ID del cliente
+    """
+    try:
+        cliente = Cliente.query.get_or_404(cliente_id)
+        
+        # Obtener datos del formulario
+        monto = float(request.form.get('monto'))
+        descripcion = request.form.get('descripcion', 'Abono')
+        metodo_pago = request.form.get('metodo_pago', 'efectivo')
+        deuda_ids = [int(i) for i in request.form.getlist('deuda_ids') if i.strip()]
+        
+        # float() acepta 'nan' e 'inf', que no son montos
+        if not math.isfinite(monto) or monto <= 0:
+            return jsonify({'success': False, 'message': 'El monto debe ser mayor a cero'})
+        
+        resultado = asignar_pago_cliente(
+            cliente.id, monto, f"{descripcion} - {metodo_pago}", deuda_ids or None)
+        
+        if not resultado['asignaciones']:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'El cliente no tiene saldo pendiente en las deudas indicadas'})
+        
+        db.session.commit()
+        
+        aplicado = sum(a['monto'] for a in resultado['asignaciones'])
+        saldadas = sum(1 for a in resultado['asignaciones'] if a['saldada'])
+        mensaje = f'Pago de ${aplicado:.2f} repartido en {len(resultado["asignaciones"])} deuda(s).'
+        if saldadas:
+            mensaje += f' {saldadas} deuda(s) completamente pagada(s).'
+        if resultado['sobrante'] > 0:
+            mensaje += f' Sobrante no aplicado: ${resultado["sobrante"]:.2f}.'
+        
+        return jsonify({
+            'success': True,
+            'message': mensaje,
+            'asignaciones': resultado['asignaciones'],
+            'sobrante': resultado['sobrante']
+        })
+        
+    except HTTPException:
+        # get_or_404: el cliente no existe
+        raise
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Monto o deudas no válidos'})
+    except Exception as e:
+        print(f"Error al registrar pago del cliente: {e}")
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Error interno al registrar el pago'})
+
 # ============================================================================
 # RUTAS DE GESTIÓN DE PEDIDOS
 # ============================================================================
@@ -1991,19 +5191,7 @@ def procesar_pedido(pedido_id):
     
     if accion == 'aceptar':
         # Convertir pedido en deuda
-        cliente = Cliente.query.filter_by(nombre=pedido.cliente_nombre).first()
-        
-        if not cliente:
-            # Crear nuevo cliente
-            cliente = Cliente(
-                nombre=pedido.cliente_nombre,
-                cedula='',
-                direccion=pedido.cliente_direccion,
-                telefono=pedido.cliente_telefono,
-                email=pedido.cliente_email
-            )
-            db.session.add(cliente)
-            db.session.flush()
+        cliente = obtener_o_crear_cliente_pedido(pedido)
         
         # Crear deuda
         deuda = Deuda(
@@ -2025,7 +5213,9 @@ def procesar_pedido(pedido_id):
             db.session.add(producto_deuda)
         
         # Cambiar estado del pedido
+        estado_anterior = pedido.estado
         pedido.estado = 'completado'
+        registrar_venta_pedido(pedido, estado_anterior)
         db.session.commit()
         
         flash('Pedido convertido en deuda exitosamente', 'success')
@@ -2038,6 +5228,11 @@ def procesar_pedido(pedido_id):
             producto = Producto.query.get(item.producto_id)
             producto.cantidad += item.cantidad
         
+        # Descontar del acumulado diario si ya contaba como venta
+        estado_anterior = pedido.estado
+        pedido.estado = 'cancelado'
+        registrar_venta_pedido(pedido, estado_anterior)
+        
         # Eliminar items y pedido
         ItemPedido.query.filter_by(pedido_id=pedido_id).delete()
         db.session.delete(pedido)
@@ -2093,7 +5288,9 @@ def editar_pedido(pedido_id):
             producto.cantidad -= cantidad
             
             # Actualizar total del pedido
+            total_anterior = pedido.total
             pedido.total = total + (producto.precio * cantidad)
+            registrar_cambio_lineas_pedido(pedido, total_anterior, producto.id, cantidad, producto.precio * cantidad)
             
             db.session.commit()
             
@@ -2134,7 +5331,9 @@ def actualizar_item_pedido(item_id):
     # Actualizar total del pedido
     pedido = Pedido.query.get(item.pedido_id)
     items = ItemPedido.query.filter_by(pedido_id=item.pedido_id).all()
+    total_anterior = pedido.total
     pedido.total = sum(item.precio * item.cantidad for item in items)
+    registrar_cambio_lineas_pedido(pedido, total_anterior, item.producto_id, diferencia, item.precio * diferencia)
     
     db.session.commit()
     
@@ -2163,7 +5362,9 @@ def eliminar_item_pedido(item_id):
     # Actualizar total del pedido
     pedido = Pedido.query.get(pedido_id)
     items = ItemPedido.query.filter_by(pedido_id=pedido_id).all()
+    total_anterior = pedido.total
     pedido.total = sum(item.precio * item.cantidad for item in items) if items else 0
+    registrar_cambio_lineas_pedido(pedido, total_anterior, item.producto_id, -item.cantidad, -item.precio * item.cantidad)
     
     db.session.commit()
     
@@ -2187,12 +5388,16 @@ def actualizar_precio_personalizado(item_id):
             return jsonify({'success': False, 'message': 'El precio debe ser mayor a cero'})
         
         # Actualizar precio
+        precio_anterior = item.precio
         item.precio = nuevo_precio
         
         # Recalcular total del pedido
         pedido = Pedido.query.get(item.pedido_id)
         items = ItemPedido.query.filter_by(pedido_id=pedido.id).all()
+        total_anterior = pedido.total
         pedido.total = sum(item.precio * item.cantidad for item in items)
+        registrar_cambio_lineas_pedido(pedido, total_anterior, item.producto_id, 0,
+                                       (nuevo_precio - precio_anterior) * item.cantidad)
         
         db.session.commit()
         
@@ -2223,7 +5428,9 @@ def eliminar_item_personalizado(item_id):
         # Actualizar total del pedido
         pedido = Pedido.query.get(pedido_id)
         items = ItemPedido.query.filter_by(pedido_id=pedido_id).all()
+        total_anterior = pedido.total
         pedido.total = sum(item.precio * item.cantidad for item in items) if items else 0
+        registrar_cambio_lineas_pedido(pedido, total_anterior, item.producto_id, -item.cantidad, -item.precio * item.cantidad)
         
         db.session.commit()
         
@@ -2269,23 +5476,12 @@ def cambiar_estado_pedido(pedido_id):
         
         estado_anterior = pedido.estado
         pedido.estado = nuevo_estado
+        registrar_venta_pedido(pedido, estado_anterior)
         
         # Si el pedido pasa a completado, crear deuda automáticamente
         if nuevo_estado == 'completado' and estado_anterior != 'completado':
             # Buscar o crear cliente
-            cliente = Cliente.query.filter_by(nombre=pedido.cliente_nombre).first()
-            
-            if not cliente:
-                # Crear nuevo cliente automáticamente
-                cliente = Cliente(
-                    nombre=pedido.cliente_nombre,
-                    cedula='',  # Se puede actualizar después
-                    direccion=pedido.cliente_direccion or '',
-                    telefono=pedido.cliente_telefono or '',
-                    email=pedido.cliente_email or ''
-                )
-                db.session.add(cliente)
-                db.session.flush()
+            cliente = obtener_o_crear_cliente_pedido(pedido)
             
             # Crear deuda
             deuda = Deuda(
@@ -2372,27 +5568,17 @@ def procesar_accion_pedido(pedido_id):
     try:
         pedido = Pedido.query.get_or_404(pedido_id)
         accion = request.form.get('accion')
+        estado_anterior = pedido.estado
         
         if accion == 'aceptar':
             pedido.estado = 'procesando'
+            registrar_venta_pedido(pedido, estado_anterior)
             db.session.commit()
             flash(f'Pedido #{pedido_id} marcado como procesando', 'info')
             
         elif accion == 'completar':
             # Buscar o crear cliente
-            cliente = Cliente.query.filter_by(nombre=pedido.cliente_nombre).first()
-            
-            if not cliente:
-                cliente = Cliente(
-                    nombre=pedido.cliente_nombre,
-                    cedula=pedido.cliente_cedula or '',
-                    rif=pedido.cliente_rif or '',
-                    direccion=pedido.cliente_direccion or '',
-                    telefono=pedido.cliente_telefono or '',
-                    email=pedido.cliente_email or ''
-                )
-                db.session.add(cliente)
-                db.session.flush()
+            cliente = obtener_o_crear_cliente_pedido(pedido)
             
             # Crear deuda
             deuda = Deuda(
@@ -2414,6 +5600,7 @@ def procesar_accion_pedido(pedido_id):
                 db.session.add(producto_deuda)
             
             pedido.estado = 'completado'
+            registrar_venta_pedido(pedido, estado_anterior)
             db.session.commit()
             flash(f'Pedido #{pedido_id} completado y convertido en deuda', 'success')
             
@@ -2426,11 +5613,13 @@ def procesar_accion_pedido(pedido_id):
                     producto.cantidad += item.cantidad
             
             pedido.estado = 'cancelado'
+            registrar_venta_pedido(pedido, estado_anterior)
             db.session.commit()
             flash(f'Pedido #{pedido_id} cancelado y stock restaurado', 'warning')
             
         elif accion == 'pendiente':
             pedido.estado = 'pendiente'
+            registrar_venta_pedido(pedido, estado_anterior)
             db.session.commit()
             flash(f'Pedido #{pedido_id} marcado como pendiente', 'info')
             
@@ -2750,16 +5939,14 @@ def verificar_identificacion():
             flash('Por favor ingrese su cédula o RIF', 'danger')
             return render_template('verificar_identificacion.html')
         
-        # Validar formato básico (V12345678 o J123456789)
-        if not (identificacion.startswith(('V', 'J', 'G', 'E', 'P')) and identificacion[1:].isdigit()):
+        # Validar formato básico (V12345678 o J123456789; se aceptan puntos y guiones)
+        identificacion = normalizar_identificacion(identificacion)
+        if not identificacion:
             flash('Formato de cédula/RIF inválido. Use V12345678 o J123456789', 'danger')
             return render_template('verificar_identificacion.html')
         
-        # Buscar cliente
-        cliente = Cliente.query.filter(
-            (Cliente.cedula == identificacion) | 
-            (Cliente.rif == identificacion)
-        ).first()
+        # Buscar cliente por cédula o RIF normalizado (índices únicos)
+        cliente = buscar_cliente_por_identificacion(identificacion)
         
         # Guardar en sesión
         session['cliente_identificacion'] = identificacion
@@ -2881,7 +6068,9 @@ def checkout():
                 identificacion = session.get('cliente_identificacion', '')
                 es_rif = identificacion.startswith(('J', 'G', 'E', 'P'))
                 
-                nuevo_cliente = Cliente(
+                # La verificación pudo venir de la caché de inexistentes de otro
+                # worker; si el cliente ya existe se usa ese
+                nuevo_cliente = crear_cliente(
                     nombre=form.nombre.data,
                     cedula=identificacion if not es_rif else '',
                     rif=identificacion if es_rif else '',
@@ -2889,8 +6078,6 @@ def checkout():
                     telefono=form.telefono.data,
                     email=form.email.data
                 )
-                db.session.add(nuevo_cliente)
-                db.session.flush()  # Para obtener el ID
                 cliente_id = nuevo_cliente.id
             
             pedido = Pedido(
@@ -2972,6 +6159,7 @@ def mi_cuenta():
     if not empresa:
         empresa = Empresa()
         db.session.add(empresa)
+        marcar_datos_globales_modificados()
         db.session.commit()
     
     # Obtener o crear configuración
@@ -2979,6 +6167,7 @@ def mi_cuenta():
     if not configuracion:
         configuracion = Configuracion()
         db.session.add(configuracion)
+        marcar_datos_globales_modificados()
         db.session.commit()
     
     form = EmpresaForm()
@@ -3010,6 +6199,7 @@ def mi_cuenta():
         empresa.twitter = form.twitter.data
         empresa.logo_url = form.logo_url.data
         
+        marcar_datos_globales_modificados()
         db.session.commit()
         flash('Información de la empresa actualizada correctamente', 'success')
         return redirect(url_for('mi_cuenta'))
@@ -3020,6 +6210,7 @@ def mi_cuenta():
         configuracion.hero_mensaje = config_form.hero_mensaje.data
         configuracion.tema = config_form.tema.data
         
+        marcar_datos_globales_modificados()
         db.session.commit()
         flash('Configuración del sitio actualizada correctamente', 'success')
         return redirect(url_for('mi_cuenta'))
@@ -3042,6 +6233,7 @@ def actualizar_configuracion():
     configuracion.hero_mensaje = request.form.get('hero_mensaje')
     configuracion.tema = request.form.get('tema')
     
+    marcar_datos_globales_modificados()
     db.session.commit()
     flash('Configuración del sitio actualizada correctamente', 'success')
     return redirect(url_for('mi_cuenta'))
@@ -3069,16 +6261,8 @@ def actualizar_tasa_manual():
         if not nueva_tasa or nueva_tasa <= 0:
             return jsonify({'success': False, 'message': 'La tasa debe ser mayor a cero'})
         
-        # Crear nueva entrada de tasa de cambio
-        tasa_cambio = TasaCambio(
-            tasa=float(nueva_tasa),
-            fuente='manual',
-            descripcion=descripcion,
-            fecha_actualizacion=datetime.utcnow()
-        )
-        
-        db.session.add(tasa_cambio)
-        db.session.commit()
+        # Crear nueva entrada de tasa de cambio y publicarla como vigente
+        tasa_cambio = registrar_tasa_cambio(nueva_tasa, fuente='manual', descripcion=descripcion)
         
         return jsonify({
             'success': True, 
@@ -3092,94 +6276,59 @@ def actualizar_tasa_manual():
         print(f"Error al actualizar tasa de cambio: {e}")
         return jsonify({'success': False, 'message': 'Error interno al actualizar la tasa'})
 
+@app.route('/actualizar_tasa_automatica', methods=['POST'])
+@login_required
+def actualizar_tasa_automatica_ahora():
+    """
+    Encola la consulta de las fuentes automáticas de tasa de cambio
+    Responde de inmediato; la tasa se guarda en segundo plano
+    """
+    if not fuentes_tasa_cambio:
+        return jsonify({'success': False, 'message': 'No hay fuentes automáticas configuradas'})
+    ejecutar_en_fondo(actualizar_tasa_automatica)
+    return jsonify({'success': True, 'message': 'Actualización de tasa iniciada'})
+
 @app.route('/api/ventas/diarias')
 @login_required
 def ventas_diarias():
     """
     API para obtener las ventas diarias de los últimos 7 días
-    Retorna los datos en formato JSON
+    Retorna los datos en formato JSON (días sin ventas en cero)
     """
-    from sqlalchemy import func, extract, and_
-    from datetime import datetime, timedelta
-    
-    # Últimos 7 días
-    fecha_inicio = datetime.now() - timedelta(days=7)
-    
-    ventas = db.session.query(
-        func.date(Pedido.fecha).label('fecha'),
-        func.sum(Pedido.total).label('total'),
-        func.count(Pedido.id).label('cantidad')
-    ).filter(
-        Pedido.fecha >= fecha_inicio,
-        Pedido.estado == 'completado'
-    ).group_by(func.date(Pedido.fecha)).all()
-    
     return jsonify([{
-        'fecha': v.fecha.strftime('%Y-%m-%d'),
-        'total': float(v.total or 0),
-        'cantidad': v.cantidad
-    } for v in ventas])
+        'fecha': v['inicio'].strftime('%Y-%m-%d'),
+        'total': v['total'],
+        'cantidad': v['cantidad']
+    } for v in serie_ventas('dia', 7, canal='pedido')])
 
 @app.route('/api/ventas/semanales')
 @login_required
 def ventas_semanales():
     """
-    API para obtener las ventas semanales de las últimas 8 semanas
-    Retorna los datos en formato JSON
+    API para obtener las ventas semanales (ISO, de lunes a domingo) de las
+    últimas 8 semanas
+    Retorna los datos en formato JSON (semanas sin ventas en cero)
     """
-    from sqlalchemy import func
-    from datetime import datetime, timedelta
-    
-    # Últimas 8 semanas
-    fecha_inicio = datetime.now() - timedelta(weeks=8)
-    
-    ventas = db.session.query(
-        func.yearweek(Pedido.fecha).label('semana'),
-        func.sum(Pedido.total).label('total'),
-        func.count(Pedido.id).label('cantidad')
-    ).filter(
-        Pedido.fecha >= fecha_inicio,
-        Pedido.estado == 'completado'
-    ).group_by(func.yearweek(Pedido.fecha)).all()
-    
     return jsonify([{
-        'semana': str(v.semana),
-        'total': float(v.total or 0),
-        'cantidad': v.cantidad
-    } for v in ventas])
+        'semana': '%d%02d' % v['inicio'].isocalendar()[:2],
+        'inicio': v['inicio'].strftime('%Y-%m-%d'),
+        'total': v['total'],
+        'cantidad': v['cantidad']
+    } for v in serie_ventas('semana', 8, canal='pedido')])
 
 @app.route('/api/ventas/mensuales')
 @login_required
 def ventas_mensuales():
     """
     API para obtener las ventas mensuales de los últimos 12 meses
-    Retorna los datos en formato JSON
+    Retorna los datos en formato JSON (meses sin ventas en cero)
     """
-    from sqlalchemy import func
-    from datetime import datetime, timedelta
-    
-    # Últimos 12 meses
-    fecha_inicio = datetime.now() - timedelta(days=365)
-    
-    ventas = db.session.query(
-        func.year(Pedido.fecha).label('año'),
-        func.month(Pedido.fecha).label('mes'),
-        func.sum(Pedido.total).label('total'),
-        func.count(Pedido.id).label('cantidad')
-    ).filter(
-        Pedido.fecha >= fecha_inicio,
-        Pedido.estado == 'completado'
-    ).group_by(
-        func.year(Pedido.fecha),
-        func.month(Pedido.fecha)
-    ).all()
-    
     return jsonify([{
-        'año': v.año,
-        'mes': v.mes,
-        'total': float(v.total or 0),
-        'cantidad': v.cantidad
-    } for v in ventas])
+        'año': v['inicio'].year,
+        'mes': v['inicio'].month,
+        'total': v['total'],
+        'cantidad': v['cantidad']
+    } for v in serie_ventas('mes', 12, canal='pedido')])
 
 @app.route('/api/ventas/resumen')
 @login_required
@@ -3190,62 +6339,15 @@ def api_ventas_resumen():
     """
     try:
         periodo = request.args.get('periodo', 'month')
-        print(f"Solicitando resumen para período: {periodo}")
-        
-        # Obtener rango de fechas para el período solicitado
-        inicio, fin = get_date_range(periodo)
-        print(f"Rango de fechas: {inicio} a {fin}")
-        
-        ventas_actual = calcular_ventas_periodo(inicio, fin)
-        print(f"Ventas actuales: {ventas_actual}")
-        
-        # Determinar período anterior para comparación
-        ventas_anterior = None
-        cambio = None
-        
-        if periodo == 'today':
-            inicio_anterior, fin_anterior = get_date_range('yesterday')
-            ventas_anterior = calcular_ventas_periodo(inicio_anterior, fin_anterior)
-        elif periodo == 'yesterday':
-            antier = inicio - timedelta(days=1)
-            ventas_anterior = calcular_ventas_periodo(antier, antier)
-        elif periodo == 'week':
-            inicio_anterior, fin_anterior = get_date_range('last_week')
-            ventas_anterior = calcular_ventas_periodo(inicio_anterior, fin_anterior)
-        elif periodo == 'last_week':
-            inicio_anterior = inicio - timedelta(weeks=1)
-            fin_anterior = fin - timedelta(weeks=1)
-            ventas_anterior = calcular_ventas_periodo(inicio_anterior, fin_anterior)
-        elif periodo == 'month':
-            inicio_anterior, fin_anterior = get_date_range('last_month')
-            ventas_anterior = calcular_ventas_periodo(inicio_anterior, fin_anterior)
-        elif periodo == 'last_month':
-            if inicio.month == 1:
-                inicio_anterior = inicio.replace(year=inicio.year-1, month=12, day=1)
-            else:
-                inicio_anterior = inicio.replace(month=inicio.month-1, day=1)
-            fin_anterior = inicio_anterior.replace(day=28) + timedelta(days=4)
-            fin_anterior = fin_anterior - timedelta(days=fin_anterior.day)
-            ventas_anterior = calcular_ventas_periodo(inicio_anterior, fin_anterior)
-        
-        print(f"Ventas anteriores: {ventas_anterior}")
-        
-        # Calcular cambio porcentual si hay datos del período anterior
-        if ventas_anterior and ventas_anterior['monto'] is not None:
-            if ventas_anterior['monto'] == 0:
-                if ventas_actual['monto'] > 0:
-                    cambio = 100  # De 0 a algún valor positivo
-                else:
-                    cambio = 0  # Ambos son 0
-            else:
-                cambio = ((ventas_actual['monto'] - ventas_anterior['monto']) / ventas_anterior['monto']) * 100
+        if periodo not in PERIODOS_DASHBOARD:
+            periodo = 'today'
         
-        print(f"Cambio porcentual: {cambio}")
+        ventas = obtener_resumen_ventas()[periodo]
         
         return jsonify({
-            'monto': ventas_actual['monto'],
-            'pedidos': ventas_actual['pedidos'],
-            'cambio': cambio,
+            'monto': ventas['monto'],
+            'pedidos': ventas['pedidos'],
+            'cambio': ventas['cambio'],
             'periodo': periodo
         })
         
@@ -3255,6 +6357,232 @@ def api_ventas_resumen():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/ventas/resumen_periodos')
+@login_required
+def api_ventas_resumen_periodos():
+    """
+    API con el resumen de ventas de todos los períodos del dashboard (hoy,
+    ayer, semana, semana pasada, mes y mes pasado) y su cambio porcentual
+    Retorna los datos en formato JSON
+    """
+    try:
+        return jsonify({'periodos': obtener_resumen_ventas()})
+    except Exception as e:
+        print(f"Error en api_ventas_resumen_periodos: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/productos/ranking')
+@login_required
+def api_ranking_productos():
+    """
+    API con los productos más vendidos en una ventana de tiempo
+    
+    Parámetros:
+        ventana: 7, 30, 90 o total (por defecto 30)
+        categoria: ID de categoría o 'sin_categoria' (opcional)
+        canal: pedido o deuda (opcional, por defecto ambos)
+        orden: unidades (por defecto) o monto
+        limite: Cantidad de productos (1-100, por defecto 10)
+    Retorna los datos en formato JSON
+    """
+    ventana = request.args.get('ventana', '30')
+    if ventana not in VENTANAS_RANKING:
+        return jsonify({'error': 'Ventana inválida, use 7, 30, 90 o total'}), 400
+    
+    categoria = request.args.get('categoria') or None
+    if categoria and categoria != 'sin_categoria':
+        if not categoria.isdigit():
+            return jsonify({'error': 'Categoría inválida'}), 400
+        categoria = int(categoria)
+    
+    canal = request.args.get('canal') if request.args.get('canal') in ('pedido', 'deuda') else None
+    orden = 'monto' if request.args.get('orden') == 'monto' else 'unidades'
+    limite = min(max(request.args.get('limite', 10, type=int), 1), 100)
+    
+    try:
+        productos = ranking_productos(ventana, categoria, canal, orden, limite)
+    except Exception as e:
+        print(f"Error en api_ranking_productos: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    return jsonify({'ventana': ventana, 'canal': canal, 'orden': orden, 'productos': productos})
+
+@app.route('/reportes/antiguedad_deudas')
+@login_required
+def reporte_antiguedad_deudas():
+    """
+    Reporte de antigüedad de saldos por cobrar por cliente
+    Con ?formato=csv descarga el mismo reporte en CSV
+    """
+    try:
+        reporte = cache_reportes.obtener('antiguedad_deudas', calcular_antiguedad_deudas)
+    except Exception as e:
+        print(f"Error al calcular antigüedad de deudas: {e}")
+        flash('Error al generar el reporte de antigüedad', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    if request.args.get('formato') == 'csv':
+        salida = StringIO()
+        writer = csv.writer(salida)
+        writer.writerow(['Cliente ID', 'Cliente', 'Cédula', 'Deudas', 'Corriente',
+                         '31-60 días', '61-90 días', 'Más de 90 días', 'Total'])
+        for c in reporte['clientes']:
+            writer.writerow([c['id'], c['nombre'], c['cedula'] or '', c['deudas'], c['corriente'],
+                             c['dias_30'], c['dias_60'], c['dias_90'], c['total']])
+        t = reporte['totales']
+        writer.writerow(['', 'TOTAL', '', t['deudas'], t['corriente'],
+                         t['dias_30'], t['dias_60'], t['dias_90'], t['total']])
+        
+        nombre_archivo = f"antiguedad_deudas_{reporte['generado'].strftime('%Y%m%d')}.csv"
+        return Response(salida.getvalue(), mimetype='text/csv',
+                        headers={'Content-Disposition': f'attachment; filename={nombre_archivo}'})
+    
+    return render_template('reporte_antiguedad.html', **reporte)
+
+def obtener_rango_estado_cuenta():
+    """
+    Lee el rango 'desde'/'hasta' (YYYY-MM-DD) de la petición
+    Por defecto: desde el primer día del mes actual hasta hoy
+    """
+    hoy = hoy_negocio()
+    try:
+        desde = datetime.strptime(request.values.get('desde', ''), '%Y-%m-%d').date()
+    except ValueError:
+        desde = hoy.replace(day=1)
+    try:
+        hasta = datetime.strptime(request.values.get('hasta', ''), '%Y-%m-%d').date()
+    except ValueError:
+        hasta = hoy
+    return desde, max(desde, hasta)
+
+@app.route('/estado_cuenta/<int:cliente_id>')
+@login_required
+def estado_cuenta_cliente(cliente_id):
+    """
+    Descarga el estado de cuenta en PDF de un cliente
+    
+    Args:
+        cliente_id (int): ID del cliente
+    """
+    cliente = Cliente.query.get_or_404(cliente_id)
+    desde, hasta = obtener_rango_estado_cuenta()
+    
+    try:
+        pdf = obtener_pdf_estado_cuenta(cliente, desde, hasta, Empresa.query.first())
+    except Exception as e:
+        print(f"Error al generar estado de cuenta: {e}")
+        flash('Error al generar el estado de cuenta', 'danger')
+        return redirect(url_for('gestion_deudas', cliente_id=cliente_id))
+    
+    return send_file(BytesIO(pdf), as_attachment=True, mimetype='application/pdf',
+                     download_name=f"estado_cuenta_{cliente.id}_{desde:%Y%m%d}_{hasta:%Y%m%d}.pdf")
+
+@app.route('/estados_cuenta/lote', methods=['GET', 'POST'])
+@login_required
+def lote_estados_cuenta_clientes():
+    """
+    GET: Consulta el progreso del último lote de estados de cuenta
+    POST: Inicia en segundo plano la generación para todos los clientes
+    con saldo pendiente
+    """
+    if request.method == 'POST':
+        desde, hasta = obtener_rango_estado_cuenta()
+        limite = datetime.utcnow() - timedelta(minutes=MINUTOS_LOTE_ABANDONADO)
+        en_proceso = LoteEstadosCuenta.query.filter(
+            LoteEstadosCuenta.estado == 'procesando', LoteEstadosCuenta.actualizado >= limite).first()
+        if en_proceso:
+            return jsonify({'success': False, 'message': 'Ya hay un lote en proceso'})
+        
+        lote = LoteEstadosCuenta(estado='procesando', fecha_inicio=desde, fecha_fin=hasta)
+        db.session.add(lote)
+        db.session.commit()
+        ejecutar_en_fondo(generar_lote_estados_cuenta, lote.id)
+        return jsonify({'success': True, 'message': 'Generación de estados de cuenta iniciada', 'id': lote.id})
+    
+    lote = LoteEstadosCuenta.query.order_by(LoteEstadosCuenta.id.desc()).first()
+    if not lote:
+        return jsonify({'estado': 'inactivo', 'procesados': 0, 'total': 0, 'fallidos': 0,
+                        'errores': [], 'error': None, 'descarga': None})
+    return jsonify({
+        'id': lote.id,
+        'estado': lote.estado,
+        'procesados': lote.procesados,
+        'total': lote.total,
+        'fallidos': lote.fallidos,
+        'errores': lote.errores.split('\n') if lote.errores else [],
+        'error': lote.error,
+        'descarga': url_for('descargar_lote_estados_cuenta', lote_id=lote.id) if lote.archivo else None
+    })
+
+@app.route('/estados_cuenta/lote/<int:lote_id>/descargar')
+@login_required
+def descargar_lote_estados_cuenta(lote_id):
+    """Descarga el ZIP de un lote de estados de cuenta desde el directorio compartido"""
+    lote = LoteEstadosCuenta.query.get_or_404(lote_id)
+    ruta = os.path.join(DIRECTORIO_ESTADOS_CUENTA, lote.archivo) if lote.archivo else None
+    if not ruta or not os.path.exists(ruta):
+        abort(404)
+    return send_file(ruta, as_attachment=True, download_name=lote.archivo)
+
+@app.route('/reportes/conciliacion', methods=['GET', 'POST'])
+@login_required
+def reporte_conciliacion():
+    """
+    Muestra las discrepancias de la última conciliación de saldos
+    POST: Ejecuta la conciliación en segundo plano
+    """
+    if request.method == 'POST':
+        ejecutar_en_fondo(conciliar_saldos)
+        flash('Conciliación iniciada. Recargue la página en unos segundos', 'info')
+        return redirect(url_for('reporte_conciliacion'))
+    
+    ultima = db.session.query(func.max(DiscrepanciaSaldo.ejecucion)).scalar()
+    discrepancias = []
+    if ultima:
+        discrepancias = db.session.query(DiscrepanciaSaldo, Cliente.nombre
+        ).outerjoin(Cliente, Cliente.id == DiscrepanciaSaldo.cliente_id
+        ).filter(DiscrepanciaSaldo.ejecucion == ultima
+        ).order_by(DiscrepanciaSaldo.tipo, DiscrepanciaSaldo.deuda_id).all()
+    
+    return render_template('reporte_conciliacion.html',
+                          ultima_ejecucion=ultima,
+                          discrepancias=discrepancias,
+                          form=EmptyForm())
+
+@app.route('/reportes/reposicion', methods=['GET', 'POST'])
+@login_required
+def reporte_reposicion():
+    """
+    Muestra las sugerencias de reposición precalculadas por producto
+    POST: Recalcula las sugerencias en segundo plano
+    """
+    if request.method == 'POST':
+        ejecutar_en_fondo(calcular_sugerencias_reposicion)
+        flash('Cálculo de reposición iniciado. Recargue la página en unos segundos', 'info')
+        return redirect(url_for('reporte_reposicion'))
+    
+    prioridad = case(
+        (SugerenciaReposicion.estado == 'agotado', 0),
+        (SugerenciaReposicion.estado == 'reordenar', 1),
+        (SugerenciaReposicion.estado == 'ok', 2),
+        else_=3
+    )
+    sugerencias = db.session.query(SugerenciaReposicion, Producto.nombre, Categoria.nombre
+    ).join(Producto, Producto.id == SugerenciaReposicion.producto_id
+    ).outerjoin(Categoria, Categoria.id == Producto.categoria_id
+    ).order_by(prioridad, SugerenciaReposicion.dias_cobertura, Producto.nombre).all()
+    
+    calculado = db.session.query(func.max(SugerenciaReposicion.calculado)).scalar()
+    
+    return render_template('reporte_reposicion.html',
+                          sugerencias=sugerencias,
+                          calculado=calculado,
+                          tiempo_entrega=TIEMPO_ENTREGA_DIAS,
+                          dias_revision=DIAS_REVISION_INVENTARIO,
+                          form=EmptyForm())
+
 @app.route('/generar_pdf_pedido/<int:pedido_id>')
 @login_required
 def generar_pdf_pedido(pedido_id):
@@ -3304,9 +6632,9 @@ def generar_pdf_pedido(pedido_id):
     
     # Obtener información de empresa y tasa de cambio
     empresa = Empresa.query.first()
-    tasa_cambio_obj = TasaCambio.query.order_by(TasaCambio.fecha_actualizacion.desc()).first()
-    tasa_cambio = tasa_cambio_obj.tasa if tasa_cambio_obj else 50.0
-    tasa_cambio_fecha = tasa_cambio_obj.fecha_actualizacion.strftime('%d/%m/%Y') if tasa_cambio_obj else 'No disponible'
+    tasa_cambio_obj = tasa_cambio_vigente.obtener()
+    tasa_cambio = tasa_cambio_obj['tasa'] if tasa_cambio_obj else 50.0
+    tasa_cambio_fecha = tasa_cambio_obj['fecha_actualizacion'].strftime('%d/%m/%Y') if tasa_cambio_obj else 'No disponible'
     
     # Crear cliente ficticio para el template (ya que los pedidos no tienen cliente asociado)
     cliente = {
@@ -3328,10 +6656,124 @@ def generar_pdf_pedido(pedido_id):
                           tasa_cambio_fecha=tasa_cambio_fecha,
                           tasa_cambio_obj=tasa_cambio_obj)
 
+@app.route('/exportar')
+@login_required
+def exportar_datos():
+    """
+    Página para descargar los datos crudos de pedidos, deudas y pagos
+    """
+    return render_template('exportar_datos.html',
+                          entidades=list(EXPORTACIONES),
+                          parquet_disponible=pa is not None)
+
+@app.route('/exportar/descargar')
+@login_required
+def exportar_datos_descarga():
+    """
+    Descarga una tabla completa en CSV (transmitido por partes) o Parquet
+    
+    Parámetros:
+        entidad: pedidos, items_pedido, deudas, productos_deuda o pagos
+        formato: csv (por defecto) o parquet (requiere pyarrow; si no está, csv)
+        desde, hasta: Rango de días locales (YYYY-MM-DD), opcional
+    """
+    entidad = request.args.get('entidad', '')
+    if entidad not in EXPORTACIONES:
+        abort(404)
+    
+    try:
+        desde = datetime.strptime(request.args['desde'], '%Y-%m-%d').date() if request.args.get('desde') else None
+        hasta = datetime.strptime(request.args['hasta'], '%Y-%m-%d').date() if request.args.get('hasta') else None
+    except ValueError:
+        flash('Fecha inválida, use el formato AAAA-MM-DD', 'danger')
+        return redirect(url_for('exportar_datos'))
+    
+    consulta, columnas = consulta_exportacion(entidad, desde, hasta)
+    sufijo = ''.join(f"_{f.strftime('%Y%m%d')}" for f in (desde, hasta) if f)
+    
+    if request.args.get('formato') == 'parquet' and pa is not None:
+        # ParquetWriter necesita un archivo: se escribe en disco por lotes y se envía
+        archivo = tempfile.TemporaryFile()
+        try:
+            escribir_parquet_exportacion(consulta, columnas, archivo)
+        except Exception as e:
+            archivo.close()
+            print(f"Error al exportar {entidad} en Parquet: {e}")
+            flash('Error al generar la exportación', 'danger')
+            return redirect(url_for('exportar_datos'))
+        archivo.seek(0)
+        return send_file(archivo, mimetype='application/vnd.apache.parquet',
+                        as_attachment=True, download_name=f'{entidad}{sufijo}.parquet')
+    
+    return Response(stream_with_context(generar_csv_exportacion(consulta, columnas)),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={entidad}{sufijo}.csv'})
+
+# ============================================================================
+# TAREAS PROGRAMADAS
+# ============================================================================
+
+def ejecutar_con_contexto(funcion):
+    """Envuelve una tarea programada para que corra dentro del contexto de la app"""
+    def tarea():
+        with app.app_context():
+            try:
+                funcion()
+            except Exception as e:
+                print(f"Error en tarea programada {funcion.__name__}: {e}")
+    tarea.__name__ = funcion.__name__
+    return tarea
+
+# Las tareas no se inician al importar el módulo (workers de gunicorn, scripts de
+# mantenimiento). Se ejecutan en un proceso dedicado con `flask --app app programador`
+# (proceso "programador" del Procfile) o, en una instalación de un solo proceso,
+# con SCHEDULER_ACTIVO=1.
+scheduler = BackgroundScheduler(daemon=True)
+scheduler.add_job(ejecutar_con_contexto(conciliar_saldos), 'cron', hour=3, minute=0,
+                  id='conciliar_saldos', coalesce=True, max_instances=1)
+# Absorbe ediciones de pedidos ya completados que no pasan por un cambio de estado
+scheduler.add_job(ejecutar_con_contexto(reconstruir_ventas_diarias), 'cron', hour=3, minute=30,
+                  id='reconstruir_ventas_diarias', coalesce=True, max_instances=1)
+scheduler.add_job(ejecutar_con_contexto(calcular_sugerencias_reposicion), 'cron', hour=4, minute=0,
+                  id='calcular_sugerencias_reposicion', coalesce=True, max_instances=1)
+if fuentes_tasa_cambio:
+    scheduler.add_job(ejecutar_con_contexto(actualizar_tasa_automatica), 'interval',
+                      minutes=int(os.environ.get('TASA_CAMBIO_INTERVALO_MINUTOS', 60)),
+                      id='actualizar_tasa_automatica', coalesce=True, max_instances=1,
+                      next_run_time=datetime.now())
+
+def iniciar_programador():
+    """Inicia las tareas programadas en este proceso (una sola vez)"""
+    if not scheduler.running:
+        scheduler.start()
+        atexit.register(lambda: scheduler.shutdown(wait=False))
+
+@app.cli.command('programador')
+def programador_command():
+    """Ejecuta las tareas programadas en primer plano (proceso dedicado)"""
+    iniciar_programador()
+    print("Tareas programadas en ejecución; Ctrl+C para detener")
+    try:
+        while True:
+            sleep(3600)
+    except (KeyboardInterrupt, SystemExit):
+        scheduler.shutdown(wait=False)
+
+if os.environ.get('SCHEDULER_ACTIVO', '0') == '1':
+    iniciar_programador()
+
 # ============================================================================
 # INICIO DE LA APLICACIÓN
 # ============================================================================
 
+# Se ejecuta al importar el módulo (también bajo gunicorn)
+with app.app_context():
+    try:
+        inicializar_datos_globales()
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al inicializar configuración: {e}")
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,22 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, db
+
+def crear_indices():
+    """
+    Crea en las tablas existentes los índices declarados en los modelos.
+    db.create_all() no agrega índices a tablas que ya existen.
+    """
+    with app.app_context():
+        for tabla in db.metadata.sorted_tables:
+            for indice in tabla.indexes:
+                try:
+                    indice.create(db.engine, checkfirst=True)
+                    print(f"Índice {indice.name} verificado/creado")
+                except Exception as e:
+                    print(f"Error al crear índice {indice.name}: {e}")
+
+if __name__ == '__main__':
+    crear_indices()
@@ -0,0 +1,21 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, db, VentaDiaria, VentaProductoDiaria, reconstruir_ventas_diarias
+
+def main():
+    """
+    Crea las tablas de acumulados de ventas si no existen y las llena con el historial
+    de pedidos completados y deudas pagadas.
+    """
+    with app.app_context():
+        VentaDiaria.__table__.create(db.engine, checkfirst=True)
+        VentaProductoDiaria.__table__.create(db.engine, checkfirst=True)
+        try:
+            reconstruir_ventas_diarias()
+        except Exception as e:
+            print(f"Error al reconstruir ventas diarias: {e}")
+
+if __name__ == '__main__':
+    main()
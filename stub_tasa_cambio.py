@@ -0,0 +1,58 @@
+import argparse
+import json
+import random
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+def crear_manejador(tasa, fallos, demora):
+    """
+    Crea el manejador HTTP del servidor de prueba
+
+    Args:
+        tasa (float): Tasa base que se responde (con una pequeña variación)
+        fallos (float): Proporción de respuestas 500 (0 a 1)
+        demora (float): Segundos de espera antes de responder
+    """
+    class ManejadorTasa(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if demora:
+                time.sleep(demora)
+            if random.random() < fallos:
+                self.send_response(500)
+                self.end_headers()
+                return
+
+            cuerpo = json.dumps({
+                'tasa': round(tasa * random.uniform(0.995, 1.005), 4),
+                'fecha': datetime.utcnow().isoformat()
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+    return ManejadorTasa
+
+def main():
+    """
+    Servidor local que simula una fuente de tasa de cambio para pruebas.
+    Usar con: TASA_CAMBIO_FUENTES="stub|http://127.0.0.1:8765/tasa|tasa"
+    """
+    parser = argparse.ArgumentParser(description='Fuente de tasa de cambio de prueba')
+    parser.add_argument('--puerto', type=int, default=8765)
+    parser.add_argument('--tasa', type=float, default=36.5)
+    parser.add_argument('--fallos', type=float, default=0.0, help='Proporción de respuestas con error (0 a 1)')
+    parser.add_argument('--demora', type=float, default=0.0, help='Segundos de espera por respuesta')
+    args = parser.parse_args()
+
+    servidor = HTTPServer(('127.0.0.1', args.puerto), crear_manejador(args.tasa, args.fallos, args.demora))
+    print(f"Fuente de tasa de prueba en http://127.0.0.1:{args.puerto}/tasa")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        servidor.server_close()
+
+if __name__ == '__main__':
+    main()
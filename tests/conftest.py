@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# La app se configura al importarse: usar una base SQLite temporal y sin tareas programadas
+_directorio = tempfile.mkdtemp()
+os.environ['MYSQL_PUBLIC_URL'] = f"sqlite:///{os.path.join(_directorio, 'pruebas.db')}"
+os.environ['SCHEDULER_ACTIVO'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as modulo_app
+
+
+@pytest.fixture
+def app_ctx():
+    """Contexto de la app con las tablas recién creadas"""
+    app = modulo_app.app
+    app.config['TESTING'] = True
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        modulo_app.db.drop_all()
+        modulo_app.db.create_all()
+        yield app
+        modulo_app.db.session.remove()
@@ -0,0 +1,91 @@
+import io
+
+import app as modulo_app
+from app import db, Cliente
+
+
+def _importar(contenido):
+    return modulo_app.importar_clientes(io.BytesIO(contenido.encode('utf-8')), 'clientes.csv')
+
+
+def test_busca_por_cedula_o_rif_normalizados(app_ctx):
+    """Un cliente con cédula y RIF se encuentra por cualquiera de los dos, escritos de cualquier forma"""
+    db.session.add(Cliente(nombre='Ana', cedula='v-12.345.678', rif='J-30123456-7'))
+    db.session.commit()
+    modulo_app.cache_identificaciones_inexistentes.invalidar()
+
+    assert modulo_app.buscar_cliente_por_identificacion('V12345678').nombre == 'Ana'
+    assert modulo_app.buscar_cliente_por_identificacion('j 301234567').nombre == 'Ana'
+    assert modulo_app.buscar_cliente_por_identificacion('V999') is None
+
+
+def test_editar_rif_actualiza_su_columna_normalizada(app_ctx):
+    """Cambiar el RIF recalcula solo su valor normalizado"""
+    cliente = Cliente(nombre='Ana', cedula='V-1', rif='J-1')
+    db.session.add(cliente)
+    db.session.commit()
+
+    cliente.rif = 'j-2'
+    db.session.commit()
+    assert (cliente.cedula_normalizada, cliente.rif_normalizado) == ('V1', 'J2')
+
+
+def test_importacion_actualiza_al_cliente_encontrado_por_rif(app_ctx):
+    """Una fila solo con RIF actualiza al cliente registrado con cédula y ese RIF"""
+    db.session.add(Cliente(nombre='Ana', cedula='V-1', rif='J-1', telefono='0412'))
+    db.session.commit()
+
+    resumen = _importar('nombre,rif,email\nAna Pérez,J-1,ana@correo.com\nLuis,J-2,\n')
+
+    assert resumen['total_errores'] == 0
+    assert Cliente.query.count() == 2
+    ana = Cliente.query.filter_by(rif_normalizado='J1').one()
+    assert (ana.nombre, ana.cedula, ana.telefono, ana.email) == ('Ana Pérez', 'V-1', '0412', 'ana@correo.com')
+    assert Cliente.query.filter_by(rif_normalizado='J2').one().cedula_normalizada is None
+
+
+def test_importacion_informa_filas_en_conflicto(app_ctx):
+    """Las filas cuya cédula y RIF apuntan a clientes distintos, o a otro RIF, no se guardan"""
+    db.session.add_all([Cliente(nombre='Ana', cedula='V-1', rif='J-1'), Cliente(nombre='Luis', cedula='V-2')])
+    db.session.commit()
+
+    resumen = _importar('nombre,cedula,rif\nMezcla,V-2,J-1\nOtro RIF,V-1,J-9\nNuevo,V-3,J-3\n')
+
+    assert resumen['guardadas'] == 1
+    assert [numero for numero, _ in resumen['errores']] == [2, 3]
+    assert Cliente.query.filter_by(cedula_normalizada='V2').one().nombre == 'Luis'
+    assert Cliente.query.filter_by(cedula_normalizada='V1').one().rif_normalizado == 'J1'
+    assert Cliente.query.count() == 3
+
+
+def _cliente_de_otro_worker(cedula):
+    """Inserta sin pasar por la ORM, como otro proceso: la caché de inexistentes de este no se entera"""
+    db.session.execute(Cliente.__table__.insert().values(
+        nombre='Ana', cedula=cedula, cedula_normalizada=modulo_app.normalizar_identificacion(cedula)))
+    db.session.commit()
+
+
+def test_crear_pedido_ignora_la_cache_de_inexistentes(app_ctx):
+    """Un "no existe" en caché no provoca un cliente duplicado al convertir un pedido"""
+    modulo_app.cache_identificaciones_inexistentes.invalidar()
+    assert modulo_app.buscar_cliente_por_identificacion('V-1') is None
+    _cliente_de_otro_worker('V-1')
+
+    pedido = modulo_app.Pedido(cliente_nombre='Ana María', cliente_cedula='V-1')
+    cliente = modulo_app.obtener_o_crear_cliente_pedido(pedido)
+
+    assert cliente.nombre == 'Ana'
+    assert Cliente.query.count() == 1
+
+
+def test_crear_cliente_devuelve_el_existente_si_choca_el_indice(app_ctx):
+    """Si otro proceso creó la misma cédula, se deshace solo el savepoint y se usa ese cliente"""
+    _cliente_de_otro_worker('V-2')
+    otro = Cliente(nombre='Luis', cedula='V-3')
+    db.session.add(otro)
+
+    cliente = modulo_app.crear_cliente(nombre='Ana María', cedula='v.2', rif='')
+
+    assert cliente.nombre == 'Ana'
+    db.session.commit()
+    assert Cliente.query.count() == 2
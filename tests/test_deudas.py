@@ -0,0 +1,30 @@
+from werkzeug.security import generate_password_hash
+
+from app import db, Cliente, Deuda, Usuario
+
+
+def test_busqueda_de_deudas_por_prefijo_e_identificacion(app_ctx):
+    """La búsqueda encuentra por inicio del nombre, cédula o RIF normalizados e ID exacto"""
+    db.session.add(Usuario(username='admin', password=generate_password_hash('clave', method='pbkdf2:sha256:1000')))
+    ana = Cliente(nombre='Ana Torres', cedula='V-12.345.678', rif='J-40111222-3')
+    luis = Cliente(nombre='Luis Ana', cedula='V-999')
+    db.session.add_all([ana, luis])
+    db.session.flush()
+    deuda_ana = Deuda(cliente_id=ana.id, cliente_cedula=ana.cedula)
+    deuda_luis = Deuda(cliente_id=luis.id, cliente_cedula=luis.cedula)
+    db.session.add_all([deuda_ana, deuda_luis])
+    db.session.commit()
+
+    web = app_ctx.test_client()
+    web.post('/login', data={'username': 'admin', 'password': 'clave'})
+
+    def encontrados(busqueda):
+        html = web.get('/consultar_deudas', query_string={'busqueda': busqueda}).get_data(as_text=True)
+        return {nombre for nombre in ('Ana Torres', 'Luis Ana') if nombre in html}
+
+    assert encontrados('ana') == {'Ana Torres'}
+    assert encontrados('V12345678') == {'Ana Torres'}
+    assert encontrados('j-40111222-3') == {'Ana Torres'}
+    assert encontrados('V-99') == {'Luis Ana'}
+    assert encontrados(str(deuda_luis.id)) == {'Luis Ana'}
+    assert encontrados('100%') == set()
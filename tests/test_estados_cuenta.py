@@ -0,0 +1,80 @@
+import zipfile
+from datetime import timedelta
+
+from werkzeug.security import generate_password_hash
+
+import app as modulo_app
+from app import db, Cliente, Deuda, Empresa, LoteEstadosCuenta, PagoParcial, Producto, ProductoDeuda, Usuario
+
+
+def _cliente_con_deuda(nombre, descripcion_pago):
+    producto = Producto(nombre='Producto', precio=30.0, cantidad=10)
+    cliente = Cliente(nombre=nombre, cedula=None)
+    db.session.add_all([producto, cliente])
+    db.session.flush()
+    deuda = Deuda(cliente_id=cliente.id, estado='pendiente')
+    db.session.add(deuda)
+    db.session.flush()
+    db.session.add(ProductoDeuda(deuda_id=deuda.id, producto_id=producto.id, cantidad=1, precio=30.0))
+    db.session.add(PagoParcial(deuda_id=deuda.id, monto_usd=10.0, descripcion=descripcion_pago))
+    db.session.commit()
+    return cliente
+
+
+def _rango():
+    hoy = modulo_app.hoy_negocio()
+    return hoy - timedelta(days=30), hoy + timedelta(days=1)
+
+
+def test_pdf_escapa_el_texto_de_los_usuarios(app_ctx):
+    """Descripciones y nombres con '<' o '&' no se interpretan como marcado de reportlab"""
+    db.session.add(Empresa(nombre='Ferretería <Sur> & Cía', rif='J-1', direccion='Calle </i>'))
+    cliente = _cliente_con_deuda('Ana <b>Torres & hijos', '<b>abono & </i>')
+
+    estado = modulo_app.obtener_estado_cuenta(cliente.id, *_rango())
+    pdf = modulo_app.generar_pdf_estado_cuenta(cliente, estado, Empresa.query.first())
+
+    assert pdf.startswith(b'%PDF')
+
+
+def test_lote_continua_si_falla_un_cliente(app_ctx, monkeypatch, tmp_path):
+    """El error de un cliente queda en errores.txt y los demás PDFs se generan"""
+    monkeypatch.setattr(modulo_app, 'DIRECTORIO_ESTADOS_CUENTA', str(tmp_path))
+    ana = _cliente_con_deuda('Ana', 'Abono')
+    luis = _cliente_con_deuda('Luis', 'Abono')
+    generar = modulo_app.obtener_pdf_estado_cuenta
+
+    def fallar_con_luis(cliente, *args):
+        if cliente.id == luis.id:
+            raise ValueError('PDF inválido')
+        return generar(cliente, *args)
+
+    monkeypatch.setattr(modulo_app, 'obtener_pdf_estado_cuenta', fallar_con_luis)
+    lote = LoteEstadosCuenta(fecha_inicio=_rango()[0], fecha_fin=_rango()[1])
+    db.session.add(lote)
+    db.session.commit()
+    lote_id = lote.id
+    modulo_app.generar_lote_estados_cuenta(lote_id)
+
+    lote = db.session.get(LoteEstadosCuenta, lote_id)
+    assert (lote.estado, lote.procesados, lote.fallidos) == ('completado', 2, 1)
+    with zipfile.ZipFile(tmp_path / lote.archivo) as archivo_zip:
+        assert sorted(archivo_zip.namelist()) == ['errores.txt', f'estado_cuenta_{ana.id}.pdf']
+        assert 'PDF inválido' in archivo_zip.read('errores.txt').decode('utf-8')
+
+
+def test_estado_y_descarga_del_lote_salen_de_la_base(app_ctx, monkeypatch, tmp_path):
+    """Cualquier worker informa el lote y sirve su ZIP a partir de la fila, sin estado en memoria"""
+    monkeypatch.setattr(modulo_app, 'DIRECTORIO_ESTADOS_CUENTA', str(tmp_path))
+    (tmp_path / 'estados_cuenta_1.zip').write_bytes(b'zip')
+    db.session.add(Usuario(username='admin', password=generate_password_hash('clave', method='pbkdf2:sha256:1000')))
+    db.session.add(LoteEstadosCuenta(id=1, estado='completado', fecha_inicio=_rango()[0], fecha_fin=_rango()[1],
+                                     procesados=3, total=3, archivo='estados_cuenta_1.zip'))
+    db.session.commit()
+    web = app_ctx.test_client()
+    web.post('/login', data={'username': 'admin', 'password': 'clave'})
+
+    estado = web.get('/estados_cuenta/lote').get_json()
+    assert (estado['estado'], estado['procesados'], estado['total']) == ('completado', 3, 3)
+    assert web.get(estado['descarga']).data == b'zip'
+    assert web.get('/estados_cuenta/lote/2/descargar').status_code == 404
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+import app as modulo_app
+
+
+def test_primera_operacion_registrar_no_oculta_tasas_anteriores(app_ctx, monkeypatch):
+    """Si el worker registra una tasa antes de leer el historial, las tasas viejas se siguen cargando"""
+    ahora = datetime.utcnow()
+    for dias, tasa in ((60, 30.0), (30, 35.0)):
+        modulo_app.db.session.add(modulo_app.TasaCambio(tasa=tasa, fecha_actualizacion=ahora - timedelta(days=dias)))
+    modulo_app.db.session.commit()
+    monkeypatch.setattr(modulo_app, 'historial_tasas', modulo_app.HistorialTasas())
+
+    modulo_app.registrar_tasa_cambio(50.0)
+
+    historial = modulo_app.historial_tasas
+    assert historial.tasa_en(ahora - timedelta(days=45)) == 30.0
+    assert historial.tasa_en(ahora - timedelta(days=10)) == 35.0
+    assert historial.tasa_en(ahora + timedelta(seconds=1)) == 50.0
+
+
+def test_registrar_con_historial_cargado_agrega_sin_recargar(app_ctx, monkeypatch):
+    """Con el historial ya cargado, la tasa nueva se agrega directamente"""
+    ahora = datetime.utcnow()
+    modulo_app.db.session.add(modulo_app.TasaCambio(tasa=30.0, fecha_actualizacion=ahora - timedelta(days=5)))
+    modulo_app.db.session.commit()
+    monkeypatch.setattr(modulo_app, 'historial_tasas', modulo_app.HistorialTasas())
+    historial = modulo_app.historial_tasas
+    assert historial.tasa_en(ahora) == 30.0
+
+    modulo_app.registrar_tasa_cambio(40.0)
+
+    tasas, montos = historial.convertir([1.0, 2.0], [ahora - timedelta(days=1), ahora + timedelta(seconds=1)])
+    assert list(tasas) == [30.0, 40.0]
+    assert list(montos) == [30.0, 80.0]
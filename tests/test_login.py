@@ -0,0 +1,143 @@
+import threading
+import time
+
+import flask
+
+from werkzeug.security import generate_password_hash
+
+import app as modulo_app
+
+
+def _crear_usuario(username, password):
+    usuario = modulo_app.Usuario(username=username, password=generate_password_hash(password, method='pbkdf2:sha256:1000'))
+    modulo_app.db.session.add(usuario)
+    modulo_app.db.session.commit()
+
+
+def _limitadores_nuevos(monkeypatch):
+    almacen = modulo_app.AlmacenLocal(max_claves=100)
+    monkeypatch.setattr(modulo_app, 'limitador_login_ip', modulo_app.LimitadorTokens(
+        capacidad=100, tasa=1 / 6, almacen=almacen, prefijo='login_ip:'))
+    monkeypatch.setattr(modulo_app, 'limitador_login_usuario', modulo_app.LimitadorTokens(
+        capacidad=5, tasa=1 / 60, almacen=almacen, prefijo='login_usuario:'))
+    monkeypatch.setattr(modulo_app, 'limitador_login_dispositivo', modulo_app.LimitadorTokens(
+        capacidad=5, tasa=1 / 60, almacen=almacen, prefijo='login_dispositivo:'))
+    monkeypatch.setattr(modulo_app, 'dispositivos_confiables_login', modulo_app.CacheTTL(ttl_segundos=60))
+
+
+def _pedir(cliente, ruta):
+    """GET como petición nueva: el contexto de la prueba conserva el usuario cargado en g"""
+    flask.g.pop('_login_user', None)
+    return cliente.get(ruta)
+
+
+def _intentar(cliente, password, ip, reenviada=None):
+    cabeceras = {'X-Forwarded-For': reenviada or ip}
+    return cliente.post('/login', data={'username': 'admin', 'password': password}, headers=cabeceras)
+
+
+def test_x_forwarded_for_falsificado_no_evade_el_limite(app_ctx, monkeypatch):
+    """Solo cuenta la entrada que agregó el proxy confiable, no las que envía el cliente"""
+    _limitadores_nuevos(monkeypatch)
+    monkeypatch.setattr(modulo_app.limitador_login_ip, 'capacidad', 3)
+    cliente = app_ctx.test_client()
+
+    codigos = [_intentar(cliente, 'x', None, f'1.1.1.{i}, 10.0.0.66').status_code for i in range(4)]
+    assert codigos[-1] == 429
+
+
+def test_rotar_ips_no_evade_el_limite_por_usuario(app_ctx, monkeypatch):
+    """Los fallos contra una cuenta se cuentan juntos aunque cada intento venga de otra IP"""
+    _limitadores_nuevos(monkeypatch)
+    _crear_usuario('admin', 'correcta')
+    cliente = app_ctx.test_client()
+
+    codigos = [_intentar(cliente, 'incorrecta', f'10.0.1.{i}').status_code for i in range(6)]
+    assert codigos[:5] == [200] * 5
+    assert codigos[5] == 429
+
+
+def test_fallos_ajenos_no_bloquean_los_equipos_del_usuario(app_ctx, monkeypatch):
+    """Quien agota la cubeta del usuario desde otras IPs no impide entrar desde una IP ya usada"""
+    _limitadores_nuevos(monkeypatch)
+    _crear_usuario('admin', 'correcta')
+    cliente = app_ctx.test_client()
+    assert _intentar(cliente, 'correcta', '10.0.0.7').status_code == 302
+    cliente.get('/logout')
+
+    for i in range(6):
+        _intentar(cliente, 'incorrecta', f'10.0.1.{i}')
+    assert _intentar(cliente, 'correcta', '10.0.0.8').status_code == 429
+
+    assert _intentar(cliente, 'correcta', '10.0.0.7').status_code == 302
+
+
+def test_aciertos_no_consumen_la_cubeta_del_usuario(app_ctx, monkeypatch):
+    """Solo los intentos fallidos gastan tokens de la cubeta por usuario"""
+    _limitadores_nuevos(monkeypatch)
+    _crear_usuario('admin', 'correcta')
+    cliente = app_ctx.test_client()
+
+    for _ in range(8):
+        assert _intentar(cliente, 'correcta', '10.0.0.7').status_code == 302
+
+
+def test_cupo_de_hash_se_libera_al_terminar_el_calculo(monkeypatch):
+    """Dejar de esperar un hash no libera su cupo mientras el cálculo sigue en curso"""
+    monkeypatch.setattr(modulo_app, 'cupos_hash', threading.BoundedSemaphore(1))
+    terminar = threading.Event()
+
+    assert modulo_app.ejecutar_hash(terminar.wait, 5, espera=0.01) is None
+    assert modulo_app.ejecutar_hash(lambda: 'ok', espera=0.01) is None
+
+    terminar.set()
+    for _ in range(100):
+        if modulo_app.ejecutar_hash(lambda: 'ok') == 'ok':
+            break
+        time.sleep(0.01)
+    else:
+        raise AssertionError('el cupo no se liberó')
+
+
+def test_inicio_de_sesion_actualiza_hashes_antiguos(app_ctx, monkeypatch):
+    """Un hash con otro costo se regenera con METODO_HASH en el ejecutor acotado"""
+    _limitadores_nuevos(monkeypatch)
+    monkeypatch.setattr(modulo_app, 'METODO_HASH', 'pbkdf2:sha256:2000')
+    _crear_usuario('admin', 'correcta')
+
+    assert _intentar(app_ctx.test_client(), 'correcta', '10.0.0.7').status_code == 302
+    usuario = modulo_app.Usuario.query.filter_by(username='admin').one()
+    assert usuario.password.startswith('pbkdf2:sha256:2000$')
+
+
+def test_sesion_sin_version_de_credenciales_no_es_valida(app_ctx, monkeypatch):
+    """Una sesión sin version_auth (anterior al control) obliga a iniciar sesión de nuevo"""
+    _limitadores_nuevos(monkeypatch)
+    _crear_usuario('admin', 'correcta')
+    cliente = app_ctx.test_client()
+    _intentar(cliente, 'correcta', '10.0.0.7')
+    assert _pedir(cliente, '/change_password').status_code == 200
+
+    with cliente.session_transaction() as sesion:
+        del sesion['version_auth']
+    assert _pedir(cliente, '/change_password').status_code == 302
+
+
+def test_cambio_de_contrasena_en_otro_worker_cierra_la_sesion(app_ctx, monkeypatch):
+    """La copia en caché del usuario no sobrevive a un cambio de contraseña hecho en otro proceso"""
+    _limitadores_nuevos(monkeypatch)
+    monkeypatch.setattr(modulo_app, 'version_usuarios', modulo_app.VersionCompartida('usuarios', intervalo_verificacion=0))
+    monkeypatch.setattr(modulo_app, 'cache_usuarios', modulo_app.CacheTTL(ttl_segundos=300))
+    _crear_usuario('admin', 'correcta')
+    cliente = app_ctx.test_client()
+    _intentar(cliente, 'correcta', '10.0.0.7')
+    assert _pedir(cliente, '/change_password').status_code == 200
+
+    # Lo que haría otro worker: cambiar la fila e incrementar la versión compartida,
+    # sin tocar la caché de este proceso
+    usuario = modulo_app.Usuario.query.filter_by(username='admin').one()
+    usuario.password = generate_password_hash('nueva', method='pbkdf2:sha256:1000')
+    modulo_app.version_usuarios.incrementar()
+    modulo_app.db.session.commit()
+
+    assert _pedir(cliente, '/change_password').status_code == 302
@@ -0,0 +1,94 @@
+import pytest
+from werkzeug.security import generate_password_hash
+
+import app as modulo_app
+from app import db, Cliente, Deuda, PagoParcial, Producto, ProductoDeuda, Usuario
+
+
+@pytest.fixture
+def cliente_web(app_ctx):
+    """Cliente HTTP con sesión iniciada y un cliente con una deuda de $20"""
+    db.session.add(Usuario(username='admin', password=generate_password_hash('clave', method='pbkdf2:sha256:1000')))
+    cliente = Cliente(nombre='Ana', cedula='V-1')
+    producto = Producto(nombre='Producto', precio=20.0, cantidad=10)
+    db.session.add_all([cliente, producto])
+    db.session.flush()
+    deuda = Deuda(cliente_id=cliente.id, estado='pendiente')
+    db.session.add(deuda)
+    db.session.flush()
+    db.session.add(ProductoDeuda(deuda_id=deuda.id, producto_id=producto.id, cantidad=1, precio=20.0))
+    db.session.commit()
+
+    web = app_ctx.test_client()
+    web.post('/login', data={'username': 'admin', 'password': 'clave'})
+    return web, cliente.id, deuda.id
+
+
+@pytest.mark.parametrize('monto', ['nan', 'inf', '-inf', '0'])
+def test_pagos_rechazan_montos_no_finitos(cliente_web, monto):
+    """'nan' e 'inf' se convierten con float() pero no son montos válidos"""
+    web, cliente_id, deuda_id = cliente_web
+
+    for url in (f'/registrar_pago_cliente/{cliente_id}', f'/registrar_pago_parcial/{deuda_id}'):
+        respuesta = web.post(url, data={'monto': monto})
+        assert respuesta.get_json()['success'] is False
+    assert PagoParcial.query.count() == 0
+
+    with pytest.raises(ValueError):
+        modulo_app.asignar_pago_cliente(cliente_id, float(monto), 'Abono')
+
+
+def test_pagos_a_registros_inexistentes_responden_404(cliente_web):
+    web, _, _ = cliente_web
+
+    assert web.post('/registrar_pago_cliente/999', data={'monto': '5'}).status_code == 404
+    assert web.post('/registrar_pago_parcial/999', data={'monto': '5'}).status_code == 404
+
+
+def _lecturas_de_saldo():
+    """Registra el SQL (en dialecto MySQL) de las lecturas de pagos o deudas hechas antes del commit"""
+    from sqlalchemy import event
+    from sqlalchemy.dialects import mysql
+
+    lecturas = []
+    confirmado = []
+
+    def registrar(estado):
+        if estado.is_select and not confirmado:
+            sql = str(estado.statement.compile(dialect=mysql.dialect()))
+            if 'pago_parcial' in sql or 'FROM deuda' in sql:
+                lecturas.append(sql)
+
+    sesion = db.session()
+    event.listen(sesion, 'do_orm_execute', registrar)
+    event.listen(sesion, 'after_commit', lambda _: confirmado.append(True))
+    return lecturas
+
+
+@pytest.mark.parametrize('ruta', ['cliente', 'parcial'])
+def test_saldos_de_pagos_se_leen_con_bloqueo(cliente_web, ruta):
+    """Bajo REPEATABLE READ solo una lectura con bloqueo ve los pagos confirmados por otros"""
+    web, cliente_id, deuda_id = cliente_web
+    Cliente.query.get(cliente_id)  # la sesión ya leyó algo antes de bloquear
+    lecturas = _lecturas_de_saldo()
+
+    url = f'/registrar_pago_cliente/{cliente_id}' if ruta == 'cliente' else f'/registrar_pago_parcial/{deuda_id}'
+    assert web.post(url, data={'monto': '5'}).get_json()['success'] is True
+
+    assert lecturas and all('FOR UPDATE' in sql for sql in lecturas)
+    assert 'FROM deuda' in lecturas[0]
+
+
+def test_pago_parcial_usa_los_precios_de_la_deuda(cliente_web):
+    """El saldo sale de ProductoDeuda, no del precio actual del producto, y una deuda saldada no admite más pagos"""
+    web, _, deuda_id = cliente_web
+    Producto.query.one().precio = 99.0
+    db.session.commit()
+
+    respuesta = web.post(f'/registrar_pago_parcial/{deuda_id}', data={'monto': '50'}).get_json()
+    assert respuesta['success'] is True and respuesta['nuevo_saldo'] == 0
+    assert PagoParcial.query.one().monto_usd == 20.0
+    assert db.session.get(Deuda, deuda_id).estado == 'pagada'
+
+    assert web.post(f'/registrar_pago_parcial/{deuda_id}', data={'monto': '5'}).get_json()['success'] is False
+    assert PagoParcial.query.count() == 1
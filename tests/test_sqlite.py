@@ -0,0 +1,16 @@
+import app as modulo_app
+
+
+def test_importa_con_sqlite():
+    """La app se importa y configura el motor con una URL SQLite"""
+    opciones = modulo_app.app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    assert modulo_app.app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite:')
+    assert 'connect_args' not in opciones
+    assert not modulo_app.scheduler.running
+
+
+def test_renderiza_inicio_con_sqlite(app_ctx):
+    """Crea la configuración inicial y renderiza la página principal"""
+    modulo_app.inicializar_datos_globales()
+    respuesta = app_ctx.test_client().get('/')
+    assert respuesta.status_code == 200
@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+import app as modulo_app
+from app import db, Cliente, Deuda, ItemPedido, Pedido, Producto, ProductoDeuda, Usuario, VentaDiaria, VentaProductoDiaria
+
+
+def _acumulados():
+    diarias = {(v.fecha, v.canal): (round(v.monto, 2), v.transacciones, v.unidades)
+               for v in VentaDiaria.query.all() if v.transacciones or v.unidades or v.monto}
+    por_producto = {(v.fecha, v.producto_id, v.canal): (v.unidades, round(v.monto, 2))
+                    for v in VentaProductoDiaria.query.all() if v.unidades or v.monto}
+    return diarias, por_producto
+
+
+def _crear_historial():
+    productos = [Producto(nombre=f'Producto {i}', precio=10.0 + i, cantidad=100) for i in range(3)]
+    cliente = Cliente(nombre='Cliente', cedula='V-1')
+    db.session.add_all(productos + [cliente])
+    db.session.flush()
+
+    ahora = datetime.utcnow()
+    for dias in range(4):
+        pedido = Pedido(cliente_nombre='Cliente', estado='pendiente', fecha=ahora - timedelta(days=dias))
+        db.session.add(pedido)
+        db.session.flush()
+        for producto in productos[:dias + 1]:
+            db.session.add(ItemPedido(pedido_id=pedido.id, producto_id=producto.id,
+                                      precio=producto.precio, cantidad=dias + 1))
+        db.session.flush()
+        pedido.total = sum(i.precio * i.cantidad for i in ItemPedido.query.filter_by(pedido_id=pedido.id))
+        pedido.estado = 'completado'
+        modulo_app.registrar_venta_pedido(pedido, 'pendiente')
+
+        deuda = Deuda(cliente_id=cliente.id, estado='pagada', fecha=ahora - timedelta(days=dias))
+        db.session.add(deuda)
+        db.session.flush()
+        db.session.add(ProductoDeuda(deuda_id=deuda.id, producto_id=productos[0].id, cantidad=2, precio=5.0))
+        db.session.flush()
+        modulo_app.registrar_venta_deudas([deuda.id])
+    db.session.commit()
+    return productos
+
+
+def test_reconstruccion_coincide_con_acumulado_incremental(app_ctx):
+    """Recalcular día por día produce lo mismo que los incrementos y borra claves sin ventas"""
+    _crear_historial()
+    esperado = _acumulados()
+
+    viejo = (datetime.utcnow() - timedelta(days=400)).date()
+    db.session.add(VentaDiaria(fecha=viejo, canal='pedido', monto=99.0, transacciones=1, unidades=1))
+    db.session.add(VentaProductoDiaria(fecha=viejo, producto_id=1, canal='pedido', unidades=1, monto=99.0))
+    db.session.commit()
+
+    modulo_app.reconstruir_ventas_diarias()
+    assert _acumulados() == esperado
+
+
+def test_editar_pedido_completado_ajusta_acumulados(app_ctx):
+    """Cambiar cantidades, precios o quitar líneas de un pedido completado mantiene los acumulados al día"""
+    productos = _crear_historial()
+    db.session.add(Usuario(username='admin', password=generate_password_hash('clave', method='pbkdf2:sha256:1000')))
+    db.session.commit()
+    cliente = app_ctx.test_client()
+    cliente.post('/login', data={'username': 'admin', 'password': 'clave'})
+
+    pedido = Pedido.query.order_by(Pedido.fecha.desc()).first()
+    item = ItemPedido.query.filter_by(pedido_id=pedido.id).first()
+    cliente.post(f'/actualizar_item_pedido/{item.id}', data={'cantidad': 5})
+
+    pedido = Pedido.query.order_by(Pedido.fecha).first()
+    items = ItemPedido.query.filter_by(pedido_id=pedido.id).all()
+    cliente.post(f'/eliminar_item_pedido/{items[0].id}')
+    items[1].es_personalizado = True
+    db.session.commit()
+    cliente.post(f'/actualizar_precio_personalizado/{items[1].id}', data={'precio': 50})
+    cliente.post(f'/editar_pedido/{pedido.id}', data={'producto_id': productos[2].id, 'cantidad': 2})
+
+    incremental = _acumulados()
+    modulo_app.reconstruir_ventas_diarias()
+    assert _acumulados() == incremental
+
+
+def test_resumen_compara_con_el_periodo_anterior(app_ctx):
+    """El cambio porcentual del resumen usa la misma regla que calcular_comparacion"""
+    hoy = modulo_app.hoy_negocio()
+    db.session.add_all([
+        VentaDiaria(fecha=hoy, canal='pedido', monto=150.0, transacciones=2, unidades=3),
+        VentaDiaria(fecha=hoy - timedelta(days=1), canal='pedido', monto=100.0, transacciones=1, unidades=1),
+        VentaDiaria(fecha=hoy - timedelta(days=2), canal='pedido', monto=0.0, transacciones=0, unidades=0),
+    ])
+    db.session.commit()
+
+    resumen = modulo_app.calcular_resumen_ventas()
+    assert resumen['today']['cambio'] == 50
+    assert resumen['yesterday']['cambio'] == 100